@@ -0,0 +1,531 @@
+import asyncio
+import logging
+import os
+
+from urllib.parse import urljoin
+
+from confluence import (API_HEADERS, DEFAULT_ATTACHMENT_JOBS,
+                        DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT,
+                        FINGERPRINT_PROPERTY, MULTIPART_HEADERS, PAGE_EXPAND,
+                        AttachmentUploadException, RequestFailedException,
+                        check_labels, deployed_parts, exists_cql,
+                        label_payload, page_parts, page_payload,
+                        parse_headers, require_kwargs)
+from throttle import rate_limit_buckets, request_kind
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# The default maximum number of requests we allow to be in flight at once
+DEFAULT_CONCURRENCY = 100
+
+log = logging.getLogger(__name__)
+
+
+class AsyncConfluence():
+    def __init__(self,
+                 api_url=None,
+                 username=None,
+                 password=None,
+                 headers=None,
+                 dry_run=False,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 attachment_jobs=DEFAULT_ATTACHMENT_JOBS,
+                 rate_limits=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 _client=None):
+        """Creates a new asyncio Confluence API client.
+
+        This mirrors the Confluence client, except that each API method is a
+        coroutine. Requests are sent over a single aiohttp session, and at most
+        `concurrency` of them are in flight at any time.
+
+        The client should be used as an async context manager so that the
+        underlying session is closed when we're done with it.
+
+        Arguments:
+            api_url {str} -- The URL to the Confluence API root (e.g. https://wiki.example.com/api/rest/)
+            username {str} -- The Confluence service account username
+            password {str} -- The Confluence service account password
+            headers {list(str)} -- The HTTP headers which will be set for all requests
+            dry_run {bool} -- Log requests rather than sending writes to Confluence
+            concurrency {int} -- The maximum number of in-flight requests
+            attachment_jobs {int} -- The number of attachments to upload
+                concurrently for each page
+            rate_limits {dict} -- The requests per second allowed for reads,
+                writes and uploads, keyed by throttle.READ, throttle.WRITE
+                and throttle.UPLOAD
+            connect_timeout {float} -- The number of seconds to wait for a
+                connection to Confluence
+            read_timeout {float} -- The number of seconds to wait between
+                bytes of a response from Confluence
+        """
+        if aiohttp is None and _client is None:
+            raise ImportError(
+                'The aiohttp package is required to use AsyncConfluence')
+
+        if not api_url.endswith('/'):
+            api_url = api_url + '/'
+        self.api_url = api_url
+
+        self.username = username
+        self.password = password
+        self.dry_run = dry_run
+        self.concurrency = concurrency
+        self.attachment_jobs = attachment_jobs
+        self._buckets = rate_limit_buckets(rate_limits)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._headers = dict(parse_headers(headers))
+        self._session = _client
+        self._semaphore = None
+        # The author lookups made by this client, by username
+        self._authors = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Closes the underlying HTTP session, if we created one."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # aiohttp sessions and asyncio primitives should be created from
+        # within the running event loop, so we create them on first use.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._session is None:
+            auth = None
+            if self.username:
+                auth = aiohttp.BasicAuth(self.username, self.password or '')
+            # Every in-flight request gets its own pooled connection
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(auth=auth,
+                                                  headers=self._headers,
+                                                  connector=connector,
+                                                  timeout=timeout)
+        return self._session
+
+    async def _request(self,
+                       method='GET',
+                       path='',
+                       params=None,
+                       files=None,
+                       data=None,
+                       headers=None,
+                       raise_for_status=False):
+        url = urljoin(self.api_url, path)
+        session = self._get_session()
+
+        if not headers:
+            headers = {}
+        headers.update(API_HEADERS)
+
+        if files:
+            headers.update(MULTIPART_HEADERS)
+
+        if self.dry_run:
+            log.info('''{method} {url}:
+            Params: {params}
+            Data: {data}
+            Files: {files}'''.format(method=method,
+                                     url=url,
+                                     params=params,
+                                     data=data,
+                                     files=files))
+            if method != 'GET':
+                return {}
+
+        body = None
+        if files:
+            body = aiohttp.FormData()
+            for name, (filename, content) in files.items():
+                body.add_field(name, content, filename=filename)
+
+        bucket = self._buckets.get(request_kind(method, files))
+        if bucket:
+            delay = bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+        async with self._semaphore:
+            async with session.request(method,
+                                       url,
+                                       params=params,
+                                       json=data,
+                                       data=body,
+                                       headers=headers) as response:
+                if response.status >= 400:
+                    content = await response.read()
+                    log.info('''{method} {url}: {status_code} {reason}
+            Params: {params}
+            Data: {data}
+            Files: {files}
+            Response: {content}'''.format(method=method,
+                                          url=url,
+                                          status_code=response.status,
+                                          reason=response.reason,
+                                          params=params,
+                                          data=data,
+                                          files=files,
+                                          content=content))
+                    if raise_for_status:
+                        raise RequestFailedException(
+                            '{} {}: {} {}'.format(method, url,
+                                                  response.status,
+                                                  response.reason),
+                            status_code=response.status)
+                    return content
+
+                return await response.json(content_type=None)
+
+    async def get(self, path=None, params=None):
+        return await self._request(method='GET', path=path, params=params)
+
+    async def post(self,
+                   path=None,
+                   params=None,
+                   data=None,
+                   files=None,
+                   raise_for_status=False):
+        return await self._request(method='POST',
+                                   path=path,
+                                   params=params,
+                                   data=data,
+                                   files=files,
+                                   raise_for_status=raise_for_status)
+
+    async def put(self, path=None, params=None, data=None,
+                  raise_for_status=False):
+        return await self._request(method='PUT',
+                                   path=path,
+                                   params=params,
+                                   data=data,
+                                   raise_for_status=raise_for_status)
+
+    async def exists(self, space=None, slug=None, ancestor_id=None):
+        """Returns the Confluence page that matches the provided metdata, if
+        it exists.
+
+        See Confluence.exists for details.
+
+        Arguments:
+            space {str} -- The Confluence space to use for filtering posts
+            slug {str} -- The page slug
+            ancestor_id {str} -- The ID of the parent page
+        """
+        require_kwargs({'slug': slug})
+
+        cql = exists_cql(space=space, slug=slug, ancestor_id=ancestor_id)
+        params = {'expand': PAGE_EXPAND, 'cql': cql}
+        response = await self.get(path='content/search', params=params)
+        # An error must not be mistaken for a missing page, which would be
+        # created again
+        if not isinstance(response, dict):
+            raise RequestFailedException(
+                'Unable to search for "{}": {}'.format(cql, response))
+        if not response.get('size'):
+            return None
+        return response['results'][0]
+
+    async def create_labels(self, page_id=None, slug=None, tags=None):
+        """Creates labels for the page to both assist with searching as well
+        as categorization.
+
+        Keyword Arguments:
+            page_id {str} -- The ID of the existing page to which the label should apply
+            slug {str} -- The page slug to use as the label value
+            tags {list(str)} -- Any other tags to apply to the post
+        """
+        labels = label_payload(slug=slug, tags=tags)
+        path = 'content/{page_id}/label'.format(page_id=page_id)
+        response = await self.post(path=path, data=labels)
+        return check_labels(slug, response)
+
+    async def get_attachments(self, post_id):
+        """Gets the attachments for a particular Confluence post
+
+        Arguments:
+            post_id {str} -- The Confluence post ID
+        """
+        response = await self.get('content/{}/child/attachment'.format(post_id))
+        if not isinstance(response, dict):
+            return []
+        return response.get('results', [])
+
+    async def upload_attachment(self, post_id=None, attachment_path=None):
+        """Uploads an attachment to a Confluence post
+
+        Keyword Arguments:
+            post_id {str} -- The Confluence post ID
+            attachment_path {str} -- The absolute path to the attachment
+
+        Returns:
+            dict -- The Confluence response, or None if the upload failed
+        """
+        path = 'content/{}/child/attachment'.format(post_id)
+        if not os.path.exists(attachment_path):
+            log.error('Attachment {} does not exist'.format(attachment_path))
+            return None
+        log.info(
+            'Uploading attachment {attachment_path} to post {post_id}'.format(
+                attachment_path=attachment_path, post_id=post_id))
+        with open(attachment_path, 'rb') as attachment:
+            content = attachment.read()
+        filename = os.path.basename(attachment_path)
+        response = await self.post(path=path,
+                                   params={'allowDuplicated': 'true'},
+                                   files={'file': (filename, content)})
+        if not isinstance(response, dict):
+            log.error('Unable to upload {} to post ID {}'.format(
+                attachment_path, post_id))
+            return None
+        log.info('Uploaded {} to post ID {}'.format(attachment_path, post_id))
+        return response
+
+    async def upload_attachments(self, post_id=None, attachments=None):
+        """Uploads attachments to a Confluence post, up to attachment_jobs
+        at a time.
+
+        See Confluence.upload_attachments for details.
+        """
+        limit = asyncio.Semaphore(self.attachment_jobs)
+
+        async def upload(attachment_path):
+            async with limit:
+                try:
+                    response = await self.upload_attachment(
+                        post_id=post_id, attachment_path=attachment_path)
+                except Exception as e:
+                    log.error('Unable to upload {} to post ID {}: {}'.format(
+                        attachment_path, post_id, e))
+                    return e
+            if response is None:
+                return 'upload failed'
+            return None
+
+        attachments = attachments or []
+        errors = await asyncio.gather(*(upload(attachment)
+                                        for attachment in attachments))
+        return {
+            attachment: error
+            for attachment, error in zip(attachments, errors)
+            if error is not None
+        }
+
+    async def get_author(self, username):
+        """Returns the Confluence author profile for the provided username,
+        if it exists.
+
+        Each username is only looked up once per client. Concurrent calls for
+        the same username share a single request.
+
+        Arguments:
+            username {str} -- The Confluence username
+        """
+        lookup = self._authors.get(username)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._get_author(username))
+            self._authors[username] = lookup
+        try:
+            return await asyncio.shield(lookup)
+        except Exception:
+            # Let a later call try again
+            if self._authors.get(username) is lookup:
+                del self._authors[username]
+            raise
+
+    async def _get_author(self, username):
+        log.info('Looking up Confluence user key for {}'.format(username))
+        response = await self.get(path='user', params={'username': username})
+        if not isinstance(response, dict) or not response.get('userKey'):
+            log.error('No Confluence user key for {}'.format(username))
+            return {}
+        return response
+
+    async def set_property(self,
+                           page_id=None,
+                           key=None,
+                           value=None,
+                           page=None):
+        """Creates or updates a content property on a page.
+
+        See Confluence.set_property for details.
+        """
+        path = 'content/{}/property'.format(page_id)
+        existing = None
+        if page is not None and 'metadata' in page:
+            properties = page.get('metadata', {}).get('properties', {})
+            existing = properties.get(key)
+        else:
+            existing = await self.get(path='{}/{}'.format(path, key),
+                                      params={'expand': 'version'})
+            if not isinstance(existing, dict) or 'version' not in existing:
+                existing = None
+
+        if not existing:
+            return await self.post(path=path,
+                                   data={
+                                       'key': key,
+                                       'value': value
+                                   })
+        return await self.put(path='{}/{}'.format(path, key),
+                              data={
+                                  'key': key,
+                                  'value': value,
+                                  'version': {
+                                      'number':
+                                      existing['version']['number'] + 1
+                                  }
+                              })
+
+    async def create(self,
+                     content=None,
+                     space=None,
+                     title=None,
+                     ancestor_id=None,
+                     slug=None,
+                     tags=None,
+                     attachments=None,
+                     type='page',
+                     fingerprint=None,
+                     parts=None):
+        """Creates a new page with the provided content.
+
+        See Confluence.create for details.
+        """
+        require_kwargs({
+            'content': content,
+            'slug': slug,
+            'title': title,
+            'space': space
+        })
+
+        page = page_payload(content='Upload in progress...',
+                            title=title,
+                            ancestor_id=ancestor_id,
+                            space=space,
+                            type=type)
+        response = await self.post(path='content/',
+                                   data=page,
+                                   raise_for_status=True)
+
+        page_id = response['id']
+        page_url = urljoin(self.api_url, response['_links']['webui'])
+
+        log.info('Page "{title}" (id {page_id}) created successfully at {url}'.
+                 format(title=title, page_id=page_id, url=page_url))
+
+        return await self.update(post_id=page_id,
+                                 content=content,
+                                 space=space,
+                                 title=title,
+                                 ancestor_id=ancestor_id,
+                                 slug=slug,
+                                 tags=tags,
+                                 page=response,
+                                 attachments=attachments,
+                                 fingerprint=fingerprint,
+                                 parts=parts)
+
+    async def update(self,
+                     post_id=None,
+                     content=None,
+                     space=None,
+                     title=None,
+                     ancestor_id=None,
+                     slug=None,
+                     tags=None,
+                     attachments=None,
+                     page=None,
+                     type='page',
+                     fingerprint=None,
+                     parts=None):
+        """Updates an existing page with new content.
+
+        See Confluence.update for details. Unlike Confluence.update, every
+        part of the page is sent, whatever the parts stored on it. The
+        attachments are uploaded concurrently, but all of them finish before
+        the page content is sent.
+        """
+        require_kwargs({
+            'content': content,
+            'slug': slug,
+            'title': title,
+            'post_id': post_id,
+            'space': space
+        })
+
+        failed = await self.upload_attachments(post_id=post_id,
+                                               attachments=attachments)
+        for attachment, error in failed.items():
+            log.error('Attachment {} was not uploaded to page {}: {}'.format(
+                attachment, post_id, error))
+
+        new_page = page_payload(content=content,
+                                title=title,
+                                ancestor_id=ancestor_id,
+                                space=space,
+                                type=type)
+        new_page['version'] = {'number': page['version']['number'] + 1}
+
+        path = 'content/{}'.format(page['id'])
+        response = await self.put(path=path,
+                                  data=new_page,
+                                  raise_for_status=True)
+        log.debug(response)
+
+        page_url = urljoin(self.api_url, response['_links']['webui'])
+
+        await self.create_labels(page_id=post_id, slug=slug, tags=tags)
+
+        # As with Confluence.update, we record what we deployed, clearing the
+        # fingerprint if an attachment failed, so that the threaded client
+        # never skips a page it didn't deploy itself.
+        properties = {}
+        if fingerprint:
+            if parts is None:
+                parts = page_parts(content=content,
+                                   title=title,
+                                   ancestor_id=ancestor_id,
+                                   slug=slug,
+                                   tags=tags,
+                                   attachments=attachments)
+            stored = await self.set_property(
+                page_id=post_id,
+                key=FINGERPRINT_PROPERTY,
+                value={
+                    'fingerprint': None if failed else fingerprint,
+                    'parts': deployed_parts(parts, failed)
+                },
+                page=page)
+            if isinstance(stored, dict) and 'version' in stored:
+                properties[FINGERPRINT_PROPERTY] = stored
+
+        log.info('Page "{title}" (id {page_id}) updated successfully at {url}'.
+                 format(title=title, page_id=post_id, url=page_url))
+        updated = {
+            'id': str(post_id),
+            'version': response['version'],
+            'metadata': {
+                'properties': properties
+            },
+        }
+        if failed:
+            raise AttachmentUploadException(
+                'Unable to upload {} to page {}'.format(
+                    ', '.join(sorted(failed)), post_id),
+                failed=failed,
+                page=updated)
+        return updated
@@ -0,0 +1,175 @@
+"""Resolves post authors to Confluence user keys.
+
+Each unique author is looked up once per run, no matter how many posts they
+wrote. Lookups can be persisted to a cache file so that repeat runs don't
+need to look them up at all.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# How long a resolved user key is cached for
+DEFAULT_AUTHOR_TTL = 7 * 24 * 60 * 60
+
+# How long we remember that a username doesn't exist in Confluence
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+
+# The default number of authors looked up concurrently
+DEFAULT_AUTHOR_JOBS = 8
+
+log = logging.getLogger(__name__)
+
+
+class AuthorResolver():
+    def __init__(self,
+                 confluence,
+                 cache_path=None,
+                 ttl=DEFAULT_AUTHOR_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 jobs=DEFAULT_AUTHOR_JOBS,
+                 _clock=time.time):
+        """Creates a new author resolver.
+
+        Arguments:
+            confluence {confluence.Confluence} -- The Confluence API client
+            cache_path {str} -- The path to a JSON file used to persist the
+                resolved authors between runs (default: don't persist them)
+            ttl {int} -- The number of seconds a resolved user key is cached
+            negative_ttl {int} -- The number of seconds we remember that a
+                username doesn't exist
+            jobs {int} -- The number of authors to look up concurrently
+        """
+        self.confluence = confluence
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.jobs = jobs
+        self._clock = _clock
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._dirty = False
+        self._cache = self._load()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable author cache {}: {}'.format(
+                self.cache_path, e))
+            return {}
+        now = self._clock()
+        return {
+            username: entry
+            for username, entry in cache.items()
+            if entry.get('expires', 0) > now
+        }
+
+    def save(self):
+        """Writes the resolved authors to the cache file, if one is set."""
+        if not self.cache_path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            cache = dict(self._cache)
+            self._dirty = False
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that an interrupted run never
+        # leaves a truncated cache behind.
+        tmp_path = '{}.tmp'.format(self.cache_path)
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(cache, cache_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def resolve(self, usernames):
+        """Resolves the user keys for the given usernames, looking up any that
+        aren't cached concurrently.
+
+        Arguments:
+            usernames {list(str)} -- The usernames to resolve
+
+        Returns:
+            dict -- The user key for each username, or None if the user
+                doesn't exist (or couldn't be looked up)
+        """
+        now = self._clock()
+        resolved = {}
+        waiting = {}
+        missing = []
+        with self._lock:
+            for username in set(usernames):
+                entry = self._cache.get(username)
+                if entry and entry['expires'] > now:
+                    resolved[username] = entry['key']
+                elif username in self._pending:
+                    # Another thread is already looking this user up
+                    waiting[username] = self._pending[username]
+                else:
+                    future = Future()
+                    self._pending[username] = future
+                    waiting[username] = future
+                    missing.append(username)
+
+        if len(missing) == 1 or self.jobs <= 1:
+            for username in missing:
+                self._lookup(username)
+        elif missing:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                list(executor.map(self._lookup, missing))
+
+        for username, future in waiting.items():
+            resolved[username] = future.result()
+        return resolved
+
+    def author_keys(self, usernames):
+        """Returns the user keys for the authors which exist in Confluence,
+        in the order given.
+
+        Arguments:
+            usernames {list(str)} -- The author usernames
+        """
+        resolved = self.resolve(usernames)
+        keys = []
+        for username in usernames:
+            if not resolved.get(username):
+                log.error('No Confluence user key for {}'.format(username))
+                continue
+            keys.append(resolved[username])
+        return keys
+
+    def _lookup(self, username):
+        log.info('Looking up Confluence user key for {}'.format(username))
+        key = None
+        ttl = None
+        try:
+            user = self.confluence.find_user(username)
+        except Exception as e:
+            # We don't cache failed lookups, since they may succeed next time
+            log.error('Unable to look up Confluence user {}: {}'.format(
+                username, e))
+        else:
+            if user is None:
+                ttl = self.negative_ttl
+            else:
+                key = user['userKey']
+                ttl = self.ttl
+
+        with self._lock:
+            if ttl is not None:
+                self._cache[username] = {
+                    'key': key,
+                    'expires': self._clock() + ttl,
+                }
+                self._dirty = True
+            future = self._pending.pop(username)
+        future.set_result(key)
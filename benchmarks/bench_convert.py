@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+import textwrap
+import time
+
+import mistune
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from convert import (PLUGINS, ConfluenceRenderer, convtoconf_many,
+                     render_content, render_layout)
+"""Measures how quickly posts are converted.
+
+This compares building a new parser and renderer for every post (as
+convtoconf used to) with convtoconf_many, which reuses them, and measures the
+throughput of converting a single large document. Run it against different
+mistune versions to compare them.
+"""
+
+POST = textwrap.dedent('''\
+    # Post {n}
+
+    Some *emphasis*, a [link](https://example.com) and an image:
+
+    ![diagram](/images/diagram-{n}.png)
+
+    ```python
+    print({n})
+    ```
+    ''')
+
+
+def convert_fresh(posts):
+    """Converts each post with a new parser and renderer, like convtoconf
+    did before parsers were reused."""
+    for markdown, front_matter in posts:
+        renderer = ConfluenceRenderer()
+        parser = mistune.create_markdown(renderer=renderer, plugins=PLUGINS)
+        content_html = parser(markdown)
+        page_html = render_layout(content_html,
+                                  has_toc=renderer.has_toc,
+                                  author_keys=front_matter.get('author_keys'))
+        yield page_html, renderer.attachments
+
+
+def timed(convert, posts):
+    start = time.perf_counter()
+    for _ in convert(posts):
+        pass
+    return time.perf_counter() - start
+
+
+def large_document(size):
+    """Returns a Markdown document of roughly the given size, in bytes."""
+    sections = []
+    length = 0
+    while length < size:
+        section = POST.format(n=len(sections)) + '\n'
+        sections.append(section)
+        length += len(section)
+    return ''.join(sections)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks converting posts to Confluence pages')
+    parser.add_argument('--posts',
+                        type=int,
+                        default=5000,
+                        help='The number of posts to convert (default: 5000)')
+    parser.add_argument('--document-kb',
+                        type=int,
+                        default=2048,
+                        help='The size of the large document to convert, in '
+                        'KiB (default: 2048)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help='The number of runs to take the best of '
+                        '(default: 3)')
+    args = parser.parse_args()
+
+    posts = [(POST.format(n=n), {'author_keys': ['key']})
+             for n in range(args.posts)]
+    for name, convert in [('fresh parser', convert_fresh),
+                          ('convtoconf_many', convtoconf_many)]:
+        best = min(timed(convert, posts) for _ in range(args.repeat))
+        print('{:<16} {:8.3f}s total {:8.1f}us/post'.format(
+            name, best, best / args.posts * 1e6))
+
+    document = large_document(args.document_kb * 1024)
+    best = min(
+        timed(lambda document: [render_content(document)], document)
+        for _ in range(args.repeat))
+    print('{:<16} {:8.3f}s total {:8.2f}MB/s'.format(
+        'large document', best,
+        len(document) / best / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
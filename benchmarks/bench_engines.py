@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_convert import POST, large_document
+from convert import available_engines, parse, render_content
+"""Compares the throughput and peak memory of each Markdown engine.
+
+The corpus is either a directory of posts (such as the content directory of
+a repo) or, by default, a set of generated posts and one large document.
+"""
+
+
+def load_corpus(directory):
+    """Returns the Markdown body of every post in a directory."""
+    posts = []
+    pattern = os.path.join(directory, '**', '*.md')
+    for post_path in sorted(glob.glob(pattern, recursive=True)):
+        try:
+            _, markdown = parse(post_path)
+        except Exception as e:
+            print('Skipping {}: {}'.format(post_path, e))
+            continue
+        posts.append(markdown)
+    return posts
+
+
+def measure(engine, documents):
+    """Converts every document, returning the time taken and the peak
+    memory allocated."""
+    # Build the engine before measuring, as it's reused between runs
+    render_content('', engine=engine)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for document in documents:
+        render_content(document, engine=engine)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the Markdown engines against each other')
+    parser.add_argument('--corpus',
+                        help='A directory of posts to convert (default: '
+                        'generated posts)')
+    parser.add_argument('--posts',
+                        type=int,
+                        default=2000,
+                        help='The number of posts to generate (default: 2000)')
+    parser.add_argument('--document-kb',
+                        type=int,
+                        default=2048,
+                        help='The size of the large document to generate, in '
+                        'KiB (default: 2048)')
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpora = [('corpus', load_corpus(args.corpus))]
+    else:
+        corpora = [
+            ('small posts', [POST.format(n=n) for n in range(args.posts)]),
+            ('large document', [large_document(args.document_kb * 1024)]),
+        ]
+
+    for name, documents in corpora:
+        size = sum(len(document) for document in documents)
+        print('{} ({} documents, {:.1f}MB)'.format(name, len(documents),
+                                                  size / 1024 / 1024))
+        for engine in available_engines():
+            elapsed, peak = measure(engine, documents)
+            print('  {:<12} {:8.3f}s {:8.2f}MB/s {:8.1f}MB peak'.format(
+                engine, elapsed, size / elapsed / 1024 / 1024,
+                peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
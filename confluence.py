@@ -1,10 +1,21 @@
+import collections
+import hashlib
 import logging
 import json
 import requests
 import os
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 
+from sources import FILE_SOURCE
+from throttle import (IDEMPOTENT_METHODS, TRANSIENT_STATUSES, AdaptiveLimiter,
+                      RetryPolicy, parse_retry_after, rate_limit_buckets,
+                      request_kind)
+
 API_HEADERS = {
     'User-Agent': 'markdown-to-confluence',
 }
@@ -15,14 +26,382 @@ MULTIPART_HEADERS = {
 
 DEFAULT_LABEL_PREFIX = 'global'
 
+# The default number of attachments uploaded concurrently for a single page
+DEFAULT_ATTACHMENT_JOBS = 4
+
+# The default number of slugs looked up in a single search by exists_many,
+# which keeps the CQL query well within URL length limits
+DEFAULT_LOOKUP_CHUNK_SIZE = 50
+
+# The number of search results we request per page
+SEARCH_PAGE_SIZE = 100
+
+# The prefix of the attachment comment in which we store the content hash of
+# each attachment, so that we can tell if it has changed
+ATTACHMENT_HASH_PREFIX = 'sha256:'
+
+# The content property in which we store the fingerprint of the deployed page,
+# so that we can tell if a post has changed since it was last deployed
+FINGERPRINT_PROPERTY = 'markdown-to-confluence'
+
+# The properties we expand when looking up an existing page
+PAGE_EXPAND = 'version,metadata.properties.{}'.format(FINGERPRINT_PROPERTY)
+
+# The default number of connections kept open to Confluence
+DEFAULT_POOL_SIZE = 10
+
+# The default number of seconds to wait to connect to Confluence, and then
+# between bytes of its response
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+
 log = logging.getLogger(__name__)
 
+# The calls needed to update a page: the attachments to upload, and whether
+# to update its body, its title and ancestor, and its labels
+UpdatePlan = collections.namedtuple('UpdatePlan',
+                                    ['attachments', 'body', 'page', 'labels'])
+
 
 class MissingArgumentException(Exception):
     def __init__(self, arg):
         self.message = 'Missing required argument: {}'.format(arg)
 
 
+class RequestFailedException(Exception):
+    def __init__(self, message, status_code=None):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(message)
+
+
+class AttachmentUploadException(Exception):
+    """Raised when a page was deployed, but some of its attachments couldn't
+    be uploaded. The failed attachments (mapped to the reason for the
+    failure) and the deployed page are kept on the exception."""
+
+    def __init__(self, message, failed=None, page=None):
+        self.message = message
+        self.failed = failed or {}
+        self.page = page
+        super().__init__(message)
+
+
+def parse_headers(headers):
+    """Splits "Name: value" header strings into (name, value) pairs.
+
+    If no value is set, an empty string is used.
+
+    Arguments:
+        headers {list(str)} -- The HTTP headers to parse
+    """
+    parsed = []
+    for header in headers or []:
+        try:
+            name, value = header.split(':', 1)
+        except ValueError:
+            name, value = header, ''
+        parsed.append((name, value.lstrip()))
+    return parsed
+
+
+def require_kwargs(kwargs):
+    """Ensures that certain kwargs have been provided
+
+    Arguments:
+        kwargs {dict} -- The dict of required kwargs
+    """
+    missing = []
+    for k, v in kwargs.items():
+        if not v:
+            missing.append(k)
+    if missing:
+        raise MissingArgumentException(missing)
+
+
+def exists_cql(space=None, slug=None, ancestor_id=None, slugs=None):
+    """Returns the CQL query used to find the page for a slug.
+
+    Arguments:
+        space {str} -- The Confluence space to use for filtering posts
+        slug {str} -- The page slug
+        ancestor_id {str} -- The ID of the parent page
+        slugs {list(str)} -- Multiple page slugs to search for at once
+    """
+    cql_args = []
+    if slug:
+        cql_args.append('label={}'.format(slug))
+    if slugs:
+        cql_args.append('label in ({})'.format(','.join(
+            '"{}"'.format(slug) for slug in slugs)))
+    if ancestor_id:
+        cql_args.append('ancestor={}'.format(ancestor_id))
+    if space:
+        cql_args.append('space={!r}'.format(space))
+    return ' and '.join(cql_args)
+
+
+def label_payload(slug=None, tags=None):
+    """Returns the labels to apply to a page: the slug, followed by any tags.
+
+    Arguments:
+        slug {str} -- The page slug to use as the label value
+        tags {list(str)} -- Any other tags to apply to the post
+    """
+    labels = [{'prefix': DEFAULT_LABEL_PREFIX, 'name': slug}]
+    for tag in tags or []:
+        labels.append({'prefix': DEFAULT_LABEL_PREFIX, 'name': tag})
+    return labels
+
+
+def check_labels(slug, response):
+    """Does a sanity check to ensure that the label for the slug appears in
+    the label creation response, since that's needed for us to find the page
+    later.
+
+    Arguments:
+        slug {str} -- The page slug
+        response {dict} -- The response from the label creation request
+
+    Returns:
+        list(dict) -- The labels now applied to the page
+    """
+    labels = response.get('results', []) if isinstance(response, dict) else []
+    if not labels:
+        log.error(
+            'No labels found after attempting to update page {}'.format(slug))
+        log.error('Here\'s the response we got:\n{}'.format(response))
+        return labels
+
+    if not any(label['name'] == slug for label in labels):
+        log.error('Returned labels missing the expected slug: {}'.format(slug))
+        log.error('Here are the labels we got: {}'.format(labels))
+        return labels
+
+    log.info('Created the following labels for page {slug}: {labels}'.format(
+        slug=slug, labels=', '.join(label['name'] for label in labels)))
+    return labels
+
+
+def attachment_unchanged(attachment, size, digest):
+    """Returns whether an attachment on Confluence has the given size and
+    content hash.
+
+    Arguments:
+        attachment {dict} -- The attachment, with the extensions and
+            metadata properties expanded
+        size {int} -- The size of the local file
+        digest {str} -- The SHA-256 hex digest of the local file
+    """
+    file_size = attachment.get('extensions', {}).get('fileSize')
+    comment = attachment.get('metadata', {}).get('comment', '')
+    return file_size == size and comment == ATTACHMENT_HASH_PREFIX + digest
+
+
+def page_parts(content=None,
+               title=None,
+               ancestor_id=None,
+               slug=None,
+               tags=None,
+               attachments=None,
+               source=None,
+               **kwargs):
+    """Returns a summary of each part of a page we deploy, which is stored on
+    the page so that the next deploy can tell which parts have changed.
+
+    Keyword Arguments:
+        content {str} -- The page represented in Confluence storage format
+        title {str} -- The page title
+        ancestor_id {str} -- The ID of the parent Confluence page
+        slug {str} -- The unique slug for the page
+        tags {list(str)} -- The list of tags for the page
+        attachments {list(str)} -- The absolute paths to the attachments
+        source {sources.FileSource} -- The source attachments are read from
+            (default: the filesystem)
+
+    Returns:
+        dict -- The body hash, title, ancestor, labels and attachment digests
+    """
+    source = source or FILE_SOURCE
+    attachment_digests = {}
+    for attachment in attachments or []:
+        if source.exists(attachment):
+            attachment_digests[os.path.basename(attachment)] = source.digest(
+                attachment)
+    return {
+        'body': hashlib.sha256((content or '').encode('utf-8')).hexdigest(),
+        'title': title,
+        'ancestor_id': str(ancestor_id),
+        'labels': sorted(set([slug] + list(tags or []))),
+        'attachments': attachment_digests,
+    }
+
+
+def page_fingerprint(content=None,
+                     title=None,
+                     ancestor_id=None,
+                     slug=None,
+                     tags=None,
+                     attachments=None,
+                     source=None,
+                     **kwargs):
+    """Returns a fingerprint of everything we deploy for a page, which
+    changes if (and only if) the page needs to be deployed again.
+
+    Besides the rendered body, title, ancestor and labels, this covers the
+    contents of the attachments, since an image can change without the body
+    which references it changing.
+
+    Keyword Arguments:
+        content {str} -- The page represented in Confluence storage format
+        title {str} -- The page title
+        ancestor_id {str} -- The ID of the parent Confluence page
+        slug {str} -- The unique slug for the page
+        tags {list(str)} -- The list of tags for the page
+        attachments {list(str)} -- The absolute paths to the attachments
+        source {sources.FileSource} -- The source attachments are read from
+            (default: the filesystem)
+
+    Returns:
+        str -- The SHA-256 hex digest of the page
+    """
+    return parts_fingerprint(
+        page_parts(content=content,
+                   title=title,
+                   ancestor_id=ancestor_id,
+                   slug=slug,
+                   tags=tags,
+                   attachments=attachments,
+                   source=source))
+
+
+def parts_fingerprint(parts):
+    """Returns the fingerprint of a page from its parts, so that a caller
+    which needs both only reads the attachments once.
+
+    Arguments:
+        parts {dict} -- The page parts returned by page_parts
+
+    Returns:
+        str -- The SHA-256 hex digest of the page
+    """
+    serialized = json.dumps(parts, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def stored_fingerprint(page):
+    """Returns the fingerprint stored on a page when it was last deployed,
+    if any.
+
+    Arguments:
+        page {dict} -- The page, with the fingerprint property expanded
+    """
+    return stored_value(page).get('fingerprint')
+
+
+def stored_parts(page):
+    """Returns the page parts stored on a page when it was last deployed, if
+    any.
+
+    Arguments:
+        page {dict} -- The page, with the fingerprint property expanded
+    """
+    return stored_value(page).get('parts')
+
+
+def stored_value(page):
+    properties = (page or {}).get('metadata', {}).get('properties', {})
+    return properties.get(FINGERPRINT_PROPERTY, {}).get('value', {})
+
+
+def deployed_parts(parts, failed=None):
+    """Returns the page parts which were actually deployed, leaving out the
+    attachments which failed to upload so that the next deploy uploads them
+    again.
+
+    Arguments:
+        parts {dict} -- The page parts returned by page_parts
+        failed {dict} -- The attachments which failed to upload, by path
+    """
+    if not failed:
+        return parts
+    failed_names = set(os.path.basename(attachment) for attachment in failed)
+    return dict(parts,
+                attachments={
+                    name: digest
+                    for name, digest in parts['attachments'].items()
+                    if name not in failed_names
+                })
+
+
+def plan_update(remote_parts, parts, attachments=None):
+    """Returns the steps needed to bring a page from what was last deployed
+    to what we want to deploy now.
+
+    If we don't know what was last deployed, every step is needed.
+
+    Arguments:
+        remote_parts {dict} -- The page parts stored on the page, or None
+        parts {dict} -- The page parts returned by page_parts
+        attachments {list(str)} -- The absolute paths to the attachments
+
+    Returns:
+        UpdatePlan -- The attachments to upload, and whether to update the
+            body, the title and ancestor only, and the labels
+    """
+    attachments = attachments or []
+    if not remote_parts:
+        return UpdatePlan(attachments=attachments,
+                          body=True,
+                          page=True,
+                          labels=True)
+
+    remote_attachments = remote_parts.get('attachments', {})
+    changed = [
+        attachment for attachment in attachments
+        if remote_attachments.get(os.path.basename(attachment)) !=
+        parts['attachments'].get(os.path.basename(attachment))
+    ]
+    body = remote_parts.get('body') != parts['body']
+    page = (remote_parts.get('title') != parts['title']
+            or remote_parts.get('ancestor_id') != parts['ancestor_id'])
+    # We never remove labels, so only new labels need to be added
+    labels = bool(set(parts['labels']) - set(remote_parts.get('labels', [])))
+    return UpdatePlan(attachments=changed, body=body, page=page, labels=labels)
+
+
+def page_payload(content=None,
+                 title=None,
+                 ancestor_id=None,
+                 space=None,
+                 type='page'):
+    """Returns the content payload used to create or update a page.
+
+    Keyword Arguments:
+        content {str} -- The page represented in Confluence storage format
+        title {str} -- The page title
+        ancestor_id {str} -- The ID of the parent Confluence page
+        space {str} -- The Confluence space where the page should reside
+        type {str} -- The Confluence content type
+    """
+    return {
+        'type': type,
+        'title': title,
+        'space': {
+            'key': space
+        },
+        'body': {
+            'storage': {
+                'representation': 'storage',
+                'value': content
+            }
+        },
+        'ancestors': [{
+            'id': str(ancestor_id)
+        }]
+    }
+
+
 class Confluence():
     def __init__(self,
                  api_url=None,
@@ -30,6 +409,15 @@ class Confluence():
                  password=None,
                  headers=None,
                  dry_run=False,
+                 attachment_jobs=DEFAULT_ATTACHMENT_JOBS,
+                 rate_limits=None,
+                 max_concurrency=None,
+                 retry_policy=None,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 pool_block=False,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 source=None,
                  _client=None):
         """Creates a new Confluence API client.
         
@@ -38,7 +426,29 @@ class Confluence():
             username {str} -- The Confluence service account username
             password {str} -- The Confluence service account password
             headers {list(str)} -- The HTTP headers which will be set for all requests
-            dry_run {str} -- The Confluence service account password
+            dry_run {bool} -- Log requests rather than sending writes to Confluence
+            attachment_jobs {int} -- The number of attachments to upload
+                concurrently for each page
+            rate_limits {dict} -- The requests per second allowed for reads,
+                writes and uploads, keyed by throttle.READ, throttle.WRITE
+                and throttle.UPLOAD
+            max_concurrency {int} -- If set, the number of concurrent requests
+                adapts to how Confluence is responding, up to this maximum
+            retry_policy {throttle.RetryPolicy} -- How transient failures are
+                retried (default: throttle.DEFAULT_RETRIES retries with
+                exponential backoff)
+            pool_size {int} -- The number of connections to keep open to
+                Confluence. This should be at least the number of requests
+                made concurrently, or connections will be thrown away and
+                re-established.
+            pool_block {bool} -- When every pooled connection is in use, wait
+                for one to be free rather than opening a throwaway connection
+            connect_timeout {float} -- The number of seconds to wait for a
+                connection to Confluence
+            read_timeout {float} -- The number of seconds to wait between
+                bytes of a response from Confluence
+            source {sources.FileSource} -- The source attachments are read
+                from (default: the filesystem)
         """
         # A common gotcha will be given a URL that doesn't end with a /, so we
         # can account for this
@@ -49,18 +459,31 @@ class Confluence():
         self.username = username
         self.password = password
         self.dry_run = dry_run
+        self.attachment_jobs = attachment_jobs
+        self.source = source or FILE_SOURCE
+        self._buckets = rate_limit_buckets(rate_limits)
+        self._limiter = None
+        if max_concurrency:
+            self._limiter = AdaptiveLimiter(maximum=max_concurrency)
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        self._known_pages = {}
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
 
         if _client is None:
             _client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size,
+                                  pool_block=pool_block)
+            _client.mount('https://', adapter)
+            _client.mount('http://', adapter)
 
         self._session = _client
         self._session.auth = (self.username, self.password)
-        for header in headers or []:
-            try:
-                name, value = header.split(':', 1)
-            except ValueError:
-                name, value = header, ''
-            self._session.headers[name] = value.lstrip()
+        for name, value in parse_headers(headers):
+            self._session.headers[name] = value
 
     def _require_kwargs(self, kwargs):
         """Ensures that certain kwargs have been provided
@@ -68,12 +491,7 @@ class Confluence():
         Arguments:
             kwargs {dict} -- The dict of required kwargs
         """
-        missing = []
-        for k, v in kwargs.items():
-            if not v:
-                missing.append(k)
-        if missing:
-            raise MissingArgumentException(missing)
+        require_kwargs(kwargs)
 
     def _request(self,
                  method='GET',
@@ -81,8 +499,32 @@ class Confluence():
                  params=None,
                  files=None,
                  data=None,
-                 headers=None):
+                 headers=None,
+                 idempotent=None,
+                 raise_for_status=False):
+        """Sends a request to the Confluence API, retrying transient
+        failures.
+
+        Keyword Arguments:
+            method {str} -- The HTTP method
+            path {str} -- The path, relative to the API root
+            params {dict} -- The query parameters
+            files {dict} -- Any files to upload as multipart form data
+            data {object} -- The JSON body
+            headers {dict} -- Any extra headers to send
+            idempotent {bool} -- Whether the request can safely be repeated if
+                we don't know whether it took effect (default: based on the
+                method)
+            raise_for_status {bool} -- Raise a RequestFailedException if
+                Confluence returns an error, rather than returning the content
+
+        Returns:
+            dict -- The decoded JSON response, or the raw response content if
+                Confluence returned an error
+        """
         url = urljoin(self.api_url, path)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
 
         if not headers:
             headers = {}
@@ -106,42 +548,161 @@ class Confluence():
             if method != 'GET':
                 return {}
 
-        response = self._session.request(method=method,
-                                         url=url,
-                                         params=params,
-                                         json=data,
-                                         headers=headers,
-                                         files=files)
+        # We serialize the body once up front, so that retries send exactly
+        # the same bytes without re-encoding them.
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+
+        bucket = self._buckets.get(request_kind(method, files))
+        attempt = 0
+        while True:
+            if bucket:
+                bucket.acquire()
+            try:
+                response = self._send(method=method,
+                                      url=url,
+                                      params=params,
+                                      data=body,
+                                      headers=headers,
+                                      files=files)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                # If we couldn't connect, the request was never sent.
+                # Otherwise, it may have been processed before we lost the
+                # response.
+                never_sent = isinstance(e, requests.exceptions.ConnectTimeout)
+                if attempt >= self._retry_policy.retries or not (
+                        idempotent or never_sent):
+                    raise
+                delay = self._retry_policy.delay(attempt)
+                log.warning('{method} {url} failed ({error}), retrying in '
+                            '{delay:.1f}s'.format(method=method,
+                                                 url=url,
+                                                 error=e,
+                                                 delay=delay))
+            else:
+                if not self._retry_policy.should_retry(
+                        attempt, response.status_code, idempotent):
+                    break
+                retry_after = parse_retry_after(
+                    response.headers.get('Retry-After'))
+                delay = self._retry_policy.delay(attempt, retry_after)
+                log.warning('{method} {url}: {status_code}, retrying in '
+                            '{delay:.1f}s'.format(
+                                method=method,
+                                url=url,
+                                status_code=response.status_code,
+                                delay=delay))
+            time.sleep(delay)
+            attempt += 1
+            # Any files being uploaded were read by the previous attempt
+            for upload in (files or {}).values():
+                if isinstance(upload, tuple):
+                    upload = upload[1]
+                if hasattr(upload, 'seek'):
+                    upload.seek(0)
 
         if not response.ok:
             log.info('''{method} {url}: {status_code} {reason}
             Params: {params}
             Data: {data}
-            Files: {files}'''.format(method=method,
-                                     url=url,
-                                     status_code=response.status_code,
-                                     reason=response.reason,
-                                     params=params,
-                                     data=data,
-                                     files=files))
-            print(response.content)
+            Files: {files}
+            Response: {content}'''.format(method=method,
+                                          url=url,
+                                          status_code=response.status_code,
+                                          reason=response.reason,
+                                          params=params,
+                                          data=data,
+                                          files=files,
+                                          content=response.content))
+            if raise_for_status:
+                raise RequestFailedException(
+                    '{} {}: {} {}'.format(method, url, response.status_code,
+                                          response.reason),
+                    status_code=response.status_code)
             return response.content
 
         # Will probably want to be more robust here, but this should work for now
         return response.json()
 
+    def _send(self, **kwargs):
+        """Sends a request through the session, reporting the outcome to the
+        adaptive concurrency limiter (if enabled)."""
+        kwargs.setdefault('timeout', self.timeout)
+        if self._limiter is None:
+            return self._session.request(**kwargs)
+
+        self._limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = self._session.request(**kwargs)
+        except Exception:
+            self._limiter.release(failed=True)
+            raise
+        self._limiter.release(
+            status=response.status_code,
+            latency=time.monotonic() - start,
+            retry_after=parse_retry_after(
+                response.headers.get('Retry-After')))
+        return response
+
+    def warm(self, connections=None):
+        """Opens connections to Confluence in the background, so that the
+        TCP and TLS handshakes are out of the way before the first posts are
+        ready to deploy.
+
+        Arguments:
+            connections {int} -- The number of connections to open (default:
+                the pool size)
+
+        Returns:
+            list(threading.Thread) -- The threads opening the connections
+        """
+        url = urljoin(self.api_url, 'user/current')
+        # Warming counts against the same read rate limit and adaptive
+        # concurrency limit as any other request
+        bucket = self._buckets.get(request_kind('GET'))
+
+        def connect():
+            try:
+                if bucket:
+                    bucket.acquire()
+                self._send(method='GET', url=url, headers=dict(API_HEADERS))
+            except requests.exceptions.RequestException as e:
+                log.debug('Unable to pre-warm connection: {}'.format(e))
+
+        threads = []
+        for i in range(connections or self.pool_size):
+            thread = threading.Thread(target=connect,
+                                      name='warm-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
     def get(self, path=None, params=None):
         return self._request(method='GET', path=path, params=params)
 
-    def post(self, path=None, params=None, data=None, files=None):
+    def post(self,
+             path=None,
+             params=None,
+             data=None,
+             files=None,
+             idempotent=False):
         return self._request(method='POST',
                              path=path,
                              params=params,
                              data=data,
-                             files=files)
+                             files=files,
+                             idempotent=idempotent)
 
-    def put(self, path=None, params=None, data=None):
-        return self._request(method='PUT', path=path, params=params, data=data)
+    def put(self, path=None, params=None, data=None, raise_for_status=False):
+        return self._request(method='PUT',
+                             path=path,
+                             params=params,
+                             data=data,
+                             raise_for_status=raise_for_status)
 
     def exists(self, space=None, slug=None, ancestor_id=None):
         """Returns the Confluence page that matches the provided metdata, if it exists.
@@ -157,22 +718,112 @@ class Confluence():
         """
         self._require_kwargs({'slug': slug})
 
-        cql_args = []
-        if slug:
-            cql_args.append('label={}'.format(slug))
-        if ancestor_id:
-            cql_args.append('ancestor={}'.format(ancestor_id))
-        if space:
-            cql_args.append('space={!r}'.format(space))
+        # If we've already looked up this page as part of a batch, we can
+        # use that result (once) rather than searching again.
+        key = (space, str(ancestor_id), slug)
+        if key in self._known_pages:
+            return self._known_pages.pop(key)
 
-        cql = ' and '.join(cql_args)
+        cql = exists_cql(space=space, slug=slug, ancestor_id=ancestor_id)
 
-        params = {'expand': 'version', 'cql': cql}
+        params = {'expand': PAGE_EXPAND, 'cql': cql}
         response = self.get(path='content/search', params=params)
+        # An error must not be mistaken for a missing page, which would be
+        # created again
+        if not isinstance(response, dict):
+            raise RequestFailedException(
+                'Unable to search for "{}": {}'.format(cql, response))
         if not response.get('size'):
             return None
         return response['results'][0]
 
+    def exists_many(self,
+                    space=None,
+                    slugs=None,
+                    ancestor_id=None,
+                    chunk_size=DEFAULT_LOOKUP_CHUNK_SIZE):
+        """Looks up the Confluence pages for many slugs at once.
+
+        This searches for the slugs in chunks with a single CQL query each,
+        rather than one query per slug. The results are remembered, so that
+        the next call to exists() for each slug doesn't need to search again.
+
+        Arguments:
+            space {str} -- The Confluence space to use for filtering posts
+            slugs {list(str)} -- The page slugs
+            ancestor_id {str} -- The ID of the parent page
+            chunk_size {int} -- The number of slugs to search for per query
+
+        Returns:
+            dict -- The page for each slug, or None if it doesn't exist
+        """
+        slugs = sorted(set(slugs or []))
+        pages = dict.fromkeys(slugs)
+        for i in range(0, len(slugs), chunk_size):
+            chunk = slugs[i:i + chunk_size]
+            cql = exists_cql(space=space, slugs=chunk, ancestor_id=ancestor_id)
+            expand = '{},metadata.labels'.format(PAGE_EXPAND)
+            for page in self._search(cql, expand=expand):
+                labels = page.get('metadata', {}).get('labels', {})
+                for label in labels.get('results', []):
+                    slug = label.get('name')
+                    if slug in pages and pages[slug] is None:
+                        pages[slug] = page
+
+        for slug, page in pages.items():
+            self._known_pages[(space, str(ancestor_id), slug)] = page
+        return pages
+
+    def _search(self, cql, expand=None):
+        """Returns every result for a CQL content search, following the
+        pagination of the results.
+
+        Arguments:
+            cql {str} -- The CQL query
+            expand {str} -- The properties to expand on each result
+        """
+        results = []
+        start = 0
+        while True:
+            params = {
+                'cql': cql,
+                'start': start,
+                'limit': SEARCH_PAGE_SIZE,
+            }
+            if expand:
+                params['expand'] = expand
+            response = self.get(path='content/search', params=params)
+            if not isinstance(response, dict):
+                raise RequestFailedException(
+                    'Unable to search for "{}": {}'.format(cql, response))
+            page = response.get('results', [])
+            results.extend(page)
+            if not page or not response.get('_links', {}).get('next'):
+                return results
+            start += len(page)
+
+    def _get_all(self, path, params=None):
+        """Returns every result from a paginated API endpoint.
+
+        Arguments:
+            path {str} -- The path to the endpoint
+            params {dict} -- Any other query parameters
+        """
+        results = []
+        start = 0
+        while True:
+            page_params = dict(params or {})
+            page_params.update({'start': start, 'limit': SEARCH_PAGE_SIZE})
+            response = self.get(path=path, params=page_params)
+            if not isinstance(response, dict):
+                raise RequestFailedException('Unable to get {}: {}'.format(
+                    path, response))
+            page = response.get('results', [])
+            results.extend(page)
+            if not page or not response.get('_links', {}).get('next'):
+                return results
+            start += len(page)
+
     def create_labels(self, page_id=None, slug=None, tags=[]):
         """Creates labels for the page to both assist with searching as well
         as categorization.
@@ -185,36 +836,12 @@ class Confluence():
             slug {str} -- The page slug to use as the label value
             tags {list(str)} -- Any other tags to apply to the post
         """
-        labels = [{'prefix': DEFAULT_LABEL_PREFIX, 'name': slug}]
-
-        if tags is None:
-            tags = []
-        for tag in tags:
-            labels.append({'prefix': DEFAULT_LABEL_PREFIX, 'name': tag})
+        labels = label_payload(slug=slug, tags=tags)
         path = 'content/{page_id}/label'.format(page_id=page_id)
-        response = self.post(path=path, data=labels)
-
-        # Do a sanity check to ensure that the label for the slug appears in
-        # the results, since that's needed for us to find the page later.
-        labels = response.get('results', [])
-        if not labels:
-            log.error(
-                'No labels found after attempting to update page {}'.format(
-                    slug))
-            log.error('Here\'s the response we got:\n{}'.format(response))
-            return labels
-
-        if not any(label['name'] == slug for label in labels):
-            log.error(
-                'Returned labels missing the expected slug: {}'.format(slug))
-            log.error('Here are the labels we got: {}'.format(labels))
-            return labels
-
-        log.info(
-            'Created the following labels for page {slug}: {labels}'.format(
-                slug=slug,
-                labels=', '.join(label['name'] for label in labels)))
-        return labels
+        # Adding labels which already exist is a no-op, so this can safely
+        # be retried.
+        response = self.post(path=path, data=labels, idempotent=True)
+        return check_labels(slug, response)
 
     def _create_page_payload(self,
                              content=None,
@@ -223,22 +850,80 @@ class Confluence():
                              attachments=None,
                              space=None,
                              type='page'):
-        return {
-            'type': type,
+        return page_payload(content=content,
+                            title=title,
+                            ancestor_id=ancestor_id,
+                            space=space,
+                            type=type)
+
+    def find_page(self, space=None, title=None, type='page'):
+        """Returns the page with the given title in a space, if it exists.
+
+        Page titles are unique within a Confluence space, so this can be used
+        to tell if a page was created, even before it has been labeled.
+
+        Arguments:
+            space {str} -- The Confluence space
+            title {str} -- The page title
+        """
+        params = {
+            'spaceKey': space,
             'title': title,
-            'space': {
-                'key': space
-            },
-            'body': {
-                'storage': {
-                    'representation': 'storage',
-                    'value': content
-                }
-            },
-            'ancestors': [{
-                'id': str(ancestor_id)
-            }]
+            'type': type,
+            'expand': 'version'
         }
+        response = self.get(path='content', params=params)
+        if not isinstance(response, dict) or not response.get('results'):
+            return None
+        return response['results'][0]
+
+    def _create_page(self, page):
+        """Creates a page from the provided payload, retrying transient
+        failures.
+
+        Creating a page isn't idempotent, so if an attempt fails in a way
+        that means it may have taken effect, we check whether the page now
+        exists before trying again.
+
+        Arguments:
+            page {dict} -- The page payload
+
+        Returns:
+            dict -- The created page
+        """
+        space = page['space']['key']
+        title = page['title']
+        attempt = 0
+        while True:
+            try:
+                return self._request(method='POST',
+                                     path='content/',
+                                     data=page,
+                                     idempotent=False,
+                                     raise_for_status=True)
+            except RequestFailedException as e:
+                if e.status_code not in TRANSIENT_STATUSES:
+                    raise
+                error = e
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+
+            existing = self.find_page(space=space, title=title,
+                                      type=page['type'])
+            if existing:
+                log.info('Page "{}" was created despite an error: {}'.format(
+                    title, error))
+                return existing
+
+            if attempt >= self._retry_policy.retries:
+                raise RequestFailedException(
+                    'Unable to create page "{}": {}'.format(title, error))
+            delay = self._retry_policy.delay(attempt)
+            log.warning('Unable to create page "{}", retrying in {:.1f}s'.format(
+                title, delay))
+            time.sleep(delay)
+            attempt += 1
 
     def get_attachments(self, post_id):
         """Gets the attachments for a particular Confluence post
@@ -246,27 +931,168 @@ class Confluence():
         Arguments:
             post_id {str} -- The Confluence post ID
         """
-        response = self.get("/content/{}/attachments".format(post_id))
-        return response.get('results', [])
+        return self._get_all('content/{}/child/attachment'.format(post_id),
+                             params={'expand': 'version,extensions,metadata'})
 
-    def upload_attachment(self, post_id=None, attachment_path=None):
+    def upload_attachment(self,
+                          post_id=None,
+                          attachment_path=None,
+                          attachment_id=None,
+                          digest=None):
         """Uploads an attachment to a Confluence post
         
         Keyword Arguments:
             post_id {str} -- The Confluence post ID
             attachment_path {str} -- The absolute path to the attachment
+            attachment_id {str} -- The ID of the existing attachment to
+                replace with a new version, if any
+            digest {str} -- The SHA-256 hex digest of the attachment, which is
+                stored in the attachment comment
+
+        Returns:
+            dict -- The Confluence response, or None if the upload failed
         """
         path = 'content/{}/child/attachment'.format(post_id)
-        if not os.path.exists(attachment_path):
+        params = {'allowDuplicated': 'true'}
+        if attachment_id:
+            path = '{}/{}/data'.format(path, attachment_id)
+            params = None
+        if not self.source.exists(attachment_path):
             log.error('Attachment {} does not exist'.format(attachment_path))
-            return
+            return None
         log.info(
             'Uploading attachment {attachment_path} to post {post_id}'.format(
                 attachment_path=attachment_path, post_id=post_id))
-        self.post(path=path,
-                  params={'allowDuplicated': 'true'},
-                  files={'file': open(attachment_path, 'rb')})
+        with self.source.open(attachment_path) as attachment:
+            files = {
+                'file': (os.path.basename(attachment_path), attachment)
+            }
+            if digest:
+                files['comment'] = (None, ATTACHMENT_HASH_PREFIX + digest)
+            response = self.post(path=path, params=params, files=files)
+        if not isinstance(response, dict):
+            log.error('Unable to upload {} to post ID {}'.format(
+                attachment_path, post_id))
+            return None
         log.info('Uploaded {} to post ID {}'.format(attachment_path, post_id))
+        return response
+
+    def upload_attachments(self,
+                           post_id=None,
+                           attachments=None,
+                           remote_attachments=None,
+                           digests=None):
+        """Uploads the attachments for a Confluence post which are new or
+        have changed, up to attachment_jobs at a time.
+
+        The existing attachments are listed once, and each local file is
+        compared against the one with the same name by size and by the
+        content hash stored in its comment. Changed files are uploaded as a
+        new version of the existing attachment. Every upload is attempted,
+        even if some of them fail.
+
+        Keyword Arguments:
+            post_id {str} -- The Confluence post ID
+            attachments {list(str)} -- The absolute paths to the attachments
+            remote_attachments {list(dict)} -- The attachments already on the
+                post, if known (default: fetch them from Confluence)
+            digests {dict} -- The SHA-256 hex digest of each attachment, by
+                file name, if already known (default: read the attachments)
+
+        Returns:
+            dict -- The attachments which failed to upload, mapped to the
+                reason for the failure
+        """
+        # The same image may be referenced many times in a post, but only
+        # needs to be uploaded once.
+        attachments = list(collections.OrderedDict.fromkeys(attachments
+                                                            or []))
+        if not attachments:
+            return {}
+
+        if remote_attachments is None:
+            remote_attachments = self.get_attachments(post_id)
+        remote = {
+            attachment['title']: attachment
+            for attachment in remote_attachments
+        }
+
+        def upload(attachment_path):
+            try:
+                if not self.source.exists(attachment_path):
+                    log.error('Attachment {} does not exist'.format(
+                        attachment_path))
+                    return 'file does not exist'
+                name = os.path.basename(attachment_path)
+                size = self.source.size(attachment_path)
+                digest = (digests or {}).get(name) or self.source.digest(
+                    attachment_path)
+                existing = remote.get(name)
+                if existing and attachment_unchanged(existing, size, digest):
+                    log.info('Attachment {} is unchanged'.format(
+                        attachment_path))
+                    return None
+                response = self.upload_attachment(
+                    post_id=post_id,
+                    attachment_path=attachment_path,
+                    attachment_id=existing['id'] if existing else None,
+                    digest=digest)
+            except Exception as e:
+                log.error('Unable to upload {} to post ID {}: {}'.format(
+                    attachment_path, post_id, e))
+                return e
+            if response is None:
+                return 'upload failed'
+            return None
+
+        if self.attachment_jobs <= 1 or len(attachments) <= 1:
+            errors = [upload(attachment) for attachment in attachments]
+        else:
+            with ThreadPoolExecutor(
+                    max_workers=self.attachment_jobs) as executor:
+                errors = list(executor.map(upload, attachments))
+
+        return {
+            attachment: error
+            for attachment, error in zip(attachments, errors)
+            if error is not None
+        }
+
+    def set_property(self, page_id=None, key=None, value=None, page=None):
+        """Creates or updates a content property on a page.
+
+        Keyword Arguments:
+            page_id {str} -- The ID of the Confluence page
+            key {str} -- The property key
+            value {object} -- The JSON value of the property
+            page {dict} -- The page, with its metadata.properties expanded,
+                if it was already fetched (default: fetch the property)
+
+        Returns:
+            dict -- The Confluence response
+        """
+        path = 'content/{}/property'.format(page_id)
+        existing = None
+        if page is not None and 'metadata' in page:
+            properties = page.get('metadata', {}).get('properties', {})
+            existing = properties.get(key)
+        else:
+            existing = self._request(method='GET',
+                                     path='{}/{}'.format(path, key),
+                                     params={'expand': 'version'})
+            if not isinstance(existing, dict) or 'version' not in existing:
+                existing = None
+
+        if not existing:
+            return self.post(path=path, data={'key': key, 'value': value})
+        return self.put(path='{}/{}'.format(path, key),
+                        data={
+                            'key': key,
+                            'value': value,
+                            'version': {
+                                'number': existing['version']['number'] + 1
+                            }
+                        })
 
     def get_author(self, username):
         """Returns the Confluence author profile for the provided username,
@@ -282,6 +1108,34 @@ class Confluence():
             return {}
         return response
 
+    def find_user(self, username):
+        """Returns the Confluence profile for the provided username.
+
+        Unlike get_author, this distinguishes between a user that doesn't
+        exist and a failed lookup.
+
+        Arguments:
+            username {str} -- The Confluence username
+
+        Returns:
+            dict -- The user profile, or None if the user doesn't exist
+
+        Raises:
+            RequestFailedException -- If the user couldn't be looked up
+        """
+        try:
+            response = self._request(method='GET',
+                                     path='user',
+                                     params={'username': username},
+                                     raise_for_status=True)
+        except RequestFailedException as e:
+            if e.status_code == 404:
+                return None
+            raise
+        if not isinstance(response, dict) or not response.get('userKey'):
+            return None
+        return response
+
     def create(self,
                content=None,
                space=None,
@@ -290,7 +1144,9 @@ class Confluence():
                slug=None,
                tags=None,
                attachments=None,
-               type='page'):
+               type='page',
+               fingerprint=None,
+               parts=None):
         """Creates a new page with the provided content.
 
         If an ancestor_id is specified, then the page will be created as a
@@ -305,6 +1161,16 @@ class Confluence():
             tags {list(str)} -- The list of tags for the page
             attachments {list(str)} -- List of absolute paths to attachments
                 which should uploaded.
+            fingerprint {str} -- The page fingerprint to store on the page
+                once it has been created
+            parts {dict} -- The page parts returned by page_parts, if already
+                known (default: compute them)
+
+        Returns:
+            dict -- The created page, in the shape returned by exists
+
+        Raises:
+            AttachmentUploadException -- If any attachment failed to upload
         """
         self._require_kwargs({
             'content': content,
@@ -318,7 +1184,7 @@ class Confluence():
                                          ancestor_id=ancestor_id,
                                          space=space,
                                          type=type)
-        response = self.post(path='content/', data=page)
+        response = self._create_page(page)
 
         page_id = response['id']
         page_url = urljoin(self.api_url, response['_links']['webui'])
@@ -336,7 +1202,10 @@ class Confluence():
                            slug=slug,
                            tags=tags,
                            page=response,
-                           attachments=attachments)
+                           attachments=attachments,
+                           remote_attachments=[],
+                           fingerprint=fingerprint,
+                           parts=parts)
 
     def update(self,
                post_id=None,
@@ -348,11 +1217,16 @@ class Confluence():
                tags=None,
                attachments=None,
                page=None,
-               type='page'):
+               type='page',
+               remote_attachments=None,
+               fingerprint=None,
+               parts=None):
         """Updates an existing page with new content.
 
         This involves updating the attachments stored on Confluence, uploading
-        the page content, and finally updating the labels.
+        the page content, and finally updating the labels. If the page has
+        the parts we last deployed stored on it, only the parts which have
+        changed are updated.
         
         Keyword Arguments:
             post_id {str} -- The ID of the Confluence post
@@ -364,6 +1238,19 @@ class Confluence():
             tags {list(str)} -- The list of tags for the page
             attachments {list(str)} -- The list of absolute file paths to any
                 attachments which should be uploaded
+            remote_attachments {list(dict)} -- The attachments already on the
+                page, if known (default: fetch them from Confluence)
+            fingerprint {str} -- The page fingerprint to store on the page
+                once it has been updated
+            parts {dict} -- The page parts returned by page_parts, if already
+                known (default: compute them)
+
+        Returns:
+            dict -- The updated page, in the shape returned by exists
+
+        Raises:
+            AttachmentUploadException -- If any attachment failed to upload.
+                The rest of the page is still deployed.
         """
         self._require_kwargs({
             'content': content,
@@ -372,36 +1259,102 @@ class Confluence():
             'post_id': post_id,
             'space': space
         })
+        # Computing the parts reads every attachment, so callers which already
+        # have them (from computing the fingerprint) pass them in.
+        if parts is None:
+            parts = page_parts(content=content,
+                               title=title,
+                               ancestor_id=ancestor_id,
+                               slug=slug,
+                               tags=tags,
+                               attachments=attachments,
+                               source=self.source)
+        plan = plan_update(stored_parts(page), parts, attachments=attachments)
+        log.debug('Update plan for page {}: {}'.format(post_id, plan))
+
         # Since the page already has an ID in Confluence, before updating our
         # content which references certain attachments, we should make sure
         # those attachments have been uploaded.
-        if attachments is None:
-            attachments = []
-
-        for attachment in attachments:
-            self.upload_attachment(post_id=post_id, attachment_path=attachment)
-
-        # Next, we can create the updated page structure
-        new_page = self._create_page_payload(content=content,
-                                             title=title,
-                                             ancestor_id=ancestor_id,
-                                             space=space,
-                                             type=type)
-        # Increment the version number, as required by the Confluence API
-        # https://docs.atlassian.com/ConfluenceServer/rest/7.1.0/#api/content-update
-        new_version = page['version']['number'] + 1
-        new_page['version'] = {'number': new_version}
-
-        # With the attachments uploaded, and our new page structure created,
-        # we can upload the final content up to Confluence.
-        path = 'content/{}'.format(page['id'])
-        response = self.put(path=path, data=new_page)
-        print(response)
+        failed = {}
+        if plan.attachments:
+            failed = self.upload_attachments(
+                post_id=post_id,
+                attachments=plan.attachments,
+                remote_attachments=remote_attachments,
+                digests=parts['attachments'])
+        for attachment, error in failed.items():
+            log.error('Attachment {} was not uploaded to page {}: {}'.format(
+                attachment, post_id, error))
 
-        page_url = urljoin(self.api_url, response['_links']['webui'])
+        version = page['version']
+        page_url = None
+        if plan.body or plan.page:
+            # Next, we can create the updated page structure. If only the
+            # title or ancestor changed, we leave the body out.
+            new_page = self._create_page_payload(content=content,
+                                                 title=title,
+                                                 ancestor_id=ancestor_id,
+                                                 space=space,
+                                                 type=type)
+            if not plan.body:
+                del new_page['body']
+            # Increment the version number, as required by the Confluence API
+            # https://docs.atlassian.com/ConfluenceServer/rest/7.1.0/#api/content-update
+            new_version = page['version']['number'] + 1
+            new_page['version'] = {'number': new_version}
+
+            # With the attachments uploaded, and our new page structure
+            # created, we can upload the final content up to Confluence. If
+            # the page was changed (or deleted) since we looked it up, this
+            # fails rather than overwriting it.
+            path = 'content/{}'.format(page['id'])
+            response = self.put(path=path,
+                                data=new_page,
+                                raise_for_status=True)
+            log.debug(response)
+            version = response['version']
+            page_url = urljoin(self.api_url, response['_links']['webui'])
 
         # Finally, we can update the labels on the page
-        self.create_labels(page_id=post_id, slug=slug, tags=tags)
+        if plan.labels:
+            self.create_labels(page_id=post_id, slug=slug, tags=tags)
 
-        log.info('Page "{title}" (id {page_id}) updated successfully at {url}'.
-                 format(title=title, page_id=post_id, url=page_url))
\ No newline at end of file
+        # Once everything else is deployed, we record what we deployed, so
+        # that the next deploy can be skipped if nothing has changed. If an
+        # attachment failed, we clear the fingerprint (the page no longer
+        # matches the old one either) and leave the attachment out of the
+        # parts, so that the next deploy uploads it again.
+        properties = {}
+        if fingerprint:
+            stored = self.set_property(
+                page_id=post_id,
+                key=FINGERPRINT_PROPERTY,
+                value={
+                    'fingerprint': None if failed else fingerprint,
+                    'parts': deployed_parts(parts, failed)
+                },
+                page=page)
+            if isinstance(stored, dict) and 'version' in stored:
+                properties[FINGERPRINT_PROPERTY] = stored
+
+        if page_url:
+            log.info(
+                'Page "{title}" (id {page_id}) updated successfully at {url}'.
+                format(title=title, page_id=post_id, url=page_url))
+        else:
+            log.info('Page "{title}" (id {page_id}) updated successfully'.
+                     format(title=title, page_id=post_id))
+        updated = {
+            'id': str(post_id),
+            'version': version,
+            'metadata': {
+                'properties': properties
+            },
+        }
+        if failed:
+            raise AttachmentUploadException(
+                'Unable to upload {} to page {}'.format(
+                    ', '.join(sorted(failed)), post_id),
+                failed=failed,
+                page=updated)
+        return updated
\ No newline at end of file
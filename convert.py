@@ -1,58 +1,504 @@
+import io
+import json
 import mistune
+import mmap
 import os
+import re
 import textwrap
+import threading
 import yaml
 
 from urllib.parse import urlparse
 
+from render_cache import cache_key
+
+try:
+    import tomllib
+except ImportError:
+    # tomllib was added in Python 3.11
+    tomllib = None
+
+try:
+    import markdown_it
+    from markdown_it import MarkdownIt
+except ImportError:
+    # markdown-it-py is only needed for the markdown-it engine
+    markdown_it = None
+    MarkdownIt = None
+
+YAML = 'yaml'
+TOML = 'toml'
+JSON = 'json'
+
 YAML_BOUNDARY = '---'
+TOML_BOUNDARY = '+++'
 
+# The LibYAML loader is several times faster than the pure Python one, but
+# is only available if PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-def parse(post_path):
-    """Parses the metadata and content from the provided post.
+# Posts larger than this are memory-mapped rather than read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+# The syntax enabled on top of CommonMark, which matches what the mistune 0.8
+# parser supported out of the box
+PLUGINS = ['strikethrough', 'footnotes', 'table', 'url']
+
+# The version of the rendered output. This must be changed whenever a change
+# to the renderers changes their output, so that cached output isn't reused.
+RENDER_VERSION = '1'
+
+# Documents larger than this are cached in fragments, one per section, so
+# that editing one section only renders that section again
+FRAGMENT_THRESHOLD = 256 * 1024
+
+# A heading which starts a new section, if it follows a blank line
+SECTION_HEADING = re.compile(r'#{1,6}(\s|$)')
+
+# The start of a code fence, which may contain lines that look like headings
+FENCE = re.compile(r' {0,3}(`{3,}|~{3,})')
+
+# A line which can close a code fence
+CLOSING_FENCE = re.compile(r' {0,3}(`{3,}|~{3,})[ \t]*$')
+
+# Markdown whose meaning can depend on other sections of the document: link
+# reference definitions, footnotes, and raw HTML blocks which can contain
+# blank lines
+NON_LOCAL = re.compile(
+    r'^ {0,3}(\[[^\]]+\]:|\[\^|<!--|<\?|<!\[CDATA\[|'
+    r'<(pre|script|style|textarea)[\s>])',
+    re.MULTILINE | re.IGNORECASE)
+
+MISTUNE = 'mistune'
+MARKDOWN_IT = 'markdown-it'
+DEFAULT_ENGINE = MISTUNE
+
+# Each thread keeps its own engines, since an engine holds the state of the
+# document being converted
+_engines = threading.local()
+
+
+class PostBody():
+    def __init__(self, load):
+        """Creates a handle to the Markdown body of a post, which is only
+        read the first time it is needed.
+
+        Arguments:
+            load {callable} -- Returns the raw bytes of the body
+        """
+        self._load = load
+        self._markdown = None
+
+    def read(self):
+        """Returns the Markdown body of the post."""
+        if self._markdown is None:
+            self._markdown = decode(self._load()).strip()
+            self._load = None
+        return self._markdown
+
+
+def decode(raw):
+    """Decodes part of a post, translating newlines the way reading it in
+    text mode would.
+
+    Arguments:
+        raw {bytes} -- The raw bytes
+    """
+    return raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def split_front_matter(post):
+    """Reads the front matter from the start of a post, stopping at the line
+    which closes it.
+
+    As with Hugo, front matter is YAML (optionally opened by ---), TOML
+    between +++ lines, or a JSON object.
+
+    Arguments:
+        post {file} -- The post, opened in binary mode (or memory-mapped)
+
+    Returns:
+        tuple(str, bytes, int) -- The front matter format (YAML, TOML or
+            JSON), the raw front matter, and the offset at which the body
+            starts
+    """
+    lines = []
+    offset = 0
+    first = post.readline()
+    offset += len(first)
+    if first.strip() == TOML_BOUNDARY.encode():
+        front_matter_format = TOML
+    elif first.lstrip().startswith(b'{'):
+        front_matter_format = JSON
+        lines.append(first)
+    else:
+        front_matter_format = YAML
+        lines.append(first)
+
+    if front_matter_format == JSON and closes_json(lines):
+        return front_matter_format, first, offset
+
+    for line in iter(post.readline, b''):
+        offset += len(line)
+        if front_matter_format == JSON:
+            lines.append(line)
+            if closes_json(lines):
+                break
+        elif front_matter_format == TOML:
+            if line.strip() == TOML_BOUNDARY.encode():
+                break
+            lines.append(line)
+        else:
+            # The first line may open the front matter, but can't close it
+            if line.strip() == YAML_BOUNDARY.encode() and any(lines):
+                break
+            lines.append(line)
+    return front_matter_format, b''.join(lines), offset
+
+
+def closes_json(lines):
+    """Returns whether the last line read closes the JSON object the front
+    matter started with.
+
+    Arguments:
+        lines {list(bytes)} -- The lines of front matter read so far
+    """
+    if not lines[-1].rstrip().endswith(b'}'):
+        return False
+    try:
+        json.loads(decode(b''.join(lines)))
+    except ValueError:
+        return False
+    return True
+
+
+def load_front_matter(front_matter_format, raw):
+    """Parses the raw front matter of a post.
+
+    Arguments:
+        front_matter_format {str} -- The format (YAML, TOML or JSON)
+        raw {bytes} -- The raw front matter
+    """
+    text = decode(raw)
+    if front_matter_format == JSON:
+        return json.loads(text)
+    if front_matter_format == TOML:
+        if tomllib is None:
+            raise ValueError(
+                'TOML front matter requires Python 3.11 or newer')
+        return tomllib.loads(text)
+    return yaml.load(text, Loader=YAML_LOADER)
+
+
+def open_post(post_path, source=None):
+    """Opens a post for reading in binary mode.
+
+    Arguments:
+        post_path {str} -- The absolute path to the Markdown post
+        source {sources.FileSource} -- The source to read the post from
+            (default: the filesystem)
+    """
+    if source is None:
+        return open(post_path, 'rb')
+    return source.open(post_path)
+
+
+def mapped(post):
+    """Returns a memory map of a post if it is large enough to be worth it
+    (and is a file on disk), or None.
+
+    Arguments:
+        post {file} -- The post, opened in binary mode
+    """
+    try:
+        fileno = post.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    if os.fstat(fileno).st_size <= MMAP_THRESHOLD:
+        return None
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def read_body(post_path, offset, source=None):
+    """Reads the body of a post.
+
+    Arguments:
+        post_path {str} -- The absolute path to the Markdown post
+        offset {int} -- The offset at which the body starts
+        source {sources.FileSource} -- The source to read the post from
+            (default: the filesystem)
+    """
+    with open_post(post_path, source) as post:
+        mm = mapped(post)
+        if mm is not None:
+            with mm:
+                return mm[offset:]
+        post.seek(offset)
+        return post.read()
+
+
+def parse_front_matter(post_path, source=None):
+    """Parses the metadata from the provided post. A post on disk isn't read
+    past its front matter until the body is needed.
+
+    Sources which can only read a post whole (such as a GitSource) return it
+    in memory, in which case the body is kept from the same read rather than
+    being read again.
 
     Arguments:
         post_path {str} -- The absolute path to the Markdown post
+        source {sources.FileSource} -- The source to read the post from
+            (default: the filesystem)
+
+    Returns:
+        tuple(dict, PostBody) -- The front matter, and a handle to the body
     """
-    raw_yaml = ''
-    markdown = ''
-    in_yaml = True
-    with open(post_path, 'r') as post:
-        for line in post.readlines():
-            # Check if this is the ending tag
-            if line.strip() == YAML_BOUNDARY:
-                if in_yaml and raw_yaml:
-                    in_yaml = False
-                    continue
-            if in_yaml:
-                raw_yaml += line
+    with open_post(post_path, source) as post:
+        if isinstance(post, io.BytesIO):
+            data = post.getvalue()
+            front_matter_format, raw, offset = split_front_matter(post)
+            body = PostBody(lambda: data[offset:])
+        else:
+            mm = mapped(post)
+            if mm is not None:
+                with mm:
+                    front_matter_format, raw, offset = split_front_matter(mm)
             else:
-                markdown += line
-    front_matter = yaml.load(raw_yaml, Loader=yaml.SafeLoader)
-    markdown = markdown.strip()
-    return front_matter, markdown
+                front_matter_format, raw, offset = split_front_matter(post)
+            body = PostBody(
+                lambda: read_body(post_path, offset, source=source))
+    front_matter = load_front_matter(front_matter_format, raw)
+    return front_matter, body
+
 
+def parse(post_path, source=None):
+    """Parses the metadata and content from the provided post.
 
-def convtoconf(markdown, front_matter={}):
+    Arguments:
+        post_path {str} -- The absolute path to the Markdown post
+        source {sources.FileSource} -- The source to read the post from
+            (default: the filesystem)
+    """
+    front_matter, body = parse_front_matter(post_path, source=source)
+    return front_matter, body.read()
+
+
+def convtoconf(markdown, front_matter={}, engine=DEFAULT_ENGINE, cache=None):
     if front_matter is None:
         front_matter = {}
 
     author_keys = front_matter.get('author_keys', [])
-    renderer = ConfluenceRenderer(authors=author_keys)
-    content_html = mistune.markdown(markdown, renderer=renderer)
-    page_html = renderer.layout(content_html)
+    content_html, has_toc, attachments = render_content(markdown,
+                                                        engine=engine,
+                                                        cache=cache)
+    page_html = render_layout(content_html,
+                              has_toc=has_toc,
+                              author_keys=author_keys)
+
+    return page_html, attachments
+
+
+def convtoconf_many(posts, engine=DEFAULT_ENGINE, cache=None):
+    """Converts many posts, reusing the same parser and renderer for each.
+
+    Arguments:
+        posts {iterable(tuple(str, dict))} -- The Markdown content and front
+            matter of each post
+        engine {str} -- The name of the Markdown engine to use
+        cache {render_cache.RenderCache} -- A cache of rendered content
+            (default: don't cache the content)
+
+    Returns:
+        generator(tuple(str, list(str))) -- The page HTML and attachments of
+            each post, in order
+    """
+    for markdown, front_matter in posts:
+        yield convtoconf(markdown,
+                         front_matter=front_matter,
+                         engine=engine,
+                         cache=cache)
+
+
+def available_engines():
+    """Returns the names of the Markdown engines which can be used."""
+    return [name for name, engine in ENGINES.items() if engine.available()]
+
+
+def get_engine(name=DEFAULT_ENGINE):
+    """Returns the Markdown engine with the given name for the current
+    thread, creating it the first time it's needed.
+
+    Building an engine compiles its parser rules, so it's done once per
+    thread (or worker process) rather than once per post.
 
-    return page_html, renderer.attachments
+    Arguments:
+        name {str} -- The name of the engine
+    """
+    engines = getattr(_engines, 'engines', None)
+    if engines is None:
+        engines = _engines.engines = {}
+    engine = engines.get(name)
+    if engine is None:
+        if name not in ENGINES:
+            raise ValueError('Unknown Markdown engine {}'.format(name))
+        if not ENGINES[name].available():
+            raise ValueError(
+                'The {} Markdown engine is not installed'.format(name))
+        engine = engines[name] = ENGINES[name]()
+    return engine
+
+
+def render_content(markdown, engine=DEFAULT_ENGINE, cache=None):
+    """Renders the Markdown content of a post, without the page layout.
+
+    This is the expensive part of the conversion, and doesn't depend on
+    anything looked up from Confluence, so it can be done ahead of time (or in
+    another process).
+
+    Arguments:
+        markdown {str} -- The Markdown content of the post
+        engine {str} -- The name of the Markdown engine to use
+        cache {render_cache.RenderCache} -- A cache of rendered content
+            (default: don't cache the content)
+
+    Returns:
+        tuple(str, bool, list(str)) -- The content HTML, whether a TOC should
+            be rendered, and the paths of the referenced attachments
+    """
+    if cache is None:
+        return get_engine(engine).render(markdown)
+
+    sections = None
+    if len(markdown) > FRAGMENT_THRESHOLD:
+        sections = split_sections(markdown)
+    if not sections:
+        return render_cached(markdown, engine, cache)
+
+    # Each section is rendered (and cached) on its own, and the fragments are
+    # joined back together
+    fragments = []
+    has_toc = False
+    attachments = []
+    for section in sections:
+        fragment, section_has_toc, section_attachments = render_cached(
+            section, engine, cache)
+        fragments.append(fragment)
+        has_toc = has_toc or section_has_toc
+        attachments.extend(section_attachments)
+    return ''.join(fragments), has_toc, attachments
 
 
-class ConfluenceRenderer(mistune.Renderer):
+def render_cached(markdown, engine, cache):
+    """Renders Markdown content, reusing the cached output if it has been
+    rendered before.
+
+    Arguments:
+        markdown {str} -- The Markdown content
+        engine {str} -- The name of the Markdown engine to use
+        cache {render_cache.RenderCache} -- The cache of rendered content
+    """
+    key = content_key(markdown, engine)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached['content'], cached['has_toc'], cached['attachments']
+    content_html, has_toc, attachments = get_engine(engine).render(markdown)
+    cache.put(key, {
+        'content': content_html,
+        'has_toc': has_toc,
+        'attachments': attachments,
+    })
+    return content_html, has_toc, attachments
+
+
+def split_sections(markdown):
+    """Splits a document into sections which can be rendered on their own,
+    each starting at a heading.
+
+    A heading which follows a blank line always starts a new top-level block,
+    so rendering each section separately gives the same output as rendering
+    the whole document. Documents where that isn't the case, because they
+    use link references, footnotes or raw HTML blocks, aren't split.
+
+    Arguments:
+        markdown {str} -- The Markdown content
+
+    Returns:
+        list(str) -- The sections, or None if the document can't be split
+    """
+    if NON_LOCAL.search(markdown):
+        return None
+
+    sections = []
+    start = 0
+    offset = 0
+    fence = None
+    blank = True
+    for line in markdown.split('\n'):
+        if fence is not None:
+            # A fence is closed by a fence of the same kind, at least as long
+            match = CLOSING_FENCE.match(line)
+            if match and match.group(1).startswith(fence):
+                fence = None
+        else:
+            match = FENCE.match(line)
+            if match:
+                fence = match.group(1)
+            elif blank and offset > start and SECTION_HEADING.match(line):
+                sections.append(markdown[start:offset])
+                start = offset
+        blank = not line.strip()
+        offset += len(line) + 1
+    sections.append(markdown[start:])
+    return sections
+
+
+def content_key(markdown, engine=DEFAULT_ENGINE):
+    """Returns the render cache key for the content of a post, which
+    changes whenever the post, the engine or the renderer does.
+
+    Arguments:
+        markdown {str} -- The Markdown content of the post
+        engine {str} -- The name of the Markdown engine
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown Markdown engine {}'.format(engine))
+    return cache_key(RENDER_VERSION, engine, ENGINES[engine].version(),
+                     markdown)
+
+
+def render_layout(content_html, has_toc=False, author_keys=None):
+    """Wraps rendered content in the final page layout.
+
+    Arguments:
+        content_html {str} -- The HTML returned by render_content
+        has_toc {bool} -- Whether to render a table of contents
+        author_keys {list(str)} -- The Confluence user keys for each author
+    """
+    renderer = ConfluenceRenderer(authors=author_keys)
+    renderer.has_toc = has_toc
+    return renderer.layout(content_html)
+
+
+class ConfluenceRenderer(mistune.HTMLRenderer):
     def __init__(self, authors=[]):
         self.attachments = []
         if authors is None:
             authors = []
         self.authors = authors
         self.has_toc = False
-        super().__init__()
+        # Raw HTML in posts is passed through, as it always has been
+        super().__init__(escape=False)
+
+    def reset(self, authors=None):
+        """Clears the state kept for the last document rendered, so that
+        the renderer can be reused for another.
+
+        Arguments:
+            authors {list(str)} -- The Confluence user keys for each author
+        """
+        self.attachments = []
+        self.authors = authors or []
+        self.has_toc = False
 
     def layout(self, content):
         """Renders the final layout of the content. This includes a two-column
@@ -91,14 +537,18 @@ class ConfluenceRenderer(mistune.Renderer):
         main_content = column.format(width='800px', content=content)
         return sidebar + main_content
 
-    def header(self, text, level, raw=None):
+    def heading(self, text, level, **attrs):
         """Processes a Markdown header.
 
         In our case, this just tells us that we need to render a TOC. We don't
         actually do any special rendering for headers.
         """
         self.has_toc = True
-        return super().header(text, level, raw)
+        # mistune 3 passes extra attributes (such as an id) as keywords
+        return super().heading(text, level, **attrs)
+
+    # The name of the method in the mistune 0.8 API
+    header = heading
 
     def render_authors(self):
         """Renders a header that details which author(s) published the post.
@@ -121,32 +571,169 @@ class ConfluenceRenderer(mistune.Renderer):
             for user_key in self.authors)
         return '<h1>Authors</h1><p>{}</p>'.format(author_content)
 
-    def block_code(self, code, lang):
-        return textwrap.dedent('''\
-            <ac:structured-macro ac:name="code" ac:schema-version="1">
-                <ac:parameter ac:name="language">{l}</ac:parameter>
-                <ac:plain-text-body><![CDATA[{c}]]></ac:plain-text-body>
-            </ac:structured-macro>
-        ''').format(c=code, l=lang or '')
+    def block_code(self, code, info=None):
+        return render_code(code, info)
 
-    def image(self, src, title, alt_text):
+    def image(self, src, alt='', title=None, url=None):
         """Renders an image into XHTML expected by Confluence.
 
+        mistune 2 calls this as image(src, alt, title), while mistune 3 calls
+        it as image(alt, url=src, title=title).
+
         Arguments:
             src {str} -- The path to the image
+            alt {str} -- The alt text for the image
             title {str} -- The title attribute for the image
-            alt_text {str} -- The alt text for the image
+            url {str} -- The path to the image, as given by mistune 3
 
         Returns:
             str -- The constructed XHTML tag
         """
-        # Check if the image is externally hosted, or hosted as a static
-        # file within Journal
-        is_external = bool(urlparse(src).netloc)
-        tag_template = '<ac:image>{image_tag}</ac:image>'
-        image_tag = '<ri:url ri:value="{}" />'.format(src)
-        if not is_external:
-            image_tag = '<ri:attachment ri:filename="{}" />'.format(
-                os.path.basename(src))
-            self.attachments.append(src)
-        return tag_template.format(image_tag=image_tag)
+        if url is not None:
+            src = url
+        return render_image(src, self.attachments)
+
+
+def render_code(code, info=None):
+    """Renders a code block into a Confluence code macro.
+
+    Arguments:
+        code {str} -- The code
+        info {str} -- The info string of the code fence, which starts with
+            the language of the code
+
+    Returns:
+        str -- The constructed XHTML
+    """
+    # The info string can hold more than the language (e.g. "python
+    # title=example.py"), but only the language is used
+    lang = info.split()[0] if info and info.strip() else ''
+    return textwrap.dedent('''\
+        <ac:structured-macro ac:name="code" ac:schema-version="1">
+            <ac:parameter ac:name="language">{l}</ac:parameter>
+            <ac:plain-text-body><![CDATA[{c}]]></ac:plain-text-body>
+        </ac:structured-macro>
+    ''').format(c=code.rstrip('\n'), l=lang)
+
+
+def render_image(src, attachments):
+    """Renders an image into XHTML expected by Confluence.
+
+    Arguments:
+        src {str} -- The path to the image
+        attachments {list(str)} -- The attachments of the document, which
+            the image is added to if it's hosted as a static file
+
+    Returns:
+        str -- The constructed XHTML tag
+    """
+    # Check if the image is externally hosted, or hosted as a static
+    # file within Journal
+    is_external = bool(urlparse(src).netloc)
+    tag_template = '<ac:image>{image_tag}</ac:image>'
+    image_tag = '<ri:url ri:value="{}" />'.format(src)
+    if not is_external:
+        image_tag = '<ri:attachment ri:filename="{}" />'.format(
+            os.path.basename(src))
+        attachments.append(src)
+    return tag_template.format(image_tag=image_tag)
+
+
+class MistuneEngine():
+    """Converts Markdown with mistune and the ConfluenceRenderer."""
+
+    @staticmethod
+    def available():
+        return True
+
+    @staticmethod
+    def version():
+        return getattr(mistune, '__version__', '')
+
+    def __init__(self):
+        self.renderer = ConfluenceRenderer()
+        self.parser = mistune.create_markdown(renderer=self.renderer,
+                                              plugins=PLUGINS)
+
+    def render(self, markdown):
+        """Renders Markdown content into Confluence storage format.
+
+        Arguments:
+            markdown {str} -- The Markdown content
+
+        Returns:
+            tuple(str, bool, list(str)) -- The content HTML, whether a TOC
+                should be rendered, and the paths of the referenced
+                attachments
+        """
+        self.renderer.reset()
+        content_html = self.parser(markdown)
+        return content_html, self.renderer.has_toc, self.renderer.attachments
+
+
+class MarkdownItEngine():
+    """Converts Markdown with markdown-it-py, emitting the same Confluence
+    macros as the ConfluenceRenderer.
+
+    markdown-it-py follows CommonMark more strictly than mistune. Bare URLs
+    aren't turned into links, since that needs the linkify-it-py package as
+    well.
+    """
+
+    @staticmethod
+    def available():
+        return MarkdownIt is not None
+
+    @staticmethod
+    def version():
+        return markdown_it.__version__
+
+    def __init__(self):
+        self.parser = MarkdownIt('commonmark', {'html': True})
+        self.parser.enable(['table', 'strikethrough'])
+        self.parser.add_render_rule('fence', self._fence)
+        self.parser.add_render_rule('code_block', self._code_block)
+        self.parser.add_render_rule('image', self._image)
+        self.parser.add_render_rule('heading_open', self._heading_open)
+
+    @staticmethod
+    def _fence(renderer, tokens, idx, options, env):
+        token = tokens[idx]
+        return render_code(token.content, token.info)
+
+    @staticmethod
+    def _code_block(renderer, tokens, idx, options, env):
+        return render_code(tokens[idx].content)
+
+    @staticmethod
+    def _image(renderer, tokens, idx, options, env):
+        return render_image(tokens[idx].attrGet('src'), env['attachments'])
+
+    @staticmethod
+    def _heading_open(renderer, tokens, idx, options, env):
+        env['has_toc'] = True
+        return renderer.renderToken(tokens, idx, options, env)
+
+    def render(self, markdown):
+        """Renders Markdown content into Confluence storage format.
+
+        Arguments:
+            markdown {str} -- The Markdown content
+
+        Returns:
+            tuple(str, bool, list(str)) -- The content HTML, whether a TOC
+                should be rendered, and the paths of the referenced
+                attachments
+        """
+        # The state of each document is kept in its env, so the parser can
+        # be reused as is
+        env = {'attachments': [], 'has_toc': False}
+        content_html = self.parser.render(markdown, env)
+        return content_html, env['has_toc'], env['attachments']
+
+
+# The Markdown engines, by name
+ENGINES = {
+    MISTUNE: MistuneEngine,
+    MARKDOWN_IT: MarkdownItEngine,
+}
@@ -0,0 +1,220 @@
+"""Indexes the front matter of every post in a repo.
+
+The index records where each post would be deployed, and whether it is
+shared at all, so that questions like "which posts are shared?" can be
+answered without opening and parsing every post. It is kept up to date
+incrementally: a post is only parsed again when its size and modification
+time, or its git blob SHA, have changed.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from convert import parse_front_matter
+from sources import FILE_SOURCE
+
+# The version of the index file format
+INDEX_FORMAT = 1
+
+log = logging.getLogger(__name__)
+
+
+def get_slug(filepath, prefix=''):
+    """Returns the slug for a given filepath
+
+    Arguments:
+        filepath {str} -- The filepath for the post
+        prefix {str} -- Any prefixes to the slug
+    """
+    slug, _ = os.path.splitext(os.path.basename(filepath))
+    # Confluence doesn't support searching for labels with a "-",
+    # so we need to adjust it.
+    slug = slug.replace('-', '_')
+    if prefix:
+        slug = '{}_{}'.format(prefix, slug)
+    return slug
+
+
+def post_slug(post_path, front_matter):
+    """Returns the slug for a post, which is prefixed with its authors.
+
+    Arguments:
+        post_path {str} -- The path of the post
+        front_matter {dict} -- The post front matter
+    """
+    authors = front_matter.get('authors', [])
+    slug_prefix = '_'.join(author.lower() for author in authors)
+    return get_slug(post_path, prefix=slug_prefix)
+
+
+def summarize_post(post_path, front_matter):
+    """Returns the index entry for a post's front matter.
+
+    Arguments:
+        post_path {str} -- The path of the post
+        front_matter {dict} -- The post front matter
+    """
+    front_matter = front_matter or {}
+    wiki = front_matter.get('wiki') or {}
+    return {
+        'share': bool(wiki.get('share')),
+        'slug': post_slug(post_path, front_matter),
+        'title': front_matter.get('title'),
+        'authors': front_matter.get('authors', []),
+        'tags': front_matter.get('tags', []),
+        'space': wiki.get('space'),
+        'ancestor_id': wiki.get('ancestor_id'),
+    }
+
+
+class PostIndex():
+    def __init__(self, path=None, root=None, source=None):
+        """Creates a new post index, loading the index left by the last run
+        if there is one.
+
+        Arguments:
+            path {str} -- The path to the JSON file the index is kept in
+                (default: don't persist the index)
+            root {str} -- The root of the Git repo, which posts are given
+                relative to
+            source {sources.FileSource} -- The source posts are read from
+                (default: the filesystem)
+        """
+        self.path = path
+        self.root = root or ''
+        self.source = source or FILE_SOURCE
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._posts = self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable post index {}: {}'.format(
+                self.path, e))
+            return {}
+        if index.get('format') != INDEX_FORMAT:
+            log.warning('Ignoring post index {} from another version'.format(
+                self.path))
+            return {}
+        return index.get('posts', {})
+
+    def save(self):
+        """Writes the index to its file, if one is set."""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {'format': INDEX_FORMAT, 'posts': dict(self._posts)}
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that an interrupted run never
+        # leaves a truncated index behind.
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, post):
+        """Returns the index entry for a post, or None if it isn't indexed.
+
+        Arguments:
+            post {str} -- The path of the post, relative to the repo root
+        """
+        with self._lock:
+            return self._posts.get(post)
+
+    def shared(self):
+        """Returns the paths of the indexed posts which are shared to
+        Confluence, relative to the repo root, in sorted order."""
+        with self._lock:
+            return sorted(post for post, entry in self._posts.items()
+                          if entry['share'])
+
+    def collisions(self):
+        """Returns the slugs which more than one shared post would be
+        deployed as, since only one of them can have a page.
+
+        Returns:
+            dict -- The paths of the posts sharing each slug, by slug
+        """
+        slugs = {}
+        with self._lock:
+            for post, entry in sorted(self._posts.items()):
+                if entry['share']:
+                    slugs.setdefault(entry['slug'], []).append(post)
+        return {
+            slug: posts
+            for slug, posts in slugs.items() if len(posts) > 1
+        }
+
+    def update(self, posts, blobs=None):
+        """Brings the index up to date with the given posts, which are all
+        the posts in the repo. Posts which are no longer given are dropped.
+
+        If git blob SHAs are given, a post is re-indexed when its SHA has
+        changed. Otherwise, it is re-indexed when its size or modification
+        time has.
+
+        Arguments:
+            posts {list(str)} -- The paths of the posts, relative to the repo
+                root
+            blobs {dict} -- The git blob SHA of each post, by its path
+
+        Returns:
+            int -- The number of posts which were (re-)indexed
+        """
+        indexed = 0
+        posts = set(posts)
+        for post in sorted(posts):
+            post_path = os.path.join(self.root, post)
+            stat = {'mtime': None, 'size': None}
+            if blobs is None and os.path.isfile(post_path):
+                info = os.stat(post_path)
+                stat = {'mtime': info.st_mtime, 'size': info.st_size}
+
+            entry = self.get(post)
+            if entry is not None:
+                if blobs is not None:
+                    if entry['blob'] == blobs.get(post):
+                        continue
+                elif (stat['mtime'] is not None and
+                      entry['mtime'] == stat['mtime'] and
+                      entry['size'] == stat['size']):
+                    continue
+
+            entry = self._index(post, post_path, blobs)
+            entry.update(stat)
+            with self._lock:
+                self._posts[post] = entry
+                self._dirty = True
+            indexed += 1
+
+        with self._lock:
+            for post in list(self._posts):
+                if post not in posts:
+                    del self._posts[post]
+                    self._dirty = True
+        return indexed
+
+    def _index(self, post, post_path, blobs):
+        try:
+            blob = (blobs or {}).get(post) or self.source.blob_sha(post_path)
+            front_matter, _ = parse_front_matter(post_path,
+                                                 source=self.source)
+        except Exception as e:
+            # The post will be indexed again once it changes
+            log.warning('Unable to index {}: {}'.format(post, e))
+            return dict(summarize_post(post_path, {}),
+                        blob=(blobs or {}).get(post),
+                        error=str(e))
+        return dict(summarize_post(post_path, front_matter), blob=blob)
@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import functools
 import logging
 import os
 import requests
 import git
 import sys
 
-from confluence import Confluence
-from convert import convtoconf, parse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from async_confluence import AsyncConfluence, DEFAULT_CONCURRENCY, aiohttp
+from authors import AuthorResolver, DEFAULT_AUTHOR_TTL
+from confluence import (AttachmentUploadException, Confluence,
+                        DEFAULT_ATTACHMENT_JOBS, DEFAULT_CONNECT_TIMEOUT,
+                        DEFAULT_POOL_SIZE, DEFAULT_READ_TIMEOUT,
+                        RequestFailedException, page_parts,
+                        parts_fingerprint, stored_fingerprint)
+from convert import (DEFAULT_ENGINE, ENGINES, RENDER_VERSION,
+                     available_engines, convtoconf, parse_front_matter,
+                     render_content, render_layout)
+from index import PostIndex, post_slug
+from pipeline import DEFAULT_MAX_PENDING, run_pipeline
+from render_cache import DEFAULT_RENDER_CACHE_SIZE, RenderCache
+from sources import FILE_SOURCE, GitSource
+from state import DeployState
+from throttle import DEFAULT_RETRIES, READ, UPLOAD, WRITE, RetryPolicy
 """Deploys Markdown posts to Confluenceo
 
 This script is meant to be executed as either part of a CI/CD job or on an
@@ -17,8 +36,29 @@ adhoc basis.
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# When deploying with multiple workers, we include the worker name in each
+# log line so that the interleaved output can still be followed.
+THREADED_LOG_FORMAT = '%(asctime)s [%(threadName)s] %(message)s'
+
 SUPPORTED_FORMATS = ['.md']
 
+STATUS_CREATED = 'created'
+STATUS_UPDATED = 'updated'
+STATUS_SKIPPED = 'skipped'
+STATUS_UNCHANGED = 'unchanged'
+STATUS_FAILED = 'failed'
+
+# The directories in the Git repo which contain the posts, and the files
+# they reference
+CONTENT_DIR = 'content/'
+STATIC_DIR = 'static/'
+
+# Responses to a version-checked update which mean the page recorded in the
+# deploy state is stale: it was changed in Confluence, or deleted
+STALE_PAGE_STATUSES = [404, 409]
+
+DeployResult = namedtuple('DeployResult', ['post', 'status', 'error'])
+
 
 def get_environ_headers(prefix):
     """Returns a list of headers read from environment variables whose key
@@ -39,33 +79,110 @@ def get_environ_headers(prefix):
     return headers
 
 
-def get_last_modified(repo):
-    """Returns the paths to the last modified files in the provided Git repo
-    
+def get_all_posts(repo, rev='HEAD'):
+    """Returns the paths to every file in the content directory of the
+    provided Git repo
+
     Arguments:
         repo {git.Repo} -- The repository object
+        rev {str} -- The commit to list the files of
     """
-    changed_files = repo.git.diff('HEAD~1..HEAD', name_only=True).split()
-    for filepath in changed_files:
-        if not filepath.startswith('content/'):
-            changed_files.remove(filepath)
-    return changed_files
+    files = repo.git.ls_tree(rev, CONTENT_DIR, r=True, name_only=True, z=True)
+    return [filepath for filepath in files.split('\0') if filepath]
 
 
-def get_slug(filepath, prefix=''):
-    """Returns the slug for a given filepath
-    
+def get_blob_shas(repo, rev='HEAD'):
+    """Returns the blob SHA of every post and static file in the provided
+    Git repo, as recorded by git, without reading any of the files
+
     Arguments:
-        filepath {str} -- The filepath for the post
-        prefix {str} -- Any prefixes to the slug
+        repo {git.Repo} -- The repository object
+        rev {str} -- The commit to list the files of
+
+    Returns:
+        dict -- The blob SHA of each file, by its path
+    """
+    blobs = {}
+    tree = repo.git.ls_tree(rev, CONTENT_DIR, STATIC_DIR, r=True, z=True)
+    for line in tree.split('\0'):
+        if not line:
+            continue
+        info, filepath = line.split('\t', 1)
+        _, object_type, sha = info.split()
+        if object_type == 'blob':
+            blobs[filepath] = sha
+    return blobs
+
+
+def skip_unchanged(repo, posts, args, state):
+    """Splits the provided posts into those which need to be deployed, and
+    those which git shows are unchanged since they were last deployed.
+
+    Arguments:
+        repo {git.Repo} -- The repository object
+        posts {list(str)} -- The paths of the posts, relative to the repo
+        args {argparse.Arguments} -- The parsed command-line arguments
+        state {state.DeployState} -- The deploy state
+
+    Returns:
+        tuple(list(str), list(str)) -- The posts to deploy, and the posts
+            which are unchanged
     """
-    slug, _ = os.path.splitext(os.path.basename(filepath))
-    # Confluence doesn't support searching for labels with a "-",
-    # so we need to adjust it.
-    slug = slug.replace('-', '_')
-    if prefix:
-        slug = '{}_{}'.format(prefix, slug)
-    return slug
+    blobs = get_blob_shas(repo, rev=args.rev or 'HEAD')
+    options = deploy_options(args)
+    changed = []
+    unchanged = []
+    for post in posts:
+        if state.unchanged_blobs(post, blobs, options):
+            unchanged.append(post)
+        else:
+            changed.append(post)
+    return changed, unchanged
+
+
+def get_last_modified(repo, since=None, rev='HEAD'):
+    """Returns the paths to the files in the provided Git repo which were
+    added or modified since the given commit
+
+    Renamed files are returned under their new name, and deleted files
+    aren't returned. If the given commit isn't in the repo any more (e.g.
+    after a force-push), every file is returned.
+
+    Arguments:
+        repo {git.Repo} -- The repository object
+        since {str} -- The SHA of the last deployed commit (default: the
+            parent of rev)
+        rev {str} -- The commit being deployed
+    """
+    if since is None:
+        if not repo.commit(rev).parents:
+            return get_all_posts(repo, rev=rev)
+        since = '{}~1'.format(rev)
+    else:
+        try:
+            repo.git.cat_file('-e', '{}^{{commit}}'.format(since))
+        except git.exc.GitCommandError:
+            log.warning('Last deployed commit {} not found, deploying every '
+                        'post'.format(since))
+            return get_all_posts(repo, rev=rev)
+        if not repo.is_ancestor(since, rev):
+            # The history was rewritten, but comparing the trees still gives
+            # us every post which differs from what was deployed.
+            log.warning('Last deployed commit {} is not an ancestor of {}, '
+                        'comparing the two directly'.format(since, rev))
+
+    # Comparing the two trees (rather than walking the commits between them)
+    # lists each changed post once, however many commits or merges touched
+    # it.
+    changed_files = repo.git.diff(since,
+                                  rev,
+                                  '--',
+                                  CONTENT_DIR,
+                                  name_only=True,
+                                  find_renames=True,
+                                  diff_filter='ACMR',
+                                  z=True)
+    return [filepath for filepath in changed_files.split('\0') if filepath]
 
 
 def parse_args():
@@ -135,6 +252,192 @@ def parse_args():
         help=
         'Print requests that would be sent- don\'t actually make requests against Confluence (note: we return empty responses, so this might impact accuracy)'
     )
+    parser.add_argument(
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=int(os.getenv('CONFLUENCE_JOBS', 1)),
+        help=
+        'The number of posts to deploy concurrently (default: env(\'CONFLUENCE_JOBS\') or 1)'
+    )
+    parser.add_argument(
+        '--convert-jobs',
+        dest='convert_jobs',
+        type=int,
+        default=0,
+        help=
+        'Convert posts in this many worker processes, streaming them to the --jobs upload workers as they are ready (default: convert inline)'
+    )
+    parser.add_argument(
+        '--max-pending',
+        dest='max_pending',
+        type=int,
+        default=DEFAULT_MAX_PENDING,
+        help=
+        'The maximum number of converted posts waiting to be uploaded when using --convert-jobs (default: {})'
+        .format(DEFAULT_MAX_PENDING))
+    parser.add_argument(
+        '--attachment-jobs',
+        dest='attachment_jobs',
+        type=int,
+        default=DEFAULT_ATTACHMENT_JOBS,
+        help=
+        'The number of attachments to upload concurrently for each post (default: {})'
+        .format(DEFAULT_ATTACHMENT_JOBS))
+    parser.add_argument(
+        '--read-rate',
+        dest='read_rate',
+        type=float,
+        default=os.getenv('CONFLUENCE_READ_RATE'),
+        help=
+        'The maximum number of read (GET) requests per second to send to Confluence (default: env(\'CONFLUENCE_READ_RATE\') or unlimited)'
+    )
+    parser.add_argument(
+        '--write-rate',
+        dest='write_rate',
+        type=float,
+        default=os.getenv('CONFLUENCE_WRITE_RATE'),
+        help=
+        'The maximum number of write (POST/PUT) requests per second to send to Confluence (default: env(\'CONFLUENCE_WRITE_RATE\') or unlimited)'
+    )
+    parser.add_argument(
+        '--upload-rate',
+        dest='upload_rate',
+        type=float,
+        default=os.getenv('CONFLUENCE_UPLOAD_RATE'),
+        help=
+        'The maximum number of attachment uploads per second to send to Confluence (default: env(\'CONFLUENCE_UPLOAD_RATE\') or unlimited)'
+    )
+    parser.add_argument(
+        '--adaptive-concurrency',
+        dest='max_concurrency',
+        type=int,
+        default=os.getenv('CONFLUENCE_ADAPTIVE_CONCURRENCY'),
+        help=
+        'Adapt the number of concurrent requests to how Confluence is responding, up to this maximum (default: env(\'CONFLUENCE_ADAPTIVE_CONCURRENCY\') or disabled)'
+    )
+    parser.add_argument(
+        '--retries',
+        dest='retries',
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=
+        'The number of times to retry a request which failed for a transient reason, such as a timeout or a 503 (default: {})'
+        .format(DEFAULT_RETRIES))
+    parser.add_argument(
+        '--pool-size',
+        dest='pool_size',
+        type=int,
+        default=None,
+        help=
+        'The number of HTTP connections to keep open to Confluence (default: enough for --jobs and --attachment-jobs, and at least {})'
+        .format(DEFAULT_POOL_SIZE))
+    parser.add_argument(
+        '--pool-block',
+        dest='pool_block',
+        action='store_true',
+        help=
+        'When every pooled connection is in use, wait for one to be free rather than opening an extra connection'
+    )
+    parser.add_argument(
+        '--prewarm',
+        dest='prewarm',
+        action='store_true',
+        help=
+        'Open the pooled connections to Confluence while the first posts are being converted'
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        dest='connect_timeout',
+        type=float,
+        default=DEFAULT_CONNECT_TIMEOUT,
+        help=
+        'The number of seconds to wait when connecting to Confluence (default: {})'
+        .format(DEFAULT_CONNECT_TIMEOUT))
+    parser.add_argument(
+        '--read-timeout',
+        dest='read_timeout',
+        type=float,
+        default=DEFAULT_READ_TIMEOUT,
+        help=
+        'The number of seconds to wait between bytes of a response from Confluence (default: {})'
+        .format(DEFAULT_READ_TIMEOUT))
+    parser.add_argument(
+        '--cache-dir',
+        dest='cache_dir',
+        default=os.getenv('CONFLUENCE_CACHE_DIR'),
+        help=
+        'A directory used to cache data (such as author lookups) between runs (default: env(\'CONFLUENCE_CACHE_DIR\') or no cache)'
+    )
+    parser.add_argument(
+        '--author-ttl',
+        dest='author_ttl',
+        type=int,
+        default=DEFAULT_AUTHOR_TTL,
+        help=
+        'The number of seconds to cache Confluence user keys for in --cache-dir (default: {})'
+        .format(DEFAULT_AUTHOR_TTL))
+    parser.add_argument(
+        '--render-cache-mb',
+        dest='render_cache_mb',
+        type=int,
+        default=DEFAULT_RENDER_CACHE_SIZE // (1024 * 1024),
+        help=
+        'The maximum size of the converted posts cached in --cache-dir, in MiB. The least recently used posts are evicted first. (default: {})'
+        .format(DEFAULT_RENDER_CACHE_SIZE // (1024 * 1024)))
+    parser.add_argument(
+        '--rev',
+        dest='rev',
+        default=None,
+        help=
+        'Deploy the posts as of this commit, reading them and their static files from the Git objects rather than the working tree. This works with bare repos. (default: the working tree and HEAD)'
+    )
+    parser.add_argument(
+        '--full-sync',
+        dest='full_sync',
+        action='store_true',
+        default=False,
+        help=
+        'Deploy every post in the repo, rather than just the posts changed since the last deploy. With --state-dir, posts which git shows are unchanged are skipped without being read.'
+    )
+    parser.add_argument(
+        '--from-index',
+        dest='from_index',
+        action='store_true',
+        default=False,
+        help=
+        'Only consider the posts which the front matter index shows are shared. The index is kept in --cache-dir (which is required), and only posts which changed since it was last updated are parsed.'
+    )
+    parser.add_argument(
+        '--state-dir',
+        dest='state_dir',
+        default=os.getenv('CONFLUENCE_STATE_DIR'),
+        help=
+        'A directory used to record the last deployed commit and what was deployed for each post, so that each run deploys the posts changed since the last successful run and skips unchanged posts without contacting Confluence (default: env(\'CONFLUENCE_STATE_DIR\') or no state)'
+    )
+    parser.add_argument(
+        '--engine',
+        dest='engine',
+        choices=sorted(ENGINES),
+        default=os.getenv('CONFLUENCE_ENGINE', DEFAULT_ENGINE),
+        help=
+        'The Markdown engine used to convert posts. The markdown-it engine requires the optional markdown-it-py package. (default: env(\'CONFLUENCE_ENGINE\') or {})'
+        .format(DEFAULT_ENGINE))
+    parser.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help=
+        'Deploy every post concurrently from a single thread using the asyncio Confluence client (requires aiohttp). --concurrency is used instead of --jobs, and --state-dir, --convert-jobs, --adaptive-concurrency, --retries, --pool-size, --pool-block and --prewarm aren\'t supported.'
+    )
+    parser.add_argument(
+        '--concurrency',
+        dest='concurrency',
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=
+        'The maximum number of in-flight Confluence requests when using --async (default: {})'
+        .format(DEFAULT_CONCURRENCY))
     parser.add_argument(
         'posts',
         type=str,
@@ -149,94 +452,820 @@ def parse_args():
         log.error('Please provide a valid API URL')
         sys.exit(1)
 
+    if args.jobs < 1:
+        log.error('Please provide a --jobs value of at least 1')
+        sys.exit(1)
+
+    if args.engine not in available_engines():
+        log.error('The {} engine is not installed'.format(args.engine))
+        sys.exit(1)
+
+    if args.from_index and args.posts:
+        log.error('--from-index can\'t be used with individual posts')
+        sys.exit(1)
+
+    if args.from_index and not args.cache_dir:
+        log.error('--from-index requires --cache-dir to keep the index in')
+        sys.exit(1)
+
+    if args.use_async and aiohttp is None:
+        log.error('--async requires the aiohttp package')
+        sys.exit(1)
+
+    if args.use_async:
+        # The asyncio client doesn't record the deploy state, or support
+        # the options of the threaded client, so we don't let them be
+        # silently ignored
+        unsupported = [
+            option for option, value in [
+                ('--state-dir', args.state_dir),
+                ('--convert-jobs', args.convert_jobs),
+                ('--adaptive-concurrency', args.max_concurrency),
+                ('--retries', args.retries != DEFAULT_RETRIES),
+                ('--pool-size', args.pool_size),
+                ('--pool-block', args.pool_block),
+                ('--prewarm', args.prewarm),
+            ] if value
+        ]
+        if unsupported:
+            log.error('--async can\'t be used with {}'.format(
+                ', '.join(unsupported)))
+            sys.exit(1)
+
+    if args.rev and (args.use_async or args.posts):
+        log.error('--rev can\'t be used with --async or individual posts')
+        sys.exit(1)
+
     return parser.parse_args()
 
 
-def deploy_file(post_path, args, confluence):
-    """Creates or updates a file in Confluence
-    
+def get_cache_path(args, name):
+    """Returns the path to a file in the cache directory, or None if caching
+    is disabled.
+
     Arguments:
-        post_path {str} -- The absolute path of the post to deploy to Confluence
         args {argparse.Arguments} -- The parsed command-line arguments
-        confluence {confluence.Confluence} -- The Confluence API client
+        name {str} -- The name of the cache file
+    """
+    if not args.cache_dir:
+        return None
+    return os.path.join(args.cache_dir, name)
+
+
+# The render caches opened by this process, by directory
+_render_caches = {}
+
+
+def get_render_cache(cache_dir, max_mb=None):
+    """Returns the cache of converted posts in the cache directory, or None
+    if caching is disabled. Each process opens the cache once, and shares it
+    between its threads.
+
+    Arguments:
+        cache_dir {str} -- The cache directory
+        max_mb {int} -- The maximum size of the cache, in MiB
     """
+    if not cache_dir:
+        return None
+    directory = os.path.join(cache_dir, 'render')
+    if directory not in _render_caches:
+        max_size = DEFAULT_RENDER_CACHE_SIZE
+        if max_mb is not None:
+            max_size = max_mb * 1024 * 1024
+        _render_caches[directory] = RenderCache(directory, max_size=max_size)
+    return _render_caches[directory]
+
+
+def get_state_path(args):
+    """Returns the path to the deploy state file, or None if the deploy
+    state is disabled.
+
+    Arguments:
+        args {argparse.Arguments} -- The parsed command-line arguments
+    """
+    if not args.state_dir:
+        return None
+    return os.path.join(args.state_dir, 'state.json')
+
+
+def update_index(repo, args, source=None):
+    """Brings the front matter index for the repo up to date, and returns
+    it.
+
+    When deploying from the working tree, posts are re-indexed when their
+    size or modification time changes. With --rev, they're re-indexed when
+    their blob SHA does.
+
+    Arguments:
+        repo {git.Repo} -- The repository object
+        args {argparse.Arguments} -- The parsed command-line arguments
+        source {sources.FileSource} -- The source to read posts from
+            (default: the filesystem)
+    """
+    index = PostIndex(get_cache_path(args, 'index.json'),
+                      root=args.git,
+                      source=source)
+    rev = args.rev or 'HEAD'
+    posts = [
+        post for post in get_all_posts(repo, rev=rev)
+        if os.path.splitext(post)[1] in SUPPORTED_FORMATS
+    ]
+    blobs = get_blob_shas(repo, rev=rev) if args.rev else None
+    indexed = index.update(posts, blobs=blobs)
+    log.info('Indexed {} of {} posts'.format(indexed, len(posts)))
+    for slug, posts in index.collisions().items():
+        log.warning('Posts {} would all be deployed as {}'.format(
+            ', '.join(posts), slug))
+    index.save()
+    return index
+
+
+def deploy_options(args):
+    """Returns the command-line options which change how a post is
+    deployed.
+
+    This includes the default space and ancestor, since posts which don't
+    set their own are deployed there, and the post itself doesn't show it.
+    It also includes the Markdown engine and the renderer version, since
+    they change the page a post is rendered to.
+
+    Arguments:
+        args {argparse.Arguments} -- The parsed command-line arguments
+    """
+    return {
+        'global_label': args.global_label,
+        'space': args.space,
+        'ancestor_id': args.ancestor_id,
+        'engine': args.engine,
+        'render_version': RENDER_VERSION,
+    }
+
+
+def client_options(args):
+    """Returns the keyword arguments used to create a Confluence client.
+
+    Arguments:
+        args {argparse.Arguments} -- The parsed command-line arguments
+    """
+    return {
+        'api_url': args.api_url,
+        'username': args.username,
+        'password': args.password,
+        'headers': args.headers,
+        'dry_run': args.dry_run,
+        'attachment_jobs': args.attachment_jobs,
+        'rate_limits': {
+            READ: args.read_rate,
+            WRITE: args.write_rate,
+            UPLOAD: args.upload_rate,
+        },
+        'connect_timeout': args.connect_timeout,
+        'read_timeout': args.read_timeout,
+    }
+
+
+def sync_client_options(args):
+    """Returns the keyword arguments used to create the (threaded)
+    Confluence client, which supports some options the asyncio client
+    doesn't.
+
+    Arguments:
+        args {argparse.Arguments} -- The parsed command-line arguments
+    """
+    options = client_options(args)
+    options['max_concurrency'] = args.max_concurrency
+    options['retry_policy'] = RetryPolicy(retries=args.retries)
+    options['pool_size'] = args.pool_size or max(
+        DEFAULT_POOL_SIZE, args.jobs * args.attachment_jobs)
+    options['pool_block'] = args.pool_block
+    return options
+
+
+def get_source(args, repo=None):
+    """Returns the source posts and static files are read from.
+
+    Arguments:
+        args {argparse.Arguments} -- The parsed command-line arguments
+        repo {git.Repo} -- The repository object, if already open
+    """
+    if not args.rev:
+        return FILE_SOURCE
+    return GitSource(repo or git.Repo(args.git), args.git, rev=args.rev)
+
 
+def read_post(post_path, source=None):
+    """Reads the front matter for a post, returning None if the post
+    shouldn't be deployed to Confluence.
+
+    The body of the post is only read once it is needed, so posts on disk
+    which aren't shared are never read past their front matter. With --rev,
+    each post is read from its Git object once, whole, and the body is kept
+    from that read.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        source {sources.FileSource} -- The source to read the post from
+            (default: the filesystem)
+
+    Returns:
+        tuple(dict, convert.PostBody) -- The front matter, and a handle to
+            the Markdown body
+    """
     _, ext = os.path.splitext(post_path)
     if ext not in SUPPORTED_FORMATS:
         log.info('Skipping {} since it\'s not a supported format.'.format(
             post_path))
-        return
+        return None
 
     try:
-        front_matter, markdown = parse(post_path)
+        front_matter, body = parse_front_matter(post_path, source=source)
     except Exception as e:
         log.error(
             'Unable to process {}. Normally not a problem, but here\'s the error we received: {}'
             .format(post_path, e))
-        return
+        return None
 
-    if 'wiki' not in front_matter or not front_matter['wiki'].get('share'):
+    if not front_matter or 'wiki' not in front_matter or not front_matter[
+            'wiki'].get('share'):
         log.info(
             'Post {} not set to be uploaded to Confluence'.format(post_path))
-        return
+        return None
 
-    front_matter['author_keys'] = []
-    authors = front_matter.get('authors', [])
-    for author in authors:
-        confluence_author = confluence.get_author(author)
-        if not confluence_author:
-            continue
-        front_matter['author_keys'].append(confluence_author['userKey'])
+    return front_matter, body
+
+
+def render_post(post_path, args, front_matter, markdown, author_keys):
+    """Converts a post into the arguments used to create or update its
+    Confluence page.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        args {argparse.Arguments} -- The parsed command-line arguments
+        front_matter {dict} -- The post front matter
+        markdown {str} -- The post content
+        author_keys {list(str)} -- The Confluence user keys for the authors
+
+    Returns:
+        dict -- The keyword arguments for Confluence.create/update
+    """
+    front_matter['author_keys'] = author_keys
 
     # Normalize the content into whatever format Confluence expects
-    html, attachments = convtoconf(markdown, front_matter=front_matter)
+    html, attachments = convtoconf(markdown,
+                                   front_matter=front_matter,
+                                   engine=args.engine,
+                                   cache=get_render_cache(
+                                       args.cache_dir, args.render_cache_mb))
+    return page_args(post_path, args, front_matter, html, attachments)
 
-    static_path = os.path.join(args.git, 'static')
-    for i, attachment in enumerate(attachments):
-        attachments[i] = os.path.join(static_path, attachment.lstrip('/'))
 
-    slug_prefix = '_'.join(author.lower() for author in authors)
-    post_slug = get_slug(post_path, prefix=slug_prefix)
+def get_target(post_path, args, front_matter):
+    """Returns where a post should be deployed in Confluence.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        args {argparse.Arguments} -- The parsed command-line arguments
+        front_matter {dict} -- The post front matter
 
+    Returns:
+        tuple(str, str, str) -- The page slug, space and ancestor ID
+    """
+    slug = post_slug(post_path, front_matter)
     ancestor_id = front_matter['wiki'].get('ancestor_id', args.ancestor_id)
     space = front_matter['wiki'].get('space', args.space)
+    return slug, space, ancestor_id
+
+
+def prefetch(posts, args, confluence, resolver, state=None):
+    """Looks up the existing Confluence pages and the authors for all of the
+    posts up front. The pages are found with a handful of batched searches,
+    and each unique author is only looked up once.
+
+    Posts which are recorded in the deploy state don't need to be looked up.
+
+    Arguments:
+        posts {list(str)} -- The absolute paths of the posts to deploy
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {confluence.Confluence} -- The Confluence API client
+        resolver {authors.AuthorResolver} -- The author resolver
+        state {state.DeployState} -- The deploy state (default: none)
+    """
+    targets = {}
+    authors = set()
+    for post_path in posts:
+        post = read_post(post_path, confluence.source)
+        if post is None:
+            continue
+        front_matter, _ = post
+        slug, space, ancestor_id = get_target(post_path, args, front_matter)
+        if state is not None and state.get(slug, space, ancestor_id):
+            continue
+        targets.setdefault((space, ancestor_id), []).append(slug)
+        authors.update(front_matter.get('authors', []))
+
+    resolver.resolve(authors)
+
+    for (space, ancestor_id), slugs in targets.items():
+        try:
+            pages = confluence.exists_many(space=space,
+                                           slugs=slugs,
+                                           ancestor_id=ancestor_id)
+        except (RequestFailedException,
+                requests.exceptions.RequestException) as e:
+            # Each post will just look up its own page instead
+            log.warning('Unable to look up pages under {}: {}'.format(
+                ancestor_id or space, e))
+            continue
+        log.info('Found {} of {} pages under {}'.format(
+            sum(1 for page in pages.values() if page), len(pages),
+            ancestor_id or space))
+
+
+def page_args(post_path, args, front_matter, html, attachments):
+    """Returns the arguments used to create or update the Confluence page for
+    a converted post.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        args {argparse.Arguments} -- The parsed command-line arguments
+        front_matter {dict} -- The post front matter
+        html {str} -- The post converted to Confluence storage format
+        attachments {list(str)} -- The attachment paths referenced by the post
+
+    Returns:
+        dict -- The keyword arguments for Confluence.create/update
+    """
+    static_path = os.path.join(args.git, STATIC_DIR)
+    for i, attachment in enumerate(attachments):
+        attachments[i] = os.path.join(static_path, attachment.lstrip('/'))
+
+    slug, space, ancestor_id = get_target(post_path, args, front_matter)
 
     tags = front_matter.get('tags', [])
     if args.global_label:
         tags.append(args.global_label)
 
-    page = confluence.exists(slug=post_slug,
-                             ancestor_id=ancestor_id,
-                             space=space)
+    return {
+        'content': html,
+        'title': front_matter['title'],
+        'tags': tags,
+        'slug': slug,
+        'space': space,
+        'ancestor_id': ancestor_id,
+        'attachments': attachments,
+    }
+
+
+def deploy_file(post_path, args, confluence, resolver=None, state=None):
+    """Creates or updates a file in Confluence
+    
+    Arguments:
+        post_path {str} -- The absolute path of the post to deploy to Confluence
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {confluence.Confluence} -- The Confluence API client
+        resolver {authors.AuthorResolver} -- The author resolver shared by
+            the run (default: look up the authors of this post only)
+        state {state.DeployState} -- The deploy state (default: none)
+
+    Returns:
+        str -- The deploy status (one of STATUS_CREATED, STATUS_UPDATED,
+            STATUS_UNCHANGED or STATUS_SKIPPED)
+    """
+    post = read_post(post_path, confluence.source)
+    if post is None:
+        return STATUS_SKIPPED
+    front_matter, body = post
+
+    # Hashing a post from the working tree reads all of it, so it's only
+    # done up front if the state can tell us the post is unchanged. Posts
+    # read from Git objects already have their blob SHA.
+    source = None
+    if state is not None:
+        slug, space, ancestor_id = get_target(post_path, args, front_matter)
+        if state.get(slug, space, ancestor_id) is not None:
+            source = confluence.source.blob_sha(post_path)
+            if state.unchanged(slug, space, ancestor_id, source,
+                               deploy_options(args)):
+                log.info('Post {} is unchanged since it was last deployed, '
+                         'skipping it'.format(post_path))
+                return STATUS_UNCHANGED
+
+    if resolver is None:
+        resolver = AuthorResolver(confluence)
+    author_keys = resolver.author_keys(front_matter.get('authors', []))
+    rendered = render_post(post_path, args, front_matter, body.read(),
+                           author_keys)
+    if source is None and state is not None:
+        source = confluence.source.blob_sha(post_path)
+    return publish_page(rendered,
+                        confluence,
+                        state=state,
+                        source=source,
+                        options=deploy_options(args),
+                        post_path=post_path)
+
+
+def publish_page(rendered,
+                 confluence,
+                 state=None,
+                 source=None,
+                 options=None,
+                 post_path=None):
+    """Creates or updates the Confluence page for a rendered post.
+
+    If the post is recorded in the deploy state, the page is updated without
+    first searching for it, or skipped without contacting Confluence at all
+    if it hasn't changed.
+
+    Arguments:
+        rendered {dict} -- The page arguments returned by render_post
+        confluence {confluence.Confluence} -- The Confluence API client
+        state {state.DeployState} -- The deploy state (default: none)
+        source {str} -- The blob SHA of the post, recorded in the state
+        options {dict} -- The deploy options, recorded in the state
+        post_path {str} -- The path of the post, recorded in the state
+
+    Returns:
+        str -- The deploy status (STATUS_CREATED, STATUS_UPDATED or
+            STATUS_UNCHANGED)
+
+    Raises:
+        confluence.AttachmentUploadException -- If any attachment failed to
+            upload. The page is recorded in the state so that the next run
+            deploys it again.
+    """
+    # The parts include the digest of every attachment, so they're computed
+    # once here and passed on, rather than read again by each step.
+    parts = page_parts(source=confluence.source, **rendered)
+    fingerprint = parts_fingerprint(parts)
+    slug = rendered['slug']
+
+    def record(page):
+        if state is not None:
+            state.record(rendered,
+                         page,
+                         fingerprint,
+                         source=source,
+                         options=options,
+                         post_path=post_path)
+
+    def deploy(send, *args, **kwargs):
+        try:
+            record(send(*args, fingerprint=fingerprint, parts=parts,
+                        **kwargs))
+        except AttachmentUploadException as e:
+            # The rest of the page was deployed, so we record its new
+            # version, but without a fingerprint or source so that it isn't
+            # skipped next time.
+            if state is not None:
+                state.record(rendered,
+                             e.page,
+                             None,
+                             options=options,
+                             post_path=post_path)
+            raise
+
+    entry = None
+    if state is not None:
+        entry = state.get(slug,
+                          space=rendered['space'],
+                          ancestor_id=rendered['ancestor_id'])
+    if entry:
+        if entry['fingerprint'] == fingerprint:
+            log.info('Page {} is unchanged, skipping it'.format(slug))
+            # The source may have changed in a way that doesn't affect the
+            # page (e.g. whitespace), so we still record it.
+            record(state.cached_page(entry))
+            return STATUS_UNCHANGED
+        try:
+            deploy(confluence.update,
+                   entry['page_id'],
+                   page=state.cached_page(entry),
+                   **rendered)
+            return STATUS_UPDATED
+        except RequestFailedException as e:
+            if e.status_code not in STALE_PAGE_STATUSES:
+                raise
+            log.warning('Page {} has changed since it was last deployed, '
+                        'looking it up again'.format(slug))
+            state.forget(slug)
+
+    page = confluence.exists(slug=slug,
+                             ancestor_id=rendered['ancestor_id'],
+                             space=rendered['space'])
     if page:
-        confluence.update(page['id'],
-                          content=html,
-                          title=front_matter['title'],
-                          tags=tags,
-                          slug=post_slug,
-                          space=space,
-                          ancestor_id=ancestor_id,
-                          page=page,
-                          attachments=attachments)
-    else:
-        confluence.create(content=html,
-                          title=front_matter['title'],
-                          tags=tags,
-                          slug=post_slug,
-                          space=space,
-                          ancestor_id=ancestor_id,
-                          attachments=attachments)
+        if stored_fingerprint(page) == fingerprint:
+            log.info('Page {} is unchanged, skipping it'.format(slug))
+            record(page)
+            return STATUS_UNCHANGED
+        deploy(confluence.update, page['id'], page=page, **rendered)
+        return STATUS_UPDATED
+
+    deploy(confluence.create, **rendered)
+    return STATUS_CREATED
+
+
+# The Git sources opened by this (conversion) process, by repo and commit
+_worker_sources = {}
+
+
+def worker_source(root=None, rev=None):
+    """Returns the source a conversion process reads posts from. Each
+    process opens the repo (and its cat-file process) once, and reuses it for
+    every post.
+
+    Arguments:
+        root {str} -- The path to the Git repo
+        rev {str} -- The commit to read posts from (default: read them from
+            the filesystem)
+    """
+    if not rev:
+        return FILE_SOURCE
+    key = (root, rev)
+    if key not in _worker_sources:
+        _worker_sources[key] = GitSource(git.Repo(root), root, rev=rev)
+    return _worker_sources[key]
+
+
+def prepare_post(post_path,
+                 root=None,
+                 rev=None,
+                 engine=DEFAULT_ENGINE,
+                 cache_dir=None,
+                 render_cache_mb=None):
+    """Runs the CPU-bound half of a deploy: parsing the post and rendering
+    its content.
+
+    This runs in the conversion processes of the pipeline, so it must not
+    talk to Confluence.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        root {str} -- The path to the Git repo
+        rev {str} -- The commit to read the post from (default: read it from
+            the filesystem)
+        engine {str} -- The name of the Markdown engine to use
+        cache_dir {str} -- The directory to cache converted posts in
+            (default: don't cache them)
+        render_cache_mb {int} -- The maximum size of the cache, in MiB
+
+    Returns:
+        dict -- The front matter, rendered content and attachments, or None
+            if the post shouldn't be deployed
+    """
+    source = worker_source(root=root, rev=rev)
+    post = read_post(post_path, source)
+    if post is None:
+        return None
+    front_matter, body = post
+
+    content_html, has_toc, attachments = render_content(
+        body.read(),
+        engine=engine,
+        cache=get_render_cache(cache_dir, render_cache_mb))
+    return {
+        'source': source.blob_sha(post_path),
+        'front_matter': front_matter,
+        'content': content_html,
+        'has_toc': has_toc,
+        'attachments': attachments,
+    }
+
+
+def deploy_prepared(post_path,
+                    prepared,
+                    args,
+                    confluence,
+                    resolver,
+                    state=None):
+    """Runs the network half of a deploy for a post returned by
+    prepare_post.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post
+        prepared {dict} -- The value returned by prepare_post
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {confluence.Confluence} -- The Confluence API client
+        resolver {authors.AuthorResolver} -- The author resolver
+        state {state.DeployState} -- The deploy state (default: none)
+
+    Returns:
+        str -- The deploy status
+    """
+    if prepared is None:
+        return STATUS_SKIPPED
+    front_matter = prepared['front_matter']
+
+    author_keys = resolver.author_keys(front_matter.get('authors', []))
+    html = render_layout(prepared['content'],
+                         has_toc=prepared['has_toc'],
+                         author_keys=author_keys)
+    rendered = page_args(post_path, args, front_matter, html,
+                         prepared['attachments'])
+    return publish_page(rendered,
+                        confluence,
+                        state=state,
+                        source=prepared['source'],
+                        options=deploy_options(args),
+                        post_path=post_path)
+
+
+async def deploy_file_async(post_path, args, confluence):
+    """Creates or updates a file in Confluence using the asyncio client.
+
+    This behaves the same as deploy_file, but allows many posts to be
+    deployed from a single thread.
+
+    Arguments:
+        post_path {str} -- The absolute path of the post to deploy to Confluence
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {async_confluence.AsyncConfluence} -- The Confluence API client
+
+    Returns:
+        str -- The deploy status (one of STATUS_CREATED, STATUS_UPDATED,
+            STATUS_UNCHANGED or STATUS_SKIPPED)
+    """
+    post = read_post(post_path)
+    if post is None:
+        return STATUS_SKIPPED
+    front_matter, body = post
+
+    authors = await asyncio.gather(*(confluence.get_author(author)
+                                     for author in front_matter.get(
+                                         'authors', [])))
+    author_keys = [author['userKey'] for author in authors if author]
+
+    rendered = render_post(post_path, args, front_matter, body.read(),
+                           author_keys)
+    parts = page_parts(**rendered)
+    fingerprint = parts_fingerprint(parts)
+
+    page = await confluence.exists(slug=rendered['slug'],
+                                   ancestor_id=rendered['ancestor_id'],
+                                   space=rendered['space'])
+    if page:
+        if stored_fingerprint(page) == fingerprint:
+            log.info('Page {} is unchanged, skipping it'.format(
+                rendered['slug']))
+            return STATUS_UNCHANGED
+        await confluence.update(page['id'],
+                                page=page,
+                                fingerprint=fingerprint,
+                                parts=parts,
+                                **rendered)
+        return STATUS_UPDATED
+
+    await confluence.create(fingerprint=fingerprint, parts=parts, **rendered)
+    return STATUS_CREATED
+
+
+async def deploy_posts_async(posts, args):
+    """Deploys each of the provided posts concurrently with the asyncio
+    client, keeping at most args.concurrency requests in flight.
+
+    Arguments:
+        posts {list(str)} -- The absolute paths of the posts to deploy
+        args {argparse.Arguments} -- The parsed command-line arguments
+
+    Returns:
+        list(DeployResult) -- The result for each post, in the order given
+    """
+
+    async def deploy(post, confluence):
+        log.info('Attempting to deploy {}'.format(post))
+        try:
+            status = await deploy_file_async(post, args, confluence)
+        except Exception as e:
+            log.exception('Unable to deploy {}: {}'.format(post, e))
+            return DeployResult(post=post, status=STATUS_FAILED, error=e)
+        return DeployResult(post=post, status=status, error=None)
+
+    async with AsyncConfluence(concurrency=args.concurrency,
+                               **client_options(args)) as confluence:
+        return await asyncio.gather(*(deploy(post, confluence)
+                                      for post in posts))
+
+
+def deploy_posts(posts, args, confluence, resolver, state=None):
+    """Deploys each of the provided posts, running up to args.jobs deploys
+    concurrently.
+
+    The Confluence client is shared between the workers. A failure to deploy
+    one post is recorded in its result rather than aborting the others.
+
+    Arguments:
+        posts {list(str)} -- The absolute paths of the posts to deploy
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {confluence.Confluence} -- The Confluence API client
+        resolver {authors.AuthorResolver} -- The author resolver
+        state {state.DeployState} -- The deploy state (default: none)
+
+    Returns:
+        list(DeployResult) -- The result for each post, in the order given
+    """
+
+    def deploy(post):
+        log.info('Attempting to deploy {}'.format(post))
+        try:
+            status = deploy_file(post, args, confluence, resolver, state)
+        except Exception as e:
+            log.exception('Unable to deploy {}: {}'.format(post, e))
+            return DeployResult(post=post, status=STATUS_FAILED, error=e)
+        return DeployResult(post=post, status=status, error=None)
+
+    if args.convert_jobs:
+        return deploy_posts_pipelined(posts, args, confluence, resolver,
+                                      state)
+
+    if args.jobs == 1 or len(posts) == 1:
+        return [deploy(post) for post in posts]
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        return list(executor.map(deploy, posts))
+
+
+def deploy_posts_pipelined(posts, args, confluence, resolver, state=None):
+    """Deploys each of the provided posts using a two-stage pipeline: the
+    posts are converted by args.convert_jobs processes, and then sent to
+    Confluence by args.jobs threads.
+
+    Arguments:
+        posts {list(str)} -- The absolute paths of the posts to deploy
+        args {argparse.Arguments} -- The parsed command-line arguments
+        confluence {confluence.Confluence} -- The Confluence API client
+        resolver {authors.AuthorResolver} -- The author resolver
+        state {state.DeployState} -- The deploy state (default: none)
+
+    Returns:
+        list(DeployResult) -- The result for each post, in the order given
+    """
+
+    def publish(post, prepared):
+        log.info('Attempting to deploy {}'.format(post))
+        status = deploy_prepared(post, prepared, args, confluence, resolver,
+                                 state)
+        return DeployResult(post=post, status=status, error=None)
+
+    def on_error(post, e):
+        log.error('Unable to deploy {}: {}'.format(post, e))
+        return DeployResult(post=post, status=STATUS_FAILED, error=e)
+
+    prepare = functools.partial(prepare_post,
+                                root=args.git,
+                                rev=args.rev,
+                                engine=args.engine,
+                                cache_dir=args.cache_dir,
+                                render_cache_mb=args.render_cache_mb)
+    return run_pipeline(posts,
+                        prepare,
+                        publish,
+                        on_error,
+                        convert_jobs=args.convert_jobs,
+                        publish_jobs=args.jobs,
+                        max_pending=args.max_pending)
+
+
+def summarize(results):
+    """Logs a summary of the deploy results and returns the process exit
+    status.
+
+    Arguments:
+        results {list(DeployResult)} -- The results returned by deploy_posts
+
+    Returns:
+        int -- 0 if every post deployed (or was skipped) cleanly, 1 otherwise
+    """
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    log.info('Deployed {} posts: {}'.format(
+        len(results), ', '.join('{} {}'.format(count, status)
+                                for status, count in sorted(counts.items()))))
+
+    failed = [result for result in results if result.status == STATUS_FAILED]
+    for result in failed:
+        log.error('Failed to deploy {}: {}'.format(result.post, result.error))
+    return 1 if failed else 0
 
 
 def main():
     args = parse_args()
 
-    confluence = Confluence(api_url=args.api_url,
-                            username=args.username,
-                            password=args.password,
-                            headers=args.headers,
-                            dry_run=args.dry_run)
+    if args.jobs > 1:
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(THREADED_LOG_FORMAT))
+
+    repo = None
+    if not args.posts:
+        repo = git.Repo(args.git)
+    source = get_source(args, repo)
 
+    state = None
+    if args.state_dir:
+        state = DeployState(get_state_path(args), root=args.git, source=source)
+
+    head = None
+    unchanged = []
     if args.posts:
         changed_posts = [os.path.abspath(post) for post in args.posts]
         for post_path in changed_posts:
@@ -244,17 +1273,66 @@ def main():
                 log.error('File doesn\'t exist: {}'.format(post_path))
                 sys.exit(1)
     else:
-        repo = git.Repo(args.git)
-        changed_posts = [
-            os.path.join(args.git, post) for post in get_last_modified(repo)
-        ]
+        rev = args.rev or 'HEAD'
+        head = repo.commit(rev).hexsha
+        if args.full_sync:
+            posts = get_all_posts(repo, rev=rev)
+        else:
+            since = state.commit if state is not None else None
+            posts = get_last_modified(repo, since=since, rev=rev)
+        if args.from_index:
+            shared = set(update_index(repo, args, source).shared())
+            posts = [post for post in posts if post in shared]
+        if state is not None:
+            posts, unchanged = skip_unchanged(repo, posts, args, state)
+            if unchanged:
+                log.info('Skipping {} posts which are unchanged since they '
+                         'were last deployed'.format(len(unchanged)))
+        changed_posts = [os.path.join(args.git, post) for post in posts]
     if not changed_posts:
-        log.info('No post created/modified in the latest commit')
+        log.info('No post created/modified since the last deploy')
+        if state is not None and head:
+            state.set_commit(head)
+            state.save()
         return
 
-    for post in changed_posts:
-        log.info('Attempting to deploy {}'.format(post))
-        deploy_file(post, args, confluence)
+    if args.use_async:
+        results = asyncio.run(deploy_posts_async(changed_posts, args))
+    else:
+        confluence = Confluence(source=source, **sync_client_options(args))
+        if args.prewarm:
+            confluence.warm(min(confluence.pool_size, len(changed_posts) *
+                                args.attachment_jobs))
+        resolver = AuthorResolver(
+            confluence,
+            cache_path=get_cache_path(args, 'authors.json'),
+            ttl=args.author_ttl)
+        if len(changed_posts) > 1:
+            prefetch(changed_posts, args, confluence, resolver, state)
+        results = deploy_posts(changed_posts, args, confluence, resolver,
+                               state)
+        resolver.save()
+
+    render_cache = get_render_cache(args.cache_dir, args.render_cache_mb)
+    if render_cache is not None and render_cache.hits + render_cache.misses:
+        # Posts converted in the pipeline's worker processes are counted
+        # there, so aren't included
+        log.info('Render cache: {} hits, {} misses'.format(
+            render_cache.hits, render_cache.misses))
+
+    results = list(results) + [
+        DeployResult(post=os.path.join(args.git, post),
+                     status=STATUS_UNCHANGED,
+                     error=None) for post in unchanged
+    ]
+    status = summarize(results)
+    if state is not None:
+        # If any post failed, the next run starts from the same commit so
+        # that it is retried.
+        if head and status == 0:
+            state.set_commit(head)
+        state.save()
+    sys.exit(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+"""Runs deploys as a two-stage pipeline.
+
+The first stage converts posts in a pool of processes, keeping every core
+busy with the CPU-bound parsing and rendering. The converted posts are
+streamed through a queue to the second stage, a pool of threads which send
+them to Confluence.
+
+The number of posts which have been submitted for conversion but not yet
+published is bounded, so that converting faster than we can upload never
+causes the converted payloads to pile up in memory.
+"""
+
+import logging
+import queue
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# The default number of converted posts allowed to wait on the upload stage
+DEFAULT_MAX_PENDING = 32
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def run_pipeline(items,
+                 convert,
+                 publish,
+                 on_error,
+                 convert_jobs=None,
+                 publish_jobs=1,
+                 max_pending=DEFAULT_MAX_PENDING,
+                 _executor=None):
+    """Converts each item in a process pool, then publishes it in a thread
+    pool, returning the result of publishing each item.
+
+    Arguments:
+        items {list} -- The items to process
+        convert {callable} -- Called as convert(item) in a worker process.
+            Must be a picklable, module-level function, and return a
+            picklable value.
+        publish {callable} -- Called as publish(item, converted) in a
+            worker thread
+        on_error {callable} -- Called as on_error(item, exception) if either
+            stage raises, and returns the result to record for the item
+        convert_jobs {int} -- The number of conversion processes (default:
+            the number of CPUs)
+        publish_jobs {int} -- The number of publishing threads
+        max_pending {int} -- The maximum number of items submitted for
+            conversion which have not yet been published
+
+    Returns:
+        list -- The value returned by publish (or on_error) for each item,
+            in the order given
+    """
+    results = [None] * len(items)
+    ready = queue.Queue()
+    # Each item holds a slot from the time it is submitted for conversion
+    # until it has been published. Once every slot is taken, the feeder
+    # blocks until the upload stage catches up.
+    pending = threading.BoundedSemaphore(max(max_pending, publish_jobs))
+
+    def enqueue(index, item):
+        return lambda future: ready.put((index, item, future))
+
+    def feed(executor):
+        try:
+            for index, item in enumerate(items):
+                pending.acquire()
+                try:
+                    future = executor.submit(convert, item)
+                except Exception as e:
+                    # The pool is broken (e.g. a conversion process was
+                    # killed), so none of the remaining items can be
+                    # converted.
+                    log.error('Unable to convert the remaining {} items: '
+                              '{}'.format(len(items) - index, e))
+                    pending.release()
+                    for failed in range(index, len(items)):
+                        results[failed] = on_error(items[failed], e)
+                    return
+                future.add_done_callback(enqueue(index, item))
+        finally:
+            # Shutting down waits for the outstanding conversions, and so
+            # for their callbacks to have queued them.
+            executor.shutdown(wait=True)
+            for _ in range(publish_jobs):
+                ready.put(_DONE)
+
+    def drain():
+        while True:
+            entry = ready.get()
+            if entry is _DONE:
+                return
+            index, item, future = entry
+            try:
+                results[index] = publish(item, future.result())
+            except Exception as e:
+                results[index] = on_error(item, e)
+            finally:
+                pending.release()
+
+    executor = _executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=convert_jobs)
+
+    feeder = threading.Thread(target=feed,
+                              args=(executor, ),
+                              name='pipeline-feeder',
+                              daemon=True)
+    feeder.start()
+    with ThreadPoolExecutor(max_workers=publish_jobs) as publishers:
+        for _ in range(publish_jobs):
+            publishers.submit(drain)
+    feeder.join()
+    return results
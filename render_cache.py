@@ -0,0 +1,140 @@
+"""Caches converted posts on disk.
+
+Entries are addressed by a hash of everything the conversion depends on, so
+an entry never needs to be invalidated: a changed post (or renderer) simply
+has a different key. The cache is bounded in size, and the least recently
+used entries are evicted first.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# The default maximum size of the cache, in bytes
+DEFAULT_RENDER_CACHE_SIZE = 256 * 1024 * 1024
+
+# When the cache is full, entries are evicted until it's this full, so that
+# the cache isn't scanned again on every write
+EVICT_TO = 0.9
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    """Returns the key for a cache entry, which is a hash of the given
+    parts.
+
+    Arguments:
+        parts {list(str)} -- Everything the cached value depends on
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode('utf-8')
+        # Include the length of each part, so that parts can't run together
+        digest.update('{}:'.format(len(data)).encode())
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class RenderCache():
+    def __init__(self, directory, max_size=DEFAULT_RENDER_CACHE_SIZE):
+        """Creates a new render cache.
+
+        The cache can be shared by several processes, each with their own
+        RenderCache.
+
+        Arguments:
+            directory {str} -- The directory the entries are stored in
+            max_size {int} -- The maximum total size of the entries, in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], '{}.json'.format(key))
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        """Returns the cached value for a key, or None if it isn't cached.
+
+        Arguments:
+            key {str} -- The key returned by cache_key
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as entry_file:
+                value = json.load(entry_file)
+            # The modification time records when the entry was last used
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used entries if the
+        cache is full.
+
+        Arguments:
+            key {str} -- The key returned by cache_key
+            value {object} -- The value, which must be serializable as JSON
+        """
+        path = self._path(key)
+        data = json.dumps(value).encode('utf-8')
+        if len(data) > self.max_size:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first, so that other processes never
+            # read a partial entry.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path),
+                                             suffix='.tmp',
+                                             delete=False) as entry_file:
+                entry_file.write(data)
+            os.replace(entry_file.name, path)
+        except OSError as e:
+            log.warning('Unable to cache rendered post: {}'.format(e))
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_size * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
@@ -0,0 +1,132 @@
+"""Reads the posts and static files being deployed.
+
+By default, files are read from the filesystem. A GitSource reads them from
+the objects of a commit instead, so that deploys can run against any commit,
+or a bare repo, without checking it out.
+"""
+
+import hashlib
+import io
+import os
+import threading
+
+
+def blob_sha(path):
+    """Returns the git blob SHA-1 of a file, which matches the SHA git
+    records for the file when it is committed.
+
+    Arguments:
+        path {str} -- The path to the file
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    blob = hashlib.sha1('blob {}\0'.format(len(data)).encode())
+    blob.update(data)
+    return blob.hexdigest()
+
+
+class FileSource():
+    """Reads files from the filesystem."""
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def size(self, path):
+        return os.path.getsize(path)
+
+    def open(self, path):
+        """Returns a binary file object for the file."""
+        return open(path, 'rb')
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def digest(self, path):
+        """Returns the SHA-256 hex digest of the file's contents."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def blob_sha(self, path):
+        return blob_sha(path)
+
+
+class GitSource():
+    def __init__(self, repo, root, rev='HEAD'):
+        """Creates a new source which reads files from a commit.
+
+        The commit's tree is listed once, which gives the blob SHA and size
+        of every file without reading them. File contents are read through
+        the persistent `git cat-file --batch` process GitPython keeps for the
+        repo, so no process is started per file.
+
+        Arguments:
+            repo {git.Repo} -- The repository object
+            root {str} -- The path files are given relative to, normally the
+                path the repo was opened from
+            rev {str} -- The commit to read files from
+        """
+        self.repo = repo
+        self.root = root
+        self.rev = rev
+        self._lock = threading.Lock()
+        self._blobs = None
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _tree(self):
+        with self._lock:
+            if self._blobs is None:
+                self._blobs = {}
+                tree = self.repo.git.ls_tree(self.rev,
+                                             r=True,
+                                             long=True,
+                                             z=True)
+                for line in tree.split('\0'):
+                    if not line:
+                        continue
+                    info, filepath = line.split('\t', 1)
+                    # Submodules are listed as commits, without a size
+                    _, object_type, sha, size = info.split()
+                    if object_type == 'blob':
+                        self._blobs[filepath] = (sha, int(size))
+            return self._blobs
+
+    def _blob(self, path):
+        blob = self._tree().get(self._key(path))
+        if blob is None:
+            raise IOError('{} does not exist in {}'.format(path, self.rev))
+        return blob
+
+    def exists(self, path):
+        return self._key(path) in self._tree()
+
+    def size(self, path):
+        return self._blob(path)[1]
+
+    def open(self, path):
+        """Returns a binary file object for the file. The blob is read whole,
+        so the file object is in memory."""
+        return io.BytesIO(self.read(path))
+
+    def read(self, path):
+        sha, _ = self._blob(path)
+        # The cat-file process serves one object at a time
+        with self._lock:
+            _, _, _, data = self.repo.git.get_object_data(sha)
+        return data
+
+    def digest(self, path):
+        """Returns the SHA-256 hex digest of the file's contents."""
+        return hashlib.sha256(self.read(path)).hexdigest()
+
+    def blob_sha(self, path):
+        return self._blob(path)[0]
+
+
+# The source used when none is given
+FILE_SOURCE = FileSource()
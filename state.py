@@ -0,0 +1,272 @@
+"""Records what was last deployed for each post.
+
+The deploy state lets us tell that a post hasn't changed without asking
+Confluence, and lets changed posts be updated without first searching for
+their page.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from confluence import FINGERPRINT_PROPERTY
+from sources import FILE_SOURCE
+
+# The version of the state file format
+STATE_FORMAT = 2
+
+log = logging.getLogger(__name__)
+
+
+class DeployState():
+    def __init__(self, path=None, root=None, source=None):
+        """Creates a new deploy state, loading the state left by the last run
+        if there is one.
+
+        Arguments:
+            path {str} -- The path to the JSON file the state is kept in
+                (default: don't persist the state)
+            root {str} -- The root of the Git repo. Files are recorded by
+                their path relative to it, so that the state can be used from
+                another checkout. (default: record absolute paths)
+            source {sources.FileSource} -- The source attachments are read
+                from (default: the filesystem)
+        """
+        self.path = path
+        self.root = root
+        self.source = source or FILE_SOURCE
+        self._lock = threading.Lock()
+        self._dirty = False
+        state = self._load()
+        self._pages = state.get('pages', {})
+        self._slugs = {
+            entry['path']: slug
+            for slug, entry in self._pages.items() if entry.get('path')
+        }
+        self.commit = state.get('commit')
+
+    def relpath(self, path):
+        """Returns the path a file is recorded under, which is relative to
+        the repo root and uses forward slashes, like the paths git lists.
+
+        Arguments:
+            path {str} -- The path to the file
+        """
+        if not self.root:
+            return path
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def _blobs(self, paths):
+        blobs = {}
+        for path in paths or []:
+            if self.source.exists(path):
+                blobs[self.relpath(path)] = self.source.blob_sha(path)
+        return blobs
+
+    def _abspath(self, path):
+        if not self.root:
+            return path
+        return os.path.join(self.root, path)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as e:
+            log.warning('Ignoring unreadable deploy state {}: {}'.format(
+                self.path, e))
+            return {}
+        if state.get('format') != STATE_FORMAT:
+            log.warning('Ignoring deploy state {} from another version'.format(
+                self.path))
+            return {}
+        return state
+
+    def save(self):
+        """Writes the deploy state to its file, if one is set."""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            state = {
+                'format': STATE_FORMAT,
+                'commit': self.commit,
+                'pages': dict(self._pages),
+            }
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that an interrupted run never
+        # leaves a truncated state file behind.
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, slug, space=None, ancestor_id=None):
+        """Returns what was last deployed for a post, or None if it hasn't
+        been deployed to the given location.
+
+        Arguments:
+            slug {str} -- The page slug
+            space {str} -- The Confluence space the page belongs in
+            ancestor_id {str} -- The ID of the parent Confluence page
+        """
+        with self._lock:
+            entry = self._pages.get(slug)
+        if entry is None:
+            return None
+        if entry['space'] != space or entry['ancestor_id'] != str(ancestor_id):
+            return None
+        return entry
+
+    def unchanged(self, slug, space, ancestor_id, source, options=None):
+        """Returns whether a post is the same as when it was last deployed,
+        without rendering it.
+
+        This is the case if the post source, the deploy options and the
+        contents of every attachment it referenced are all unchanged.
+
+        Arguments:
+            slug {str} -- The page slug
+            space {str} -- The Confluence space the page belongs in
+            ancestor_id {str} -- The ID of the parent Confluence page
+            source {str} -- The blob SHA of the post
+            options {dict} -- Any deploy options which affect the page
+        """
+        entry = self.get(slug, space=space, ancestor_id=ancestor_id)
+        if entry is None or entry.get('source') != source:
+            return False
+        if entry.get('options') != (options or {}):
+            return False
+        attachments = entry.get('attachments', {})
+        return self._blobs(self._abspath(attachment)
+                           for attachment in attachments) == attachments
+
+    def unchanged_blobs(self, path, blobs, options=None):
+        """Returns whether a post is the same as when it was last deployed,
+        given the blob SHAs git has for it and its attachments. Unlike
+        unchanged, this doesn't need to read any files.
+
+        Arguments:
+            path {str} -- The path of the post, relative to the repo root
+            blobs {dict} -- The blob SHA of each file in the repo, by its path
+                relative to the repo root
+            options {dict} -- Any deploy options which affect the page
+        """
+        with self._lock:
+            entry = self._pages.get(self._slugs.get(path))
+        if entry is None or not entry.get('source'):
+            return False
+        if blobs.get(path) != entry['source']:
+            return False
+        if entry.get('options') != (options or {}):
+            return False
+        return all(
+            blobs.get(attachment) == blob
+            for attachment, blob in entry.get('attachments', {}).items())
+
+    def cached_page(self, entry):
+        """Returns the page recorded in a state entry, in the shape returned
+        by Confluence.exists.
+
+        Arguments:
+            entry {dict} -- The entry returned by get
+        """
+        page = {
+            'id': entry['page_id'],
+            'version': {
+                'number': entry['version']
+            },
+        }
+        # If we don't know the fingerprint property, we leave the metadata
+        # out so that it is looked up before being updated.
+        if entry.get('property_version'):
+            page['metadata'] = {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': entry['fingerprint'],
+                            'parts': entry.get('parts'),
+                        },
+                        'version': {
+                            'number': entry['property_version']
+                        },
+                    }
+                }
+            }
+        return page
+
+    def record(self,
+               rendered,
+               page,
+               fingerprint,
+               source=None,
+               options=None,
+               post_path=None):
+        """Records that a post has been deployed.
+
+        Arguments:
+            rendered {dict} -- The page arguments the post was deployed with
+            page {dict} -- The page returned by Confluence.exists, create or
+                update
+            fingerprint {str} -- The fingerprint of the page
+            source {str} -- The blob SHA of the post
+            options {dict} -- Any deploy options which affect the page
+            post_path {str} -- The path of the post
+        """
+        properties = page.get('metadata', {}).get('properties', {})
+        stored = properties.get(FINGERPRINT_PROPERTY)
+        if not stored:
+            # The fingerprint wasn't stored on the page (e.g. because an
+            # attachment failed to upload), so the post must be deployed
+            # again next time.
+            fingerprint = None
+            source = None
+        entry = {
+            'page_id': page['id'],
+            'version': page['version']['number'],
+            'space': rendered['space'],
+            'ancestor_id': str(rendered['ancestor_id']),
+            'fingerprint': fingerprint,
+            'property_version': stored and stored.get('version',
+                                                      {}).get('number'),
+            'parts': stored and stored.get('value', {}).get('parts'),
+            'attachments': self._blobs(rendered['attachments']),
+            'source': source,
+            'path': post_path and self.relpath(post_path),
+            'options': options or {},
+        }
+        with self._lock:
+            self._pages[rendered['slug']] = entry
+            if entry['path']:
+                self._slugs[entry['path']] = rendered['slug']
+            self._dirty = True
+
+    def set_commit(self, commit):
+        """Records the last commit which was deployed successfully.
+
+        Arguments:
+            commit {str} -- The commit SHA
+        """
+        with self._lock:
+            if commit != self.commit:
+                self.commit = commit
+                self._dirty = True
+
+    def forget(self, slug):
+        """Removes a post from the deploy state.
+
+        Arguments:
+            slug {str} -- The page slug
+        """
+        with self._lock:
+            entry = self._pages.pop(slug, None)
+            if entry is not None:
+                self._slugs.pop(entry.get('path'), None)
+                self._dirty = True
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import unittest
+
+from async_confluence import AsyncConfluence
+from confluence import (AttachmentUploadException, DEFAULT_LABEL_PREFIX,
+                        FINGERPRINT_PROPERTY, RequestFailedException)
+
+
+class MockAsyncResponse():
+    def __init__(self, response=None, status=None):
+        self._json = response
+        self.status = status
+        self.reason = ''
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def json(self, content_type=None):
+        return self._json
+
+    async def read(self):
+        return json.dumps(self._json).encode()
+
+
+class MockAsyncConfluenceClient():
+    def __init__(self, response=None, status=200):
+        self.response = response
+        self.status = status
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        kwargs.update({'method': method, 'url': url})
+        self.requests.append(kwargs)
+        return MockAsyncResponse(response=self.response, status=self.status)
+
+    async def close(self):
+        pass
+
+
+class MockAsyncSequenceClient(MockAsyncConfluenceClient):
+    """Returns each of the provided (status, response) outcomes in turn."""
+
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+
+    def request(self, method, url, **kwargs):
+        kwargs.update({'method': method, 'url': url})
+        self.requests.append(kwargs)
+        status, response = self.outcomes.pop(0)
+        return MockAsyncResponse(response=response, status=status)
+
+
+class TestAsyncConfluence(unittest.TestCase):
+    def setUp(self):
+        self.slug = 'example-page'
+
+    def run_with(self, client, coroutine_fn):
+        async def run():
+            async with AsyncConfluence(
+                    api_url='https://wiki.example.com/rest/api',
+                    username='foo',
+                    password='bar',
+                    _client=client) as api:
+                return await coroutine_fn(api)
+
+        return asyncio.run(run())
+
+    def testPostExists(self):
+        response = {
+            'results': [{
+                'id': '1234567',
+                'type': 'page',
+                'title': 'Example Page'
+            }],
+            'size': 1
+        }
+        client = MockAsyncConfluenceClient(response=response)
+        got = self.run_with(client, lambda api: api.exists(slug=self.slug))
+        self.assertEqual(got['id'], '1234567')
+
+    def testPostDoesntExist(self):
+        client = MockAsyncConfluenceClient(response={
+            'results': [],
+            'size': 0
+        })
+        got = self.run_with(client, lambda api: api.exists(slug=self.slug))
+        self.assertIsNone(got)
+
+    def testPostSearchFails(self):
+        # An error must not be mistaken for a missing page
+        client = MockAsyncConfluenceClient(response={'message': 'Error'},
+                                           status=500)
+        with self.assertRaises(RequestFailedException):
+            self.run_with(client, lambda api: api.exists(slug=self.slug))
+
+    def testUpdateFails(self):
+        client = MockAsyncConfluenceClient(response={'message': 'Conflict'},
+                                           status=409)
+        with self.assertRaises(RequestFailedException) as raised:
+            self.run_with(
+                client, lambda api: api.update(post_id='12345',
+                                               content='<p>Hello</p>',
+                                               space='SPACE',
+                                               title='Example Page',
+                                               slug=self.slug,
+                                               page={
+                                                   'id': '12345',
+                                                   'version': {
+                                                       'number': 3
+                                                   }
+                                               }))
+        self.assertEqual(raised.exception.status_code, 409)
+
+    def testUpdateStoresFingerprint(self):
+        page = {
+            'id': '12345',
+            'version': {
+                'number': 3
+            },
+            'metadata': {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': 'old'
+                        },
+                        'version': {
+                            'number': 7
+                        }
+                    }
+                }
+            }
+        }
+        client = MockAsyncSequenceClient([
+            (200, {
+                'id': '12345',
+                'version': {
+                    'number': 4
+                },
+                '_links': {
+                    'webui': '/pages/12345'
+                }
+            }),
+            (200, {'results': [{'name': self.slug}]}),
+            (200, {'key': FINGERPRINT_PROPERTY, 'version': {'number': 8}}),
+        ])
+        updated = self.run_with(
+            client, lambda api: api.update(post_id='12345',
+                                           content='<p>Hello</p>',
+                                           space='SPACE',
+                                           title='Example Page',
+                                           slug=self.slug,
+                                           page=page,
+                                           fingerprint='new'))
+        self.assertEqual(updated['version'], {'number': 4})
+        self.assertIn(FINGERPRINT_PROPERTY, updated['metadata']['properties'])
+
+        request = client.requests[-1]
+        self.assertEqual(request['method'], 'PUT')
+        self.assertEqual(request['json']['value']['fingerprint'], 'new')
+        self.assertEqual(request['json']['value']['parts']['title'],
+                         'Example Page')
+        self.assertEqual(request['json']['version'], {'number': 8})
+
+    def testUpdateClearsFingerprintWhenAttachmentFails(self):
+        page = {'id': '12345', 'version': {'number': 3}}
+        client = MockAsyncSequenceClient([
+            (200, {
+                'id': '12345',
+                'version': {
+                    'number': 4
+                },
+                '_links': {
+                    'webui': '/pages/12345'
+                }
+            }),
+            (200, {'results': [{'name': self.slug}]}),
+            (404, {'message': 'Not found'}),
+            (200, {'key': FINGERPRINT_PROPERTY, 'version': {'number': 1}}),
+        ])
+        with self.assertRaises(AttachmentUploadException) as raised:
+            self.run_with(
+                client, lambda api: api.update(
+                    post_id='12345',
+                    content='<p>Hello</p>',
+                    space='SPACE',
+                    title='Example Page',
+                    slug=self.slug,
+                    page=page,
+                    attachments=['/does/not/exist.png'],
+                    fingerprint='new'))
+        self.assertEqual(list(raised.exception.failed),
+                         ['/does/not/exist.png'])
+
+        # The fingerprint left by an earlier deploy must not survive, or the
+        # page would be skipped when the post is changed back
+        request = client.requests[-1]
+        self.assertEqual(request['method'], 'POST')
+        self.assertIsNone(request['json']['value']['fingerprint'])
+
+    def testLabelCreation(self):
+        tags = ['knowledge', 'testing']
+        client = MockAsyncConfluenceClient(response={})
+        self.run_with(
+            client, lambda api: api.create_labels(
+                page_id='12345', slug=self.slug, tags=tags))
+        sent = client.requests[0]['json']
+        self.assertEqual(sent, [{
+            'prefix': DEFAULT_LABEL_PREFIX,
+            'name': name
+        } for name in [self.slug] + tags])
+
+    def testGetAuthorMissing(self):
+        client = MockAsyncConfluenceClient(response={'message': 'Not found'},
+                                           status=404)
+        got = self.run_with(client, lambda api: api.get_author('foo'))
+        self.assertEqual(got, {})
+
+    def testGetAuthorOnce(self):
+        client = MockAsyncConfluenceClient(response={'userKey': 'key'})
+
+        async def lookup(api):
+            authors = await asyncio.gather(
+                *(api.get_author(username)
+                  for username in ['foo', 'bar', 'foo', 'foo']))
+            authors.append(await api.get_author('bar'))
+            return authors
+
+        got = self.run_with(client, lookup)
+        self.assertEqual(got, [{'userKey': 'key'}] * 5)
+        self.assertEqual(len(client.requests), 2)
+
+    def testConcurrencyLimit(self):
+        in_flight = []
+        peak = []
+
+        class SlowResponse(MockAsyncResponse):
+            async def __aenter__(self):
+                in_flight.append(1)
+                peak.append(len(in_flight))
+                await asyncio.sleep(0.01)
+                return self
+
+            async def __aexit__(self, *exc):
+                in_flight.pop()
+
+        class SlowClient(MockAsyncConfluenceClient):
+            def request(self, method, url, **kwargs):
+                return SlowResponse(response={'userKey': 'key'}, status=200)
+
+        async def run():
+            async with AsyncConfluence(api_url='https://wiki.example.com',
+                                       concurrency=2,
+                                       _client=SlowClient()) as api:
+                await asyncio.gather(*(api.get_author('user{}'.format(i))
+                                       for i in range(10)))
+
+        asyncio.run(run())
+        self.assertEqual(max(peak), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
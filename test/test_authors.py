@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from authors import AuthorResolver
+from confluence import RequestFailedException
+
+
+class MockConfluence():
+    def __init__(self, users=None, failing=None, delay=0):
+        self.users = users or {}
+        self.failing = failing or []
+        self.delay = delay
+        self.lookups = []
+        self._lock = threading.Lock()
+
+    def find_user(self, username):
+        with self._lock:
+            self.lookups.append(username)
+        time.sleep(self.delay)
+        if username in self.failing:
+            raise RequestFailedException('503', status_code=503)
+        if username not in self.users:
+            return None
+        return {'username': username, 'userKey': self.users[username]}
+
+
+class TestAuthorResolver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_path = os.path.join(self.directory.name, 'authors.json')
+        self.now = 1000.0
+
+    def clock(self):
+        return self.now
+
+    def resolver(self, confluence, **kwargs):
+        return AuthorResolver(confluence,
+                              cache_path=self.cache_path,
+                              _clock=self.clock,
+                              **kwargs)
+
+    def testResolvesEachAuthorOnce(self):
+        confluence = MockConfluence(users={'foo': '1', 'bar': '2'})
+        resolver = self.resolver(confluence)
+        got = resolver.resolve(['foo', 'bar', 'foo', 'unknown'])
+        self.assertEqual(got, {'foo': '1', 'bar': '2', 'unknown': None})
+        self.assertEqual(resolver.author_keys(['bar', 'unknown', 'foo']),
+                         ['2', '1'])
+        self.assertEqual(sorted(confluence.lookups), ['bar', 'foo', 'unknown'])
+
+    def testConcurrentCallersShareLookups(self):
+        confluence = MockConfluence(users={'foo': '1'}, delay=0.05)
+        resolver = self.resolver(confluence)
+        threads = [
+            threading.Thread(target=resolver.resolve, args=(['foo'], ))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(confluence.lookups, ['foo'])
+
+    def testPersistentCache(self):
+        resolver = self.resolver(MockConfluence(users={'foo': '1'}))
+        resolver.resolve(['foo', 'unknown'])
+        resolver.save()
+        with open(self.cache_path) as f:
+            self.assertEqual(json.load(f)['foo']['key'], '1')
+
+        confluence = MockConfluence()
+        got = self.resolver(confluence).resolve(['foo', 'unknown'])
+        self.assertEqual(got, {'foo': '1', 'unknown': None})
+        self.assertEqual(confluence.lookups, [])
+
+    def testExpiry(self):
+        resolver = self.resolver(MockConfluence(users={'foo': '1'}),
+                                 ttl=100,
+                                 negative_ttl=10)
+        resolver.resolve(['foo', 'unknown'])
+        resolver.save()
+
+        # Unknown users are forgotten sooner than known ones
+        self.now += 50
+        confluence = MockConfluence(users={'foo': '1', 'unknown': '2'})
+        got = self.resolver(confluence).resolve(['foo', 'unknown'])
+        self.assertEqual(got, {'foo': '1', 'unknown': '2'})
+        self.assertEqual(confluence.lookups, ['unknown'])
+
+    def testFailuresNotCached(self):
+        confluence = MockConfluence(users={'foo': '1'}, failing=['foo'])
+        resolver = self.resolver(confluence)
+        self.assertEqual(resolver.resolve(['foo']), {'foo': None})
+        confluence.failing = []
+        self.assertEqual(resolver.resolve(['foo']), {'foo': '1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
 import unittest
+import hashlib
 import json
 import logging
+import os
+import tempfile
 
-from confluence import Confluence, DEFAULT_LABEL_PREFIX
+import requests
+
+from confluence import (AttachmentUploadException, Confluence,
+                        DEFAULT_LABEL_PREFIX, FINGERPRINT_PROPERTY,
+                        RequestFailedException, UpdatePlan, page_fingerprint,
+                        page_parts, plan_update, stored_fingerprint)
+from sources import FileSource
+from throttle import READ, RetryPolicy
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
@@ -16,7 +26,10 @@ class MockResponse():
             self.text = json.dumps(response)
         else:
             self.text = response
+        self.content = self.text.encode() if self.text else b''
         self.status_code = status
+        self.reason = ''
+        self.headers = {}
 
     @property
     def ok(self):
@@ -90,6 +103,49 @@ class TestConfluence(unittest.TestCase):
         got = self.api.exists(slug=self.slug)
         self.assertFalse(got)
 
+    def testBatchPostExists(self):
+        def page(page_id, *labels):
+            return {
+                'id': page_id,
+                'version': {'number': 1},
+                'metadata': {
+                    'labels': {
+                        'results': [{'name': label} for label in labels]
+                    }
+                }
+            }
+
+        client = MockSequenceClient([
+            (200, {
+                'results': [page('1', 'a', 'knowledge')],
+                '_links': {'next': '/rest/api/content/search?start=1'}
+            }),
+            (200, {'results': [page('3', 'c')], '_links': {}}),
+            (200, {'results': [], '_links': {}}),
+        ])
+        self.api._session = client
+        got = self.api.exists_many(space=self.space,
+                                   slugs=['c', 'b', 'a', 'd'],
+                                   ancestor_id='123',
+                                   chunk_size=3)
+        self.assertEqual(got['a']['id'], '1')
+        self.assertIsNone(got['b'])
+        self.assertEqual(got['c']['id'], '3')
+        self.assertIsNone(got['d'])
+
+        params = [request['params'] for request in client.requests]
+        self.assertIn('label in ("a","b","c")', params[0]['cql'])
+        self.assertEqual(params[1]['start'], 1)
+        self.assertIn('label in ("d")', params[2]['cql'])
+
+        # Subsequent lookups use the batched results without a request
+        self.assertEqual(
+            self.api.exists(space=self.space, slug='a', ancestor_id=123)['id'],
+            '1')
+        self.assertIsNone(
+            self.api.exists(space=self.space, slug='b', ancestor_id='123'))
+        self.assertEqual(len(client.requests), 3)
+
     def testLabelCreation(self):
         slug = 'example-post'
         tags = ['knowledge', 'testing']
@@ -106,10 +162,10 @@ class TestConfluence(unittest.TestCase):
         client = MockConfluenceClient(response={}, status=200, is_json=True)
         self.api._session = client
         self.api.create_labels(page_id='12345', slug=slug, tags=tags)
-        sent = self.api._session.requests[0]
-        self.assertEqual(len(sent['json']), len(expected))
+        sent = json.loads(self.api._session.requests[0]['data'])
+        self.assertEqual(len(sent), len(expected))
         for label in expected:
-            self.assertIn(label, sent['json'])
+            self.assertIn(label, sent)
 
     def testGetAuthor(self):
         userKey = '1234567890'
@@ -132,6 +188,499 @@ class TestConfluence(unittest.TestCase):
         got = self.api.get_author('foo')
         self.assertEqual(got['userKey'], userKey)
 
+    def testTimeouts(self):
+        api = Confluence(api_url='https://wiki.example.com/rest/api',
+                         connect_timeout=5,
+                         read_timeout=30)
+        client = MockConfluenceClient(response={}, status=200, is_json=True)
+        api._session = client
+        api.get_author('foo')
+        self.assertEqual(client.requests[0]['timeout'], (5, 30))
+
+    def testWarmIsThrottled(self):
+        api = Confluence(api_url='https://wiki.example.com/rest/api',
+                         rate_limits={READ: 1000},
+                         max_concurrency=4)
+        client = MockConfluenceClient(response={}, status=200, is_json=True)
+        api._session = client
+        acquired = []
+        bucket_acquire = api._buckets[READ].acquire
+        limiter_acquire = api._limiter.acquire
+        api._buckets[READ].acquire = lambda: acquired.append(
+            'read') or bucket_acquire()
+        api._limiter.acquire = lambda: acquired.append(
+            'limiter') or limiter_acquire()
+
+        for thread in api.warm(3):
+            thread.join()
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(sorted(acquired), ['limiter'] * 3 + ['read'] * 3)
+
+    def testUploadAttachmentsReportsFailures(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        attachments = []
+        for name in ['one.png', 'two.png', 'three.png']:
+            attachment = os.path.join(directory.name, name)
+            with open(attachment, 'wb') as f:
+                f.write(b'image')
+            attachments.append(attachment)
+        missing = os.path.join(directory.name, 'missing.png')
+        attachments.append(missing)
+
+        client = MockConfluenceClient(response={'results': []},
+                                      status=200,
+                                      is_json=True)
+        self.api._session = client
+        failed = self.api.upload_attachments(post_id='12345',
+                                             attachments=attachments)
+        self.assertEqual(list(failed), [missing])
+        uploads = [r for r in client.requests if r['method'] == 'POST']
+        self.assertEqual(len(uploads), 3)
+
+    def testUploadOnlyChangedAttachments(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        paths = {}
+        for name in ['same.png', 'changed.png', 'new.png']:
+            paths[name] = os.path.join(directory.name, name)
+            with open(paths[name], 'wb') as f:
+                f.write(name.encode())
+
+        def remote(attachment_id, name, content):
+            return {
+                'id': attachment_id,
+                'title': name,
+                'extensions': {
+                    'fileSize': len(content)
+                },
+                'metadata': {
+                    'comment':
+                    'sha256:' + hashlib.sha256(content).hexdigest()
+                }
+            }
+
+        client = MockSequenceClient([
+            (200, {
+                'results': [
+                    remote('att1', 'same.png', b'same.png'),
+                    remote('att2', 'changed.png', b'old content'),
+                ],
+                '_links': {}
+            }),
+            (200, {'results': []}),
+            (200, {'results': []}),
+        ])
+        self.api._session = client
+        self.api.attachment_jobs = 1
+        failed = self.api.upload_attachments(
+            post_id='12345',
+            attachments=[
+                paths['same.png'], paths['changed.png'], paths['new.png'],
+                paths['changed.png']
+            ])
+        self.assertEqual(failed, {})
+
+        urls = [request['url'] for request in client.requests[1:]]
+        self.assertEqual(urls, [
+            'https://wiki.example.com/rest/api/content/12345/child/attachment/att2/data',
+            'https://wiki.example.com/rest/api/content/12345/child/attachment',
+        ])
+        comment = client.requests[2]['files']['comment']
+        self.assertEqual(comment[1],
+                         'sha256:' + hashlib.sha256(b'new.png').hexdigest())
+
+    def testPageFingerprint(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        image = os.path.join(directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'image')
+        page = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'ancestor_id': '123',
+            'slug': self.slug,
+            'tags': ['one', 'two'],
+            'attachments': [image],
+        }
+        fingerprint = page_fingerprint(**page)
+        self.assertEqual(fingerprint,
+                         page_fingerprint(**dict(page, tags=['two', 'one'])))
+        self.assertNotEqual(
+            fingerprint, page_fingerprint(**dict(page, title='Other Page')))
+
+        with open(image, 'wb') as f:
+            f.write(b'new image')
+        self.assertNotEqual(fingerprint, page_fingerprint(**page))
+
+    def testUpdateStoresFingerprint(self):
+        page = {
+            'id': '12345',
+            'version': {
+                'number': 3
+            },
+            'metadata': {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': 'old'
+                        },
+                        'version': {
+                            'number': 7
+                        }
+                    }
+                }
+            }
+        }
+        self.assertEqual(stored_fingerprint(page), 'old')
+        self.assertIsNone(stored_fingerprint({'id': '12345'}))
+
+        client = MockConfluenceClient(response={
+            'id': '12345',
+            'version': {
+                'number': 8
+            },
+            'results': [],
+            '_links': {
+                'webui': '/pages/12345'
+            }
+        },
+                                      status=200,
+                                      is_json=True)
+        self.api._session = client
+        updated = self.api.update(post_id='12345',
+                                  content='<p>Hello</p>',
+                                  space=self.space,
+                                  title='Example Page',
+                                  slug=self.slug,
+                                  page=page,
+                                  fingerprint='new')
+        self.assertEqual(updated['id'], '12345')
+        self.assertIn(FINGERPRINT_PROPERTY, updated['metadata']['properties'])
+
+        request = client.requests[-1]
+        self.assertEqual(request['method'], 'PUT')
+        self.assertEqual(
+            request['url'],
+            'https://wiki.example.com/rest/api/content/12345/property/' +
+            FINGERPRINT_PROPERTY)
+        data = json.loads(request['data'])
+        self.assertEqual(data['value']['fingerprint'], 'new')
+        self.assertEqual(data['value']['parts']['title'], 'Example Page')
+        self.assertEqual(data['version'], {'number': 8})
+
+    def testUpdateFailedAttachment(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        image = os.path.join(directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'image')
+        page = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'ancestor_id': '123',
+            'slug': self.slug,
+            'tags': [],
+            'attachments': [image],
+        }
+        remote = {
+            'id': '12345',
+            'version': {
+                'number': 3
+            },
+            'metadata': {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': 'old'
+                        },
+                        'version': {
+                            'number': 7
+                        }
+                    }
+                }
+            }
+        }
+        updated = {
+            'id': '12345',
+            'version': {
+                'number': 4
+            },
+            '_links': {
+                'webui': '/pages/12345'
+            }
+        }
+        client = MockSequenceClient([
+            (200, {'results': [], '_links': {}}),
+            (500, {'message': 'Upload failed'}),
+            (200, updated),
+            (200, {'results': [{'name': self.slug}]}),
+            (200, {'key': FINGERPRINT_PROPERTY, 'version': {'number': 8}}),
+        ])
+        self.api._session = client
+        self.api._retry_policy = RetryPolicy(retries=0)
+        with self.assertRaises(AttachmentUploadException) as raised:
+            self.api.update(post_id='12345',
+                            space=self.space,
+                            page=remote,
+                            fingerprint=page_fingerprint(**page),
+                            **page)
+        self.assertEqual(list(raised.exception.failed), [image])
+        self.assertEqual(raised.exception.page['version'], {'number': 4})
+
+        # The rest of the page is deployed, but the old fingerprint is
+        # cleared, and the attachment is left out of the stored parts so
+        # that it is uploaded again next time
+        data = json.loads(client.requests[-1]['data'])
+        self.assertIsNone(data['value']['fingerprint'])
+        self.assertEqual(data['value']['parts']['attachments'], {})
+        self.assertEqual(data['value']['parts']['title'], 'Example Page')
+
+    def testUpdateReadsAttachmentsOnce(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        image = os.path.join(directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'image')
+        digested = []
+
+        class CountingSource(FileSource):
+            def digest(self, path):
+                digested.append(path)
+                return super().digest(path)
+
+        source = CountingSource()
+        api = Confluence(api_url='https://wiki.example.com/rest/api',
+                         source=source)
+        api._session = MockConfluenceClient(response={
+            'id': '12345',
+            'version': {
+                'number': 4
+            },
+            'results': [{
+                'name': self.slug,
+                'title': 'other.png'
+            }],
+            '_links': {
+                'webui': '/pages/12345'
+            }
+        },
+                                            status=200,
+                                            is_json=True)
+        page = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'ancestor_id': '123',
+            'slug': self.slug,
+            'tags': [],
+            'attachments': [image],
+        }
+        parts = page_parts(source=source, **page)
+        api.update(post_id='12345',
+                   space=self.space,
+                   page={'id': '12345', 'version': {'number': 3}},
+                   fingerprint='new',
+                   parts=parts,
+                   **page)
+        uploads = [
+            r for r in api._session.requests
+            if r['url'].endswith('/child/attachment')
+            and r['method'] == 'POST'
+        ]
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0]['files']['comment'][1],
+                         'sha256:' + hashlib.sha256(b'image').hexdigest())
+        self.assertEqual(digested, [image])
+
+    def testPlanUpdate(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        image = os.path.join(directory.name, 'image.png')
+        with open(image, 'wb') as f:
+            f.write(b'image')
+        page = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'ancestor_id': '123',
+            'slug': self.slug,
+            'tags': ['one'],
+            'attachments': [image],
+        }
+        remote = page_parts(**page)
+
+        plan = plan_update(None, remote, attachments=[image])
+        self.assertEqual(plan, UpdatePlan([image], True, True, True))
+
+        retagged = page_parts(**dict(page, tags=['one', 'two']))
+        self.assertEqual(plan_update(remote, retagged, attachments=[image]),
+                         UpdatePlan([], False, False, True))
+
+        moved = page_parts(**dict(page, ancestor_id='456'))
+        self.assertEqual(plan_update(remote, moved, attachments=[image]),
+                         UpdatePlan([], False, True, False))
+
+        edited = page_parts(**dict(page, content='<p>Hello!</p>'))
+        self.assertEqual(plan_update(remote, edited, attachments=[image]),
+                         UpdatePlan([], True, False, False))
+
+        with open(image, 'wb') as f:
+            f.write(b'new image')
+        self.assertEqual(
+            plan_update(remote, page_parts(**page), attachments=[image]),
+            UpdatePlan([image], False, False, False))
+
+    def testUpdateOnlyLabels(self):
+        page = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'ancestor_id': '123',
+            'slug': self.slug,
+            'tags': ['one'],
+            'attachments': [],
+        }
+        remote = {
+            'id': '12345',
+            'version': {
+                'number': 3
+            },
+            'metadata': {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': page_fingerprint(**page),
+                            'parts': page_parts(**page)
+                        },
+                        'version': {
+                            'number': 7
+                        }
+                    }
+                }
+            }
+        }
+        client = MockConfluenceClient(response={
+            'id': '12345',
+            'version': {
+                'number': 8
+            },
+            'results': [{
+                'name': self.slug
+            }],
+        },
+                                      status=200,
+                                      is_json=True)
+        self.api._session = client
+        page['tags'] = ['one', 'two']
+        updated = self.api.update(post_id='12345',
+                                  space=self.space,
+                                  page=remote,
+                                  fingerprint=page_fingerprint(**page),
+                                  **page)
+        self.assertEqual(updated['version'], {'number': 3})
+        self.assertEqual([(r['method'], r['url']) for r in client.requests], [
+            ('POST', 'https://wiki.example.com/rest/api/content/12345/label'),
+            ('PUT', 'https://wiki.example.com/rest/api/content/12345/property/'
+             + FINGERPRINT_PROPERTY),
+        ])
+
+
+class MockSequenceClient():
+    """Returns (or raises) each of the provided outcomes in turn."""
+
+    def __init__(self, outcomes):
+        self.auth = None
+        self.headers = {}
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def request(self, *args, **kwargs):
+        self.requests.append(kwargs)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        status, response = outcome
+        return MockResponse(response=response, status=status)
+
+
+class TestConfluenceRetries(unittest.TestCase):
+    def setUp(self):
+        self.api = Confluence(api_url='https://wiki.example.com/rest/api',
+                              username='foo',
+                              password='bar',
+                              retry_policy=RetryPolicy(retries=2,
+                                                       _random=lambda: 0))
+
+    def testRetriesTransientErrors(self):
+        client = MockSequenceClient([
+            (503, {}),
+            requests.exceptions.ConnectionError('reset'),
+            (200, {'userKey': '1234'}),
+        ])
+        self.api._session = client
+        got = self.api.get_author('foo')
+        self.assertEqual(got['userKey'], '1234')
+        self.assertEqual(len(client.requests), 3)
+
+    def testGivesUpAfterRetries(self):
+        client = MockSequenceClient([(503, {})] * 3)
+        self.api._session = client
+        self.assertEqual(self.api.get_author('foo'), {})
+        self.assertEqual(len(client.requests), 3)
+
+    def testExistsRaisesAfterRetries(self):
+        client = MockSequenceClient([(503, {})] * 3)
+        self.api._session = client
+        with self.assertRaises(RequestFailedException):
+            self.api.exists(slug='example-page')
+        self.assertEqual(len(client.requests), 3)
+
+    def testNonIdempotentPostNotRetried(self):
+        client = MockSequenceClient([(500, {})])
+        self.api._session = client
+        self.api.post(path='content/123/child/attachment', data={})
+        self.assertEqual(len(client.requests), 1)
+
+    def testRequestBodyReused(self):
+        client = MockSequenceClient([(502, {}), (200, {'results': []})])
+        self.api._session = client
+        self.api.create_labels(page_id='123', slug='slug')
+        self.assertEqual(len(client.requests), 2)
+        self.assertIs(client.requests[0]['data'], client.requests[1]['data'])
+
+    def testCreateChecksForPageBeforeRetrying(self):
+        page = {'id': '123', 'title': 'Title', 'version': {'number': 1}}
+        client = MockSequenceClient([
+            requests.exceptions.ReadTimeout('timed out'),
+            (200, {'results': [page], 'size': 1}),
+        ])
+        self.api._session = client
+        got = self.api._create_page(
+            self.api._create_page_payload(title='Title', space='SPACE'))
+        self.assertEqual(got, page)
+        self.assertEqual(client.requests[1]['method'], 'GET')
+
+    def testCreateRetriesWhenPageMissing(self):
+        page = {'id': '123', 'title': 'Title'}
+        client = MockSequenceClient([
+            (503, {}),
+            (503, {}),
+            (503, {}),
+            (200, {'results': [], 'size': 0}),
+            (200, page),
+        ])
+        self.api._session = client
+        got = self.api._create_page(
+            self.api._create_page_payload(title='Title', space='SPACE'))
+        self.assertEqual(got, page)
+
+    def testCreateClientErrorNotRetried(self):
+        client = MockSequenceClient([(403, {'message': 'Forbidden'})])
+        self.api._session = client
+        with self.assertRaises(RequestFailedException):
+            self.api._create_page(
+                self.api._create_page_payload(title='Title', space='SPACE'))
+        self.assertEqual(len(client.requests), 1)
+
 
 class TestConfluenceHeaders(unittest.TestCase):
     def assert_headers(self, got, want):
@@ -1,9 +1,14 @@
+import json
 import os
 import unittest
 import tempfile
 import textwrap
 
-from convert import convtoconf, ConfluenceRenderer, parse
+import convert
+
+from convert import (convtoconf, convtoconf_many, ConfluenceRenderer, parse,
+                     parse_front_matter)
+from render_cache import RenderCache
 
 
 class TestConvert(unittest.TestCase):
@@ -21,6 +26,15 @@ class TestConvert(unittest.TestCase):
         self.assertEqual(renderer.attachments[0], have_path)
         self.assertEqual(got, want)
 
+    def testImageTagKeywords(self):
+        # mistune 3 passes the alt text first, and the path as a keyword
+        renderer = ConfluenceRenderer()
+        got = renderer.image('alt text', url='/images/example.png', title='')
+        self.assertEqual(
+            got,
+            '<ac:image><ri:attachment ri:filename="example.png" /></ac:image>')
+        self.assertEqual(renderer.attachments, ['/images/example.png'])
+
     def testExternalImageTag(self):
         have_url = 'https://example.com/images/example.png'
         want = '<ac:image><ri:url ri:value="{}" /></ac:image>'.format(have_url)
@@ -52,6 +66,130 @@ class TestConvert(unittest.TestCase):
         self.assertEqual(got, want)
         self.assertEqual(renderer.has_toc, True)
 
+    def testBlockCode(self):
+        want = textwrap.dedent('''\
+            <ac:structured-macro ac:name="code" ac:schema-version="1">
+                <ac:parameter ac:name="language">python</ac:parameter>
+                <ac:plain-text-body><![CDATA[print(1 < 2)]]></ac:plain-text-body>
+            </ac:structured-macro>
+        ''')
+        renderer = ConfluenceRenderer()
+        got = renderer.block_code('print(1 < 2)\n', 'python title=example.py')
+        self.assertEqual(got, want)
+
+    def testConvertMany(self):
+        posts = [
+            ('# Title\n\n![image](/images/one.png)\n', {
+                'author_keys': ['one']
+            }),
+            ('No headers here\n', {
+                'author_keys': ['two']
+            }),
+        ]
+        want = [convtoconf(markdown, front_matter=front_matter)
+                for markdown, front_matter in posts]
+        got = list(convtoconf_many(posts))
+        self.assertEqual(got, want)
+        # The state of the first post doesn't carry over to the second
+        self.assertEqual(got[1][1], [])
+        self.assertNotIn('name="toc"', got[1][0])
+
+    def testRenderCache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = RenderCache(directory.name)
+        markdown = '# Title\n\n![image](/images/one.png)\n'
+        want = convert.render_content(markdown)
+        self.assertEqual(convert.render_content(markdown, cache=cache), want)
+        self.assertEqual(convert.render_content(markdown, cache=cache), want)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Output from another version of the renderer isn't reused
+        version = convert.RENDER_VERSION
+        convert.RENDER_VERSION = 'test'
+        self.addCleanup(setattr, convert, 'RENDER_VERSION', version)
+        convert.render_content(markdown, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testSplitSections(self):
+        markdown = textwrap.dedent('''\
+            Introduction
+
+            # First
+            ```
+            # Not a heading
+
+            # Still not a heading
+            ```
+
+            ## Second
+            # Not a new section
+            ''')
+        sections = convert.split_sections(markdown)
+        self.assertEqual(len(sections), 3)
+        self.assertEqual(''.join(sections), markdown)
+        self.assertTrue(sections[2].startswith('## Second'))
+
+        self.assertIsNone(
+            convert.split_sections('[link][ref]\n\n# Two\n\n[ref]: /one\n'))
+
+    def testSplitSectionsIndentedFence(self):
+        # A fence indented by 4 or more spaces is code, rather than the end
+        # of the code block
+        markdown = '# A\n\n```\n    ```\n\n# inside code\n```\n\n# B\nx\n'
+        sections = convert.split_sections(markdown)
+        self.assertEqual(sections, ['# A\n\n```\n    ```\n\n# inside code\n'
+                                    '```\n\n', '# B\nx\n'])
+        want = convert.render_content(markdown)
+        got = [convert.render_content(section) for section in sections]
+        self.assertEqual(''.join(html for html, _, _ in got), want[0])
+
+    def testFragmentCache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = RenderCache(directory.name)
+        threshold = convert.FRAGMENT_THRESHOLD
+        convert.FRAGMENT_THRESHOLD = 0
+        self.addCleanup(setattr, convert, 'FRAGMENT_THRESHOLD', threshold)
+
+        sections = [
+            '# {}\n\n![image](/images/{}.png)\n\n'.format(i, i)
+            for i in range(3)
+        ]
+        markdown = ''.join(sections)
+        want = convert.render_content(markdown)
+        self.assertEqual(convert.render_content(markdown, cache=cache), want)
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+        # Only the edited section is rendered again
+        sections[1] = sections[1].replace('1.png', 'edited.png')
+        markdown = ''.join(sections)
+        want = convert.render_content(markdown)
+        self.assertEqual(convert.render_content(markdown, cache=cache), want)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def testUnknownEngine(self):
+        with self.assertRaises(ValueError):
+            convtoconf('Hello', engine='unknown')
+
+    @unittest.skipIf(convert.MarkdownIt is None,
+                     'markdown-it-py is not installed')
+    def testMarkdownItEngine(self):
+        markdown = textwrap.dedent('''\
+            # Title
+
+            ![image](/images/one.png)
+
+            ```python
+            print(1 < 2)
+            ```
+            ''')
+        want = convert.render_content(markdown, engine=convert.MISTUNE)
+        got = convert.render_content(markdown, engine=convert.MARKDOWN_IT)
+        self.assertEqual(got[1:], want[1:])
+        self.assertIn(convert.render_code('print(1 < 2)', 'python'), got[0])
+        self.assertIn('<ri:attachment ri:filename="one.png" />', got[0])
+
 
 class TestConvertParse(unittest.TestCase):
     have_yaml = textwrap.dedent(
@@ -123,3 +261,77 @@ class TestConvertParse(unittest.TestCase):
         front_matter, markdown = parse(self.post_path)
         self.assertEqual(front_matter, self.want_yaml)
         self.assertEqual(markdown, self.want_markdown)
+
+    def test_body_read_lazily(self):
+        post = '\n'.join((
+            '---',
+            self.have_yaml,
+            '---',
+            self.have_markdown,
+        )).encode()
+
+        # The body can't be decoded, but that doesn't matter until it's read
+        with open(self.post_path, 'wb') as f:
+            f.write(post + b'\xff')
+
+        front_matter, body = parse_front_matter(self.post_path)
+        self.assertEqual(front_matter, self.want_yaml)
+        with self.assertRaises(UnicodeDecodeError):
+            body.read()
+
+    def test_large_post_mapped(self):
+        post = '\n'.join((
+            self.have_yaml,
+            '---',
+            self.have_markdown,
+        ))
+
+        with open(self.post_path, 'w') as f:
+            f.write(post)
+
+        threshold = convert.MMAP_THRESHOLD
+        convert.MMAP_THRESHOLD = 0
+        self.addCleanup(setattr, convert, 'MMAP_THRESHOLD', threshold)
+        front_matter, markdown = parse(self.post_path)
+        self.assertEqual(front_matter, self.want_yaml)
+        self.assertEqual(markdown, self.want_markdown)
+
+    def test_json_front_matter(self):
+        post = '\n'.join((
+            json.dumps(self.want_yaml, indent=2),
+            self.have_markdown,
+        ))
+
+        with open(self.post_path, 'w') as f:
+            f.write(post)
+
+        front_matter, markdown = parse(self.post_path)
+        self.assertEqual(front_matter, self.want_yaml)
+        self.assertEqual(markdown, self.want_markdown)
+
+    @unittest.skipIf(convert.tomllib is None, 'tomllib is not available')
+    def test_toml_front_matter(self):
+        have_toml = textwrap.dedent(
+            '''\
+            authors = ["username1", "username2"]
+            title = "Test"
+
+            [wiki]
+            share = true
+            space = "~username"
+            ancestor_id = 12345678
+            '''
+        )
+        post = '\n'.join((
+            '+++',
+            have_toml,
+            '+++',
+            self.have_markdown,
+        ))
+
+        with open(self.post_path, 'w') as f:
+            f.write(post)
+
+        front_matter, markdown = parse(self.post_path)
+        self.assertEqual(front_matter, self.want_yaml)
+        self.assertEqual(markdown, self.want_markdown)
@@ -0,0 +1,385 @@
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+import git
+
+from confluence import (AttachmentUploadException, FINGERPRINT_PROPERTY,
+                        RequestFailedException)
+from sources import FILE_SOURCE
+from state import DeployState
+
+# The script's name isn't a valid module name, so it's loaded from its path
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                           'markdown-to-confluence.py')
+spec = importlib.util.spec_from_file_location('markdown_to_confluence',
+                                              SCRIPT_PATH)
+deploy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(deploy)
+
+POST = '''---
+title: Example Page
+wiki:
+    share: true
+---
+![image](/images/image.png)
+'''
+
+
+def make_args(root, **kwargs):
+    args = {
+        'git': root,
+        'space': 'SPACE',
+        'ancestor_id': '123',
+        'global_label': None,
+        'engine': deploy.DEFAULT_ENGINE,
+        'cache_dir': None,
+        'render_cache_mb': None,
+        'jobs': 1,
+        'convert_jobs': 0,
+        'rev': None,
+    }
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def deployed_page(version, fingerprint=None):
+    page = {'id': '12345', 'version': {'number': version}, 'metadata': {}}
+    if fingerprint is not None:
+        page['metadata']['properties'] = {
+            FINGERPRINT_PROPERTY: {
+                'value': {
+                    'fingerprint': fingerprint
+                },
+                'version': {
+                    'number': 1
+                }
+            }
+        }
+    return page
+
+
+class StubConfluence():
+    """Records the pages deployed, failing to upload attachments if asked
+    to."""
+
+    def __init__(self, page=None, fail_attachments=False):
+        self.source = FILE_SOURCE
+        self.page = page
+        self.fail_attachments = fail_attachments
+        # The errors which the next updates raise, in turn
+        self.update_errors = []
+        self.calls = []
+
+    def exists(self, slug=None, ancestor_id=None, space=None):
+        self.calls.append(('exists', slug))
+        return self.page
+
+    def create(self, fingerprint=None, parts=None, **rendered):
+        self.calls.append(('create', rendered['slug']))
+        return self._deployed(fingerprint, rendered)
+
+    def update(self,
+               post_id,
+               page=None,
+               fingerprint=None,
+               parts=None,
+               **rendered):
+        self.calls.append(('update', post_id))
+        if self.update_errors:
+            raise self.update_errors.pop(0)
+        return self._deployed(fingerprint, rendered)
+
+    def _deployed(self, fingerprint, rendered):
+        if self.fail_attachments and rendered['attachments']:
+            page = deployed_page(5, fingerprint=None)
+            raise AttachmentUploadException(
+                'Unable to upload', {
+                    attachment: 'upload failed'
+                    for attachment in rendered['attachments']
+                },
+                page=page)
+        return deployed_page(5, fingerprint=fingerprint)
+
+
+class StubResolver():
+    def author_keys(self, authors):
+        return []
+
+
+class TestDeploy(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = self.directory.name
+        self.post = self.write('content/post.md', POST.encode())
+        self.image = self.write('static/images/image.png', b'image')
+        self.state = DeployState(os.path.join(self.root, 'state.json'),
+                                 root=self.root)
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testFailedAttachmentIsRetried(self):
+        args = make_args(self.root)
+        confluence = StubConfluence(page=deployed_page(4),
+                                    fail_attachments=True)
+        results = deploy.deploy_posts([self.post], args, confluence,
+                                      StubResolver(), self.state)
+        self.assertEqual([result.status for result in results],
+                         [deploy.STATUS_FAILED])
+        self.assertIsInstance(results[0].error, AttachmentUploadException)
+        self.assertEqual(deploy.summarize(results), 1)
+
+        # The new page version is recorded, but not as deployed, so the next
+        # run deploys the post again rather than skipping it
+        entry = self.state.get('post', 'SPACE', '123')
+        self.assertEqual(entry['version'], 5)
+        self.assertIsNone(entry['fingerprint'])
+        self.assertIsNone(entry['source'])
+        self.assertFalse(
+            self.state.unchanged_blobs('content/post.md',
+                                       {'content/post.md': 'sha'},
+                                       deploy.deploy_options(args)))
+
+        confluence.fail_attachments = False
+        results = deploy.deploy_posts([self.post], args, confluence,
+                                      StubResolver(), self.state)
+        self.assertEqual([result.status for result in results],
+                         [deploy.STATUS_UPDATED])
+        self.assertEqual(confluence.calls[-1], ('update', '12345'))
+
+
+class TestPublishPage(unittest.TestCase):
+    def setUp(self):
+        self.state = DeployState()
+        self.rendered = {
+            'content': '<p>Hello</p>',
+            'title': 'Example Page',
+            'tags': [],
+            'slug': 'post',
+            'space': 'SPACE',
+            'ancestor_id': '123',
+            'attachments': [],
+        }
+        self.state.record(self.rendered, deployed_page(4, fingerprint='old'),
+                          'old')
+
+    def testUpdatedByRecordedId(self):
+        confluence = StubConfluence()
+        self.assertEqual(
+            deploy.publish_page(self.rendered, confluence, state=self.state),
+            deploy.STATUS_UPDATED)
+        self.assertEqual(confluence.calls, [('update', '12345')])
+
+    def testStalePageLookedUpAgain(self):
+        for status in deploy.STALE_PAGE_STATUSES:
+            # The page was edited or deleted in Confluence since it was
+            # recorded, so it's looked up again rather than overwritten
+            self.setUp()
+            confluence = StubConfluence(page=deployed_page(6))
+            confluence.update_errors = [
+                RequestFailedException('Stale page', status_code=status)
+            ]
+            self.assertEqual(
+                deploy.publish_page(self.rendered,
+                                    confluence,
+                                    state=self.state), deploy.STATUS_UPDATED)
+            self.assertEqual(confluence.calls, [('update', '12345'),
+                                                ('exists', 'post'),
+                                                ('update', '12345')])
+            self.assertEqual(
+                self.state.get('post', 'SPACE', '123')['version'], 5)
+
+    def testStalePageCreatedAgain(self):
+        confluence = StubConfluence(page=None)
+        confluence.update_errors = [
+            RequestFailedException('Not found', status_code=404)
+        ]
+        self.assertEqual(
+            deploy.publish_page(self.rendered, confluence, state=self.state),
+            deploy.STATUS_CREATED)
+        self.assertEqual(confluence.calls[-1], ('create', 'post'))
+
+    def testOtherErrorsRaised(self):
+        confluence = StubConfluence()
+        confluence.update_errors = [
+            RequestFailedException('Server error', status_code=500)
+        ]
+        with self.assertRaises(RequestFailedException):
+            deploy.publish_page(self.rendered, confluence, state=self.state)
+        self.assertEqual(confluence.calls, [('update', '12345')])
+        self.assertIsNotNone(self.state.get('post', 'SPACE', '123'))
+
+
+class GitRepoTestCase(unittest.TestCase):
+    """Runs each test against a new Git repo."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = self.directory.name
+        self.repo = git.Repo.init(self.root)
+        self.repo.git.config('user.name', 'Test')
+        self.repo.git.config('user.email', 'test@example.com')
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def commit(self, message='Update posts'):
+        self.repo.git.add(A=True)
+        self.repo.git.commit(m=message, allow_empty=True)
+        return self.repo.head.commit.hexsha
+
+
+class TestSkipUnchanged(GitRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.post = self.write('content/post.md', POST.encode())
+        self.image = self.write('static/images/image.png', b'image')
+        self.commit()
+        self.state = DeployState(root=self.root)
+
+    def deployed_with(self, args):
+        rendered = {
+            'slug': 'post',
+            'space': args.space,
+            'ancestor_id': args.ancestor_id,
+            'attachments': [self.image],
+        }
+        self.state.record(rendered,
+                          deployed_page(4, fingerprint='abc'),
+                          'abc',
+                          source=self.repo.git.hash_object(self.post),
+                          options=deploy.deploy_options(args),
+                          post_path=self.post)
+
+    def assertSkipped(self, args, skipped):
+        changed, unchanged = deploy.skip_unchanged(self.repo,
+                                                   ['content/post.md'], args,
+                                                   self.state)
+        if skipped:
+            self.assertEqual((changed, unchanged), ([], ['content/post.md']))
+        else:
+            self.assertEqual((changed, unchanged), (['content/post.md'], []))
+
+    def testUnchanged(self):
+        args = make_args(self.root)
+        self.deployed_with(args)
+        self.assertSkipped(args, True)
+
+        self.write('static/images/image.png', b'new image')
+        self.commit()
+        self.assertSkipped(args, False)
+
+    def testTargetChanged(self):
+        # The post doesn't set its own space or ancestor, so moving the
+        # defaults has to deploy it again, even though git shows no change
+        args = make_args(self.root)
+        self.deployed_with(args)
+        self.assertSkipped(make_args(self.root, space='OTHER'), False)
+        self.assertSkipped(make_args(self.root, ancestor_id='456'), False)
+
+    def testRendererChanged(self):
+        # A post rendered by another engine, or another version of the
+        # renderer, may produce a different page
+        args = make_args(self.root)
+        self.deployed_with(args)
+        self.assertSkipped(make_args(self.root, engine='other'), False)
+        with mock.patch.object(deploy, 'RENDER_VERSION', 'other'):
+            self.assertSkipped(args, False)
+
+
+class TestLastModified(GitRepoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write('content/one.md', b'one')
+        self.write('content/two.md', b'two')
+        self.write('static/image.png', b'image')
+        self.first = self.commit()
+
+    def lastModified(self, since=None, rev='HEAD'):
+        return sorted(
+            deploy.get_last_modified(self.repo, since=since, rev=rev))
+
+    def testRootCommit(self):
+        self.assertEqual(self.lastModified(),
+                         ['content/one.md', 'content/two.md'])
+
+    def testSinceParent(self):
+        self.write('content/two.md', b'two, edited')
+        self.write('static/image.png', b'new image')
+        self.commit()
+        self.assertEqual(self.lastModified(), ['content/two.md'])
+
+    def testSinceLastDeploy(self):
+        # Every post changed since the last deployed commit is returned once,
+        # however many commits changed it
+        self.write('content/one.md', b'one, edited')
+        self.commit()
+        self.write('content/one.md', b'one, edited again')
+        self.write('content/three.md', b'three')
+        self.commit()
+        self.assertEqual(self.lastModified(since=self.first),
+                         ['content/one.md', 'content/three.md'])
+
+    def testRenamesAndDeletions(self):
+        self.repo.git.mv('content/one.md', 'content/renamed.md')
+        self.repo.git.rm('content/two.md')
+        self.commit()
+        self.assertEqual(self.lastModified(since=self.first),
+                         ['content/renamed.md'])
+
+    def testSinceMissing(self):
+        self.write('content/one.md', b'one, edited')
+        self.commit()
+        with self.assertLogs(deploy.log, level='WARNING'):
+            self.assertEqual(self.lastModified(since='0' * 40),
+                             ['content/one.md', 'content/two.md'])
+
+    def testSinceNotAncestor(self):
+        # The last deployed commit was force-pushed away, so the posts it
+        # changed are deployed again, as well as the new changes
+        self.write('content/one.md', b'one, deployed')
+        deployed = self.commit()
+        self.repo.git.reset(self.first, hard=True)
+        self.write('content/two.md', b'two, edited')
+        self.commit()
+        with self.assertLogs(deploy.log, level='WARNING'):
+            self.assertEqual(self.lastModified(since=deployed),
+                             ['content/one.md', 'content/two.md'])
+
+
+class TestParseArgs(unittest.TestCase):
+    def parse(self, *argv):
+        with mock.patch.object(sys, 'argv', ['markdown-to-confluence.py'] +
+                               list(argv)):
+            return deploy.parse_args()
+
+    @mock.patch.object(deploy, 'aiohttp', object())
+    def testAsyncRejectsUnsupportedOptions(self):
+        api_url = '--api_url=https://wiki.example.com/rest/api'
+        self.assertTrue(self.parse(api_url, '--async').use_async)
+        for option in [['--state-dir', 'state'], ['--retries', '0'],
+                       ['--convert-jobs', '2'], ['--prewarm']]:
+            with self.assertLogs(level='ERROR') as logs:
+                with self.assertRaises(SystemExit):
+                    self.parse(api_url, '--async', *option)
+            self.assertIn(option[0], logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+
+from index import PostIndex, get_slug, post_slug
+
+SHARED_POST = '''---
+title: Shared Post
+authors: [Jordan]
+tags: [example]
+wiki:
+    share: true
+    space: SPACE
+---
+Hello
+'''
+
+PRIVATE_POST = '''---
+title: Private Post
+---
+Hello
+'''
+
+
+class TestPostIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.index_path = os.path.join(self.directory.name, 'cache',
+                                       'index.json')
+        self.write('content/shared-post.md', SHARED_POST)
+        self.write('content/private.md', PRIVATE_POST)
+        self.posts = ['content/private.md', 'content/shared-post.md']
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def testSlug(self):
+        self.assertEqual(get_slug('content/my-post.md'), 'my_post')
+        self.assertEqual(get_slug('content/my-post.md', prefix='a_b'),
+                         'a_b_my_post')
+        self.assertEqual(
+            post_slug('content/my-post.md', {'authors': ['Alice', 'Bob']}),
+            'alice_bob_my_post')
+
+    def testIndexesFrontMatter(self):
+        index = PostIndex(self.index_path, root=self.directory.name)
+        self.assertEqual(index.update(self.posts), 2)
+        self.assertEqual(index.shared(), ['content/shared-post.md'])
+
+        entry = index.get('content/shared-post.md')
+        self.assertEqual(entry['slug'], 'jordan_shared_post')
+        self.assertEqual(entry['authors'], ['Jordan'])
+        self.assertEqual(entry['tags'], ['example'])
+        self.assertEqual(entry['space'], 'SPACE')
+        self.assertIsNone(entry['ancestor_id'])
+        self.assertEqual(entry['size'], len(SHARED_POST))
+        self.assertTrue(entry['blob'])
+
+    def testUpdatedIncrementally(self):
+        index = PostIndex(self.index_path, root=self.directory.name)
+        index.update(self.posts)
+        index.save()
+
+        index = PostIndex(self.index_path, root=self.directory.name)
+        self.assertEqual(index.update(self.posts), 0)
+
+        self.write('content/private.md',
+                   PRIVATE_POST.replace('---\nHello', 'wiki:\n    share: true\n---\nHello'))
+        self.assertEqual(index.update(self.posts), 1)
+        self.assertEqual(index.shared(), self.posts)
+
+        self.assertEqual(index.update(['content/private.md']), 0)
+        self.assertIsNone(index.get('content/shared-post.md'))
+
+    def testUpdatedByBlob(self):
+        index = PostIndex(self.index_path, root=self.directory.name)
+        blobs = {'content/private.md': 'a', 'content/shared-post.md': 'b'}
+        self.assertEqual(index.update(self.posts, blobs=blobs), 2)
+        self.assertEqual(index.get('content/private.md')['blob'], 'a')
+        self.assertEqual(index.update(self.posts, blobs=blobs), 0)
+        blobs['content/private.md'] = 'c'
+        self.assertEqual(index.update(self.posts, blobs=blobs), 1)
+
+    def testCollisions(self):
+        self.write('content/other/shared-post.md', SHARED_POST)
+        index = PostIndex(root=self.directory.name)
+        index.update(self.posts + ['content/other/shared-post.md'])
+        self.assertEqual(
+            index.collisions(), {
+                'jordan_shared_post':
+                ['content/other/shared-post.md', 'content/shared-post.md']
+            })
+
+    def testUnparseablePost(self):
+        self.write('content/broken.md', '---\ntitle: [\n---\nHello\n')
+        index = PostIndex(root=self.directory.name)
+        index.update(['content/broken.md'])
+        self.assertFalse(index.get('content/broken.md')['share'])
+        self.assertIn('error', index.get('content/broken.md'))
+
+
+if __name__ == '__main__':
+    unittest.main()
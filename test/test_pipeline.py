@@ -0,0 +1,109 @@
+import os
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pipeline import run_pipeline
+
+
+def square(n):
+    if n < 0:
+        raise ValueError('negative')
+    return n * n
+
+
+def die(n):
+    if n == 3:
+        os._exit(1)
+    return n
+
+
+class BreakingExecutor(ThreadPoolExecutor):
+    """An executor which breaks after a number of submissions, like a
+    process pool whose worker died."""
+
+    def __init__(self, submissions):
+        self.submissions = submissions
+        super().__init__(max_workers=2)
+
+    def submit(self, *args, **kwargs):
+        if self.submissions == 0:
+            raise BrokenProcessPool('A worker process died')
+        self.submissions -= 1
+        return super().submit(*args, **kwargs)
+
+
+class TestPipeline(unittest.TestCase):
+    def testResultsInOrder(self):
+        items = list(range(20))
+        got = run_pipeline(items,
+                           square,
+                           lambda item, converted: (item, converted),
+                           lambda item, e: (item, None),
+                           convert_jobs=2,
+                           publish_jobs=3)
+        self.assertEqual(got, [(n, n * n) for n in items])
+
+    def testErrors(self):
+        got = run_pipeline([1, -1, 2],
+                           square,
+                           lambda item, converted: converted,
+                           lambda item, e: str(e),
+                           convert_jobs=2)
+        self.assertEqual(got, [1, 'negative', 4])
+
+    def testBrokenPool(self):
+        items = list(range(10))
+        got = run_pipeline(items,
+                           square,
+                           lambda item, converted: converted,
+                           lambda item, e: type(e).__name__,
+                           max_pending=2,
+                           _executor=BreakingExecutor(3))
+        self.assertEqual(got, [0, 1, 4] + ['BrokenProcessPool'] * 7)
+
+    def testWorkerDied(self):
+        got = run_pipeline(list(range(40)),
+                           die,
+                           lambda item, converted: converted,
+                           lambda item, e: 'failed',
+                           convert_jobs=2,
+                           max_pending=4)
+        # Every item gets a result, even once the pool is broken
+        self.assertNotIn(None, got)
+        self.assertEqual(got[3], 'failed')
+
+    def testBackpressure(self):
+        lock = threading.Lock()
+        outstanding = [0]
+        peak = [0]
+        release = threading.Event()
+
+        def convert(item):
+            with lock:
+                outstanding[0] += 1
+                peak[0] = max(peak[0], outstanding[0])
+            return item
+
+        def publish(item, converted):
+            release.wait(0.01)
+            with lock:
+                outstanding[0] -= 1
+            return converted
+
+        items = list(range(50))
+        got = run_pipeline(items,
+                           convert,
+                           publish,
+                           lambda item, e: None,
+                           publish_jobs=2,
+                           max_pending=4,
+                           _executor=ThreadPoolExecutor(max_workers=8))
+        self.assertEqual(got, items)
+        self.assertLessEqual(peak[0], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
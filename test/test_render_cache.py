@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from render_cache import RenderCache, cache_key
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_dir = os.path.join(self.directory.name, 'render')
+
+    def testCacheKey(self):
+        self.assertEqual(cache_key('a', 'b'), cache_key('a', 'b'))
+        self.assertNotEqual(cache_key('a', 'b'), cache_key('ab', ''))
+
+    def testHitsAndMisses(self):
+        cache = RenderCache(self.cache_dir)
+        key = cache_key('post')
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {'content': '<p>Hello</p>', 'attachments': []})
+
+        # Entries are shared with other processes through the directory
+        cache = RenderCache(self.cache_dir)
+        self.assertEqual(cache.get(key), {
+            'content': '<p>Hello</p>',
+            'attachments': []
+        })
+        self.assertIsNone(cache.get(cache_key('other')))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def testEvictsLeastRecentlyUsed(self):
+        value = {'content': 'x' * 100}
+        cache = RenderCache(self.cache_dir, max_size=350)
+        keys = [cache_key(str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.put(key, value)
+            # Make sure the entries are ordered, whatever the resolution of
+            # the filesystem's timestamps
+            os.utime(cache._path(key), (i, i))
+        cache.get(keys[0])
+
+        cache.put(cache_key('3'), value)
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(cache_key('3')))
+
+
+if __name__ == '__main__':
+    unittest.main()
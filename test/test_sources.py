@@ -0,0 +1,108 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from convert import parse_front_matter
+from sources import FileSource, GitSource, blob_sha
+
+
+class MockGit():
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.reads = []
+        self._lock = threading.Lock()
+
+    def ls_tree(self, rev, r=False, long=False, z=False):
+        return ''.join('100644 blob {} {:>7}\t{}\0'.format(
+            sha, len(data), path) for path, (sha, data) in self.blobs.items())
+
+    def get_object_data(self, sha):
+        # The real cat-file process can only serve one caller at a time
+        if not self._lock.acquire(blocking=False):
+            raise AssertionError('cat-file used concurrently')
+        try:
+            self.reads.append(sha)
+            for blob, data in self.blobs.values():
+                if blob == sha:
+                    return sha, 'blob', len(data), data
+        finally:
+            self._lock.release()
+
+
+class MockRepo():
+    def __init__(self, blobs):
+        self.git = MockGit(blobs)
+
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.root = self.directory.name
+        self.post = os.path.join(self.root, 'content', 'post.md')
+        os.makedirs(os.path.dirname(self.post))
+        with open(self.post, 'wb') as f:
+            f.write(b'# Hello\n')
+
+    def testBlobSha(self):
+        try:
+            expected = subprocess.check_output(
+                ['git', 'hash-object', self.post]).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest('git is not available')
+        self.assertEqual(blob_sha(self.post), expected)
+
+    def testGitSourceMatchesFiles(self):
+        files = FileSource()
+        repo = MockRepo({
+            'content/post.md': (blob_sha(self.post), b'# Hello\n'),
+        })
+        source = GitSource(repo, self.root, rev='abc123')
+
+        self.assertTrue(source.exists(self.post))
+        self.assertFalse(source.exists(os.path.join(self.root, 'missing.md')))
+        for method in ['size', 'read', 'digest', 'blob_sha']:
+            self.assertEqual(
+                getattr(source, method)(self.post),
+                getattr(files, method)(self.post), method)
+        with source.open(self.post) as f:
+            self.assertEqual(f.read(), b'# Hello\n')
+        self.assertEqual(source.digest(self.post),
+                         hashlib.sha256(b'# Hello\n').hexdigest())
+
+        with self.assertRaises(IOError):
+            source.read(os.path.join(self.root, 'missing.md'))
+
+    def testGitSourceReadsPostOnce(self):
+        post = b'---\ntitle: Hello\n---\n# Hello\n'
+        repo = MockRepo({'content/post.md': ('{:040x}'.format(1), post)})
+        source = GitSource(repo, self.root)
+        front_matter, body = parse_front_matter(self.post, source=source)
+        self.assertEqual(front_matter, {'title': 'Hello'})
+        self.assertEqual(body.read(), '# Hello')
+        self.assertEqual(len(repo.git.reads), 1)
+
+    def testGitSourceSerializesReads(self):
+        blobs = {
+            'content/{}.md'.format(i): ('{:040x}'.format(i), b'post')
+            for i in range(50)
+        }
+        repo = MockRepo(blobs)
+        source = GitSource(repo, self.root)
+        threads = [
+            threading.Thread(target=source.read,
+                             args=(os.path.join(self.root, path), ))
+            for path in blobs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(repo.git.reads), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import tempfile
+import unittest
+
+from confluence import FINGERPRINT_PROPERTY
+from sources import blob_sha
+from state import DeployState
+
+
+class TestDeployState(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.state_path = os.path.join(self.directory.name, 'state',
+                                       'state.json')
+        self.post = self.write('post.md', b'# Hello\n')
+        self.image = self.write('image.png', b'image')
+        self.rendered = {
+            'slug': 'example-page',
+            'space': 'SPACE',
+            'ancestor_id': 123,
+            'attachments': [self.image],
+        }
+        self.page = {
+            'id': '12345',
+            'version': {
+                'number': 4
+            },
+            'metadata': {
+                'properties': {
+                    FINGERPRINT_PROPERTY: {
+                        'value': {
+                            'fingerprint': 'abc',
+                            'parts': {
+                                'title': 'Example Page'
+                            }
+                        },
+                        'version': {
+                            'number': 2
+                        }
+                    }
+                }
+            }
+        }
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def testUnchangedAcrossRuns(self):
+        state = DeployState(self.state_path)
+        source = blob_sha(self.post)
+        state.record(self.rendered, self.page, 'abc', source=source)
+        state.save()
+
+        state = DeployState(self.state_path)
+        self.assertTrue(state.unchanged('example-page', 'SPACE', 123, source))
+        self.assertFalse(state.unchanged('example-page', 'SPACE', 456,
+                                         source))
+        self.assertFalse(
+            state.unchanged('example-page', 'SPACE', 123, source,
+                            {'global_label': 'blog'}))
+        self.assertEqual(
+            state.cached_page(state.get('example-page', 'SPACE', 123)),
+            self.page)
+
+        self.write('post.md', b'# Hello, world\n')
+        self.assertFalse(
+            state.unchanged('example-page', 'SPACE', 123,
+                            blob_sha(self.post)))
+
+        self.write('image.png', b'new image')
+        self.assertFalse(state.unchanged('example-page', 'SPACE', 123,
+                                         source))
+
+    def testFingerprintNotStored(self):
+        state = DeployState(self.state_path)
+        page = {'id': '12345', 'version': {'number': 4}, 'metadata': {}}
+        state.record(self.rendered, page, 'abc', source=blob_sha(self.post))
+        entry = state.get('example-page', 'SPACE', 123)
+        self.assertIsNone(entry['fingerprint'])
+        self.assertFalse(
+            state.unchanged('example-page', 'SPACE', 123,
+                            blob_sha(self.post)))
+        self.assertNotIn('metadata', state.cached_page(entry))
+
+    def testUnchangedBlobs(self):
+        state = DeployState(self.state_path, root=self.directory.name)
+        source = blob_sha(self.post)
+        state.record(self.rendered,
+                     self.page,
+                     'abc',
+                     source=source,
+                     post_path=self.post)
+        state.save()
+
+        state = DeployState(self.state_path, root=self.directory.name)
+        blobs = {'post.md': source, 'image.png': blob_sha(self.image)}
+        self.assertTrue(state.unchanged_blobs('post.md', blobs))
+        self.assertFalse(state.unchanged_blobs('other.md', blobs))
+        self.assertFalse(
+            state.unchanged_blobs('post.md', dict(blobs, **{'post.md': '1'})))
+        self.assertFalse(
+            state.unchanged_blobs('post.md', dict(blobs,
+                                                  **{'image.png': '1'})))
+
+        state.forget('example-page')
+        self.assertFalse(state.unchanged_blobs('post.md', blobs))
+
+    def testUnchangedBlobsTargetChanged(self):
+        state = DeployState(self.state_path, root=self.directory.name)
+        source = blob_sha(self.post)
+        options = {'space': 'OLD', 'ancestor_id': '123'}
+        state.record(self.rendered,
+                     self.page,
+                     'abc',
+                     source=source,
+                     options=options,
+                     post_path=self.post)
+        blobs = {'post.md': source, 'image.png': blob_sha(self.image)}
+        self.assertTrue(state.unchanged_blobs('post.md', blobs, options))
+
+        # Moving the default target has to deploy the post again, even though
+        # nothing in the repo changed
+        self.assertFalse(
+            state.unchanged_blobs('post.md', blobs, dict(options,
+                                                         space='NEW')))
+        self.assertFalse(
+            state.unchanged_blobs('post.md', blobs,
+                                  dict(options, ancestor_id='456')))
+
+    def testCommitPersisted(self):
+        state = DeployState(self.state_path)
+        self.assertIsNone(state.commit)
+        state.set_commit('abc123')
+        state.save()
+        self.assertEqual(DeployState(self.state_path).commit, 'abc123')
+
+    def testForget(self):
+        state = DeployState(self.state_path)
+        state.record(self.rendered, self.page, 'abc')
+        state.forget('example-page')
+        self.assertIsNone(state.get('example-page', 'SPACE', 123))
+
+    def testIgnoresUnreadableState(self):
+        os.makedirs(os.path.dirname(self.state_path))
+        with open(self.state_path, 'w') as f:
+            f.write('{not json')
+        state = DeployState(self.state_path)
+        self.assertIsNone(state.get('example-page', 'SPACE', 123))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+
+from throttle import (READ, UPLOAD, WRITE, AdaptiveLimiter, RetryPolicy,
+                      TokenBucket, parse_retry_after, rate_limit_buckets,
+                      request_kind)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+    def testBurstThenWait(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, _clock=clock)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # The bucket is empty, so callers queue up behind each other
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+
+    def testRefill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, _clock=clock)
+        self.assertEqual(bucket.reserve(), 0)
+        clock.now += 1
+        self.assertEqual(bucket.reserve(), 0)
+        # Idle time never fills the bucket past its capacity
+        clock.now += 60
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+
+    def testInvalidRate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+
+
+class TestRequestKind(unittest.TestCase):
+    def testKinds(self):
+        self.assertEqual(request_kind('GET'), READ)
+        self.assertEqual(request_kind('put'), WRITE)
+        self.assertEqual(request_kind('POST'), WRITE)
+        self.assertEqual(request_kind('POST', files={'file': None}), UPLOAD)
+
+    def testUnlimitedKindsHaveNoBucket(self):
+        buckets = rate_limit_buckets({READ: 5, WRITE: None})
+        self.assertEqual(list(buckets), [READ])
+        self.assertEqual(rate_limit_buckets(None), {})
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = AdaptiveLimiter(maximum=8,
+                                       latency_window=4,
+                                       _clock=self.clock)
+
+    def complete(self, count, status=200, latency=0.1, retry_after=None):
+        for _ in range(count):
+            self.limiter.acquire()
+            self.limiter.release(status=status,
+                                 latency=latency,
+                                 retry_after=retry_after)
+
+    def testAdditiveIncrease(self):
+        self.assertEqual(self.limiter.limit, 1)
+        self.complete(1)
+        self.assertEqual(self.limiter.limit, 2)
+        # Growing by one more takes about a full round of requests at the
+        # current limit
+        self.complete(2)
+        self.assertEqual(self.limiter.limit, 2)
+        self.complete(1)
+        self.assertEqual(self.limiter.limit, 3)
+        self.complete(200)
+        self.assertEqual(self.limiter.limit, 8)
+
+    def testMultiplicativeDecrease(self):
+        self.complete(200)
+        self.complete(1, status=429)
+        self.assertEqual(self.limiter.limit, 4)
+        # Errors from the same round of requests only count once
+        self.complete(3, status=503)
+        self.assertEqual(self.limiter.limit, 4)
+        self.clock.now += 2
+        self.complete(1, status=503)
+        self.assertEqual(self.limiter.limit, 2)
+
+    def testLatencyIncrease(self):
+        self.complete(200, latency=0.1)
+        self.assertEqual(self.limiter.limit, 8)
+        self.complete(4, latency=1.0)
+        self.assertEqual(self.limiter.limit, 4)
+
+    def testRetryAfterBlocksNewRequests(self):
+        self.complete(1, status=429, retry_after=0.05)
+        self.assertGreater(self.limiter._blocked_until, self.clock.now)
+
+
+class TestParseRetryAfter(unittest.TestCase):
+    def testSeconds(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+
+    def testDate(self):
+        got = parse_retry_after('Wed, 21 Oct 2015 07:28:30 GMT',
+                                _now=lambda: 1445412480)
+        self.assertEqual(got, 30)
+
+    def testInvalid(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def testShouldRetry(self):
+        policy = RetryPolicy(retries=2)
+        self.assertTrue(policy.should_retry(0, 503, idempotent=True))
+        self.assertFalse(policy.should_retry(0, 404, idempotent=True))
+        self.assertFalse(policy.should_retry(2, 503, idempotent=True))
+        # A 500 may mean the request took effect, but a 429 never does
+        self.assertFalse(policy.should_retry(0, 500, idempotent=False))
+        self.assertTrue(policy.should_retry(0, 429, idempotent=False))
+
+    def testDelay(self):
+        policy = RetryPolicy(backoff=1, max_backoff=5, _random=lambda: 1.0)
+        self.assertEqual(policy.delay(0), 1)
+        self.assertEqual(policy.delay(2), 4)
+        self.assertEqual(policy.delay(10), 5)
+        self.assertEqual(policy.delay(0, retry_after=30), 30)
+
+    def testJitter(self):
+        policy = RetryPolicy(backoff=1, _random=lambda: 0.25)
+        self.assertEqual(policy.delay(2), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
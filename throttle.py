@@ -0,0 +1,286 @@
+"""Client-side throttling and retries for requests sent to Confluence."""
+
+import collections
+import email.utils
+import random
+import threading
+import time
+
+READ = 'read'
+WRITE = 'write'
+UPLOAD = 'upload'
+
+READ_METHODS = ['GET', 'HEAD', 'OPTIONS']
+
+# Responses which mean Confluence wants us to back off
+OVERLOADED_STATUSES = [429, 503]
+
+# Methods which can be safely repeated if we don't know whether the first
+# attempt took effect
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+# Responses which mean the request was refused before being processed, and
+# so can be retried regardless of the method
+REJECTED_STATUSES = [429]
+
+# Responses which mean the request may have failed for a transient reason
+TRANSIENT_STATUSES = [429, 500, 502, 503, 504]
+
+DEFAULT_RETRIES = 3
+
+
+def request_kind(method, files=None):
+    """Returns the kind of request being made, which determines the budget
+    it is throttled against.
+
+    Arguments:
+        method {str} -- The HTTP method
+        files {dict} -- Any files being uploaded with the request
+    """
+    if files:
+        return UPLOAD
+    if method.upper() in READ_METHODS:
+        return READ
+    return WRITE
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity=None, _clock=time.monotonic):
+        """Creates a new token bucket, which allows requests to be made at a
+        steady rate, with short bursts of up to `capacity` requests.
+
+        Arguments:
+            rate {float} -- The number of requests allowed per second
+            capacity {float} -- The maximum burst size (default: one second's
+                worth of requests, and at least 1)
+        """
+        if rate <= 0:
+            raise ValueError('Token bucket rate must be positive')
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._clock = _clock
+        self._tokens = self.capacity
+        self._updated = self._clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token from the bucket, returning the number of seconds the
+        caller must wait before sending its request.
+
+        If the bucket is empty, the token is borrowed against the next refill
+        so that callers are served in the order they arrived.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+def rate_limit_buckets(rate_limits):
+    """Returns a token bucket for each kind of request which has a rate
+    limit.
+
+    Arguments:
+        rate_limits {dict} -- The requests per second allowed for each kind of
+            request (READ, WRITE or UPLOAD). Kinds which are missing, or set
+            to None, aren't throttled.
+    """
+    return {
+        kind: TokenBucket(rate)
+        for kind, rate in (rate_limits or {}).items() if rate
+    }
+
+
+def parse_retry_after(value, _now=time.time):
+    """Returns the number of seconds to wait given a Retry-After header,
+    which may be either a number of seconds or an HTTP date.
+
+    Arguments:
+        value {str} -- The Retry-After header value
+
+    Returns:
+        float -- The number of seconds to wait, or None if the header is
+            missing or malformed
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - _now())
+
+
+class AdaptiveLimiter():
+    def __init__(self,
+                 maximum,
+                 minimum=1,
+                 initial=None,
+                 decrease=0.5,
+                 latency_window=20,
+                 latency_tolerance=2.0,
+                 cooldown=1.0,
+                 _clock=time.monotonic):
+        """Creates a new limiter which adjusts the number of concurrent
+        requests to what Confluence can currently handle.
+
+        The limit grows additively while requests succeed, by about one
+        request for each full round of requests at the current limit. It is
+        cut multiplicatively when Confluence responds with a 429 or 503, or
+        when the p95 latency of recent requests rises past
+        `latency_tolerance` times the best p95 we've seen. If Confluence
+        sends a Retry-After header, no new requests are started until it has
+        passed.
+
+        Arguments:
+            maximum {int} -- The most concurrent requests we'll ever allow
+            minimum {int} -- The fewest concurrent requests we'll ever allow
+            initial {int} -- The starting limit (default: minimum)
+            decrease {float} -- The factor the limit is cut by on overload
+            latency_window {int} -- The number of requests over which the
+                p95 latency is measured
+            latency_tolerance {float} -- How far the p95 latency may rise
+                over its best value before we treat it as overload
+            cooldown {float} -- The number of seconds after cutting the
+                limit during which we won't cut it again, so that a burst of
+                errors from the same round of requests is only counted once
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self._limit = float(initial or minimum)
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._last_decrease = None
+        self._latencies = collections.deque(maxlen=latency_window)
+        self._best_p95 = None
+        self._clock = _clock
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The number of requests currently allowed to be in flight."""
+        return int(self._limit)
+
+    def acquire(self):
+        """Blocks until another request may be started."""
+        with self._condition:
+            while True:
+                wait = self._blocked_until - self._clock()
+                if wait <= 0 and self._in_flight < self.limit:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._in_flight += 1
+
+    def release(self, status=None, latency=None, retry_after=None,
+                failed=False):
+        """Records the outcome of a request started with acquire.
+
+        Keyword Arguments:
+            status {int} -- The HTTP status code of the response
+            latency {float} -- The number of seconds the request took
+            retry_after {float} -- The delay requested by Confluence, if any
+            failed {bool} -- Whether the request failed without a response
+                (e.g. a connection error or timeout)
+        """
+        with self._condition:
+            self._in_flight -= 1
+            now = self._clock()
+            if retry_after:
+                self._blocked_until = max(self._blocked_until,
+                                          now + retry_after)
+
+            if failed or status in OVERLOADED_STATUSES:
+                self._backoff(now)
+            elif latency is not None and self._latency_rising(latency):
+                self._backoff(now)
+            elif status is not None and status < 400:
+                self._limit = min(self.maximum,
+                                  self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+    def _latency_rising(self, latency):
+        self._latencies.append(latency)
+        if len(self._latencies) < self._latencies.maxlen:
+            return False
+
+        ordered = sorted(self._latencies)
+        p95 = ordered[int(0.95 * (len(ordered) - 1))]
+        self._latencies.clear()
+        if self._best_p95 is None or p95 < self._best_p95:
+            self._best_p95 = p95
+            return False
+        return p95 > self._best_p95 * self.latency_tolerance
+
+    def _backoff(self, now):
+        if (self._last_decrease is not None
+                and now - self._last_decrease < self.cooldown):
+            return
+        self._last_decrease = now
+        self._limit = max(self.minimum, self._limit * self.decrease)
+
+
+class RetryPolicy():
+    def __init__(self,
+                 retries=DEFAULT_RETRIES,
+                 backoff=0.5,
+                 max_backoff=30.0,
+                 _random=random.random):
+        """Creates a new retry policy, which retries transient failures with
+        exponential backoff and full jitter.
+
+        Arguments:
+            retries {int} -- The number of times to retry a request
+            backoff {float} -- The base delay, in seconds, which doubles with
+                each attempt
+            max_backoff {float} -- The longest delay between attempts
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._random = _random
+
+    def should_retry(self, attempt, status, idempotent):
+        """Returns whether a request which received the given status should
+        be retried.
+
+        Requests which may have taken effect (e.g. a POST which received a
+        500) are only retried if they're idempotent.
+
+        Arguments:
+            attempt {int} -- The number of retries made so far
+            status {int} -- The HTTP status code of the response
+            idempotent {bool} -- Whether the request can safely be repeated
+        """
+        if attempt >= self.retries or status not in TRANSIENT_STATUSES:
+            return False
+        return idempotent or status in REJECTED_STATUSES
+
+    def delay(self, attempt, retry_after=None):
+        """Returns the number of seconds to wait before the next attempt.
+
+        Arguments:
+            attempt {int} -- The number of retries made so far
+            retry_after {float} -- The delay requested by Confluence, if any
+        """
+        ceiling = min(self.max_backoff, self.backoff * (2**attempt))
+        delay = self._random() * ceiling
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay